@@ -1,10 +1,10 @@
 #!/usr/bin/python
-import gzip
 import glob
 import itertools
-import io
-import subprocess
-from readfq import readfq
+from readfq import read_line_batches
+from AddUmiNugen import join_lines, tag_lines
+from compression import (BACKENDS, DEFAULT_COMPRESSION, open_input,
+                         open_output)
 
 '''
 Commands to generate read and barcode fastq files from NEBNext Direct
@@ -19,14 +19,7 @@ INCLUDE_NON_PF_READS=FALSE IGNORE_UNEXPECTED_BARCODES=TRUE
 '''
 
 
-def writefq(fh, data):
-    fh.write('@' + data[0] + '\n')
-    fh.write(data[1] + '\n')
-    fh.write('+\n')
-    fh.write(data[2] + '\n')
-
-
-def add_umi_neb(input_dir, output_dir):
+def add_umi_neb(input_dir, output_dir, compression=None):
     R1 = glob.glob(input_dir + '/*.1.fastq.gz')[0]
     R2 = glob.glob(input_dir + '/*.2.fastq.gz')[0]
     umi = glob.glob(input_dir + '/*index*')[0]
@@ -36,32 +29,23 @@ def add_umi_neb(input_dir, output_dir):
         sample_name = sample_file_split[0]
     else:
         sample_name = '_'.join(sample_file_split[:-3])
-    r1 = open(output_dir + '/' + sample_name + '_R1_UMI_001.fastq.gz', 'w')
-    r2 = open(output_dir + '/' + sample_name + '_R2_UMI_001.fastq.gz', 'w')
-    # Use subprocess to pipe to gzip
-    r1_out = subprocess.Popen('gzip', stdin=subprocess.PIPE, stdout=r1)
-    r2_out = subprocess.Popen('gzip', stdin=subprocess.PIPE, stdout=r2)
+    r1_out = open_output(output_dir + '/' + sample_name +
+                         '_R1_UMI_001.fastq.gz', compression)
+    r2_out = open_output(output_dir + '/' + sample_name +
+                         '_R2_UMI_001.fastq.gz', compression)
 
-    with io.BufferedReader(gzip.open(R1, 'rb')) as read1, \
-            io.BufferedReader(gzip.open(R2, 'rb')) as read2, \
-            io.BufferedReader(gzip.open(umi, 'rb')) as uid:
-        for data1, data2, umidata in itertools.izip(readfq(read1),
-                                                    readfq(read2),
-                                                    readfq(uid)):
-            r1_name, r1_suffix = data1[0].split()
-            r2_name, r2_suffix = data2[0].split()
-            umi_name = umidata[0].split()[0]
-            umi_id = umidata[1]
-            assert(r1_name == r2_name == umi_name), 'Mismatch in read names'
-            r1_umi = r1_name + ':' + umi_id + ' ' + r1_suffix
-            r2_umi = r2_name + ':' + umi_id + ' ' + r2_suffix
-            writefq(r1_out.stdin, (r1_umi, data1[1], data1[2]))
-            writefq(r2_out.stdin, (r2_umi, data2[1], data2[2]))
+    with open_input(R1, compression) as read1, \
+            open_input(R2, compression) as read2, \
+            open_input(umi, compression) as uid:
+        for lines1, lines2, umi_lines in itertools.izip(
+                read_line_batches(read1), read_line_batches(read2),
+                read_line_batches(uid)):
+            tag_lines((lines1, lines2), umi_lines)
+            r1_out.write(join_lines(lines1))
+            r2_out.write(join_lines(lines2))
 
-    r1_out.communicate()
-    r2_out.communicate()
-    r1.close()
-    r2.close()
+    r1_out.close()
+    r2_out.close()
 
 if __name__ == '__main__':
 
@@ -70,6 +54,16 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input_dir', help='Directory with Fastqs')
     parser.add_argument('-o', '--output_dir', help='Output directory')
+    parser.add_argument('-z', '--compression', choices=BACKENDS,
+                        default=DEFAULT_COMPRESSION['backend'])
+    parser.add_argument('-l', '--level', type=int,
+                        default=DEFAULT_COMPRESSION['level'],
+                        help='Compression level')
+    parser.add_argument('-t', '--threads', type=int,
+                        default=DEFAULT_COMPRESSION['threads'],
+                        help='Compression threads for pigz')
 
     opts = parser.parse_args()
-    add_umi_neb(opts.input_dir, opts.output_dir)
+    compression = {'backend': opts.compression, 'level': opts.level,
+                   'threads': opts.threads}
+    add_umi_neb(opts.input_dir, opts.output_dir, compression)
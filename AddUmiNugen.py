@@ -1,78 +1,186 @@
 #!/usr/bin/python
-import gzip
 import glob
 import itertools
-import io
-import subprocess
-from readfq import readfq
+from collections import deque
+from multiprocessing import Pool
+from readfq import chunk_lines, read_chunks
+from compression import (BACKENDS, DEFAULT_COMPRESSION, compress_block,
+                         open_input, open_output)
+from read_stats import chunk_stats
 
+# Number of FASTQ records handed to a worker in one chunk
+CHUNK_RECORDS = 100000
 
-def writefq(fh, data):
-    fh.write('@' + data[0] + '\n')
-    fh.write(data[1] + '\n')
-    fh.write('+\n')
-    fh.write(data[2] + '\n')
 
+def read_chunks_lockstep(handles, num_records=CHUNK_RECORDS):
+    # Yield tuples of record-aligned raw chunks, one per file handle, until
+    # any of the files is exhausted
+    return itertools.izip(*[read_chunks(fh, num_records) for fh in handles])
 
-def add_umi(input_dir, output_dir):
+
+def tag_lines(read_lines, umi_lines):
+    # Rewrite the headers in each list of FASTQ lines in read_lines in place
+    # to name:UMI suffix, the UMI being the matching sequence in umi_lines
+    umi_names = [header.split()[0] for header in umi_lines[0::4]]
+    umis = umi_lines[1::4]
+    for lines in read_lines:
+        assert(len(lines) == len(umi_lines)), 'Mismatch in number of reads'
+        headers = []
+        for header, umi_name, umi_id in itertools.izip(lines[0::4],
+                                                       umi_names, umis):
+            name, suffix = header.split()
+            assert(name == umi_name), 'Mismatch in read names'
+            headers.append(name + ':' + umi_id + ' ' + suffix)
+        lines[0::4] = headers
+
+
+def join_lines(lines):
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def tag_chunk(task):
+    # Tagged and compressed chunks, with the chunk statistics if asked for
+    (chunk1, chunk2, umichunk), compression, with_stats = task
+    lines1 = chunk_lines(chunk1)
+    lines2 = chunk_lines(chunk2)
+    umi_lines = chunk_lines(umichunk)
+    tag_lines((lines1, lines2), umi_lines)
+    stats = chunk_stats((lines1, lines2), umi_lines) if with_stats else None
+    return (compress_block(join_lines(lines1), compression),
+            compress_block(join_lines(lines2), compression), stats)
+
+
+def tag_chunk_se(task):
+    (chunk1, umichunk), compression, with_stats = task
+    lines1 = chunk_lines(chunk1)
+    umi_lines = chunk_lines(umichunk)
+    tag_lines((lines1,), umi_lines)
+    stats = chunk_stats((lines1,), umi_lines) if with_stats else None
+    return compress_block(join_lines(lines1), compression), stats
+
+
+def ordered_map(func, tasks, processes=1, max_pending=None, pool=None):
+    # Like Pool.imap but only keeps max_pending chunks in flight, so memory
+    # stays bounded when the reader is faster than the workers. A shared
+    # pool can be passed in to spread several samples over the same workers.
+    if pool is None and processes <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    if max_pending is None:
+        max_pending = 2 * processes
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool(processes=processes)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        if own_pool:
+            pool.close()
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+class RecordCounter(object):
+    # Counts the records of lockstep chunks on their way to the workers,
+    # on the UMI chunk, the last and shortest one
+
+    def __init__(self):
+        self.records = 0
+
+    def count(self, chunks):
+        for chunk in chunks:
+            self.records += chunk[-1].count('\n') // 4
+            yield chunk
+
+
+def get_sample_name(fastq):
+    sample_file = fastq.split('/')[-1]
+    sample_file_split = sample_file.split('_')
+    if len(sample_file_split) == 4:
+        return sample_file_split[0]
+    else:
+        return '_'.join(sample_file_split[:-3])
+
+
+def split_compression(compression, parallel):
+    # With several workers each chunk is compressed in the worker and the
+    # output file is written as is. A single process hands plain text to
+    # the output stream, so pigz can still use its own threads.
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
+    if parallel:
+        return compression, dict(compression, backend='none')
+    return dict(compression, backend='none'), compression
+
+
+def add_umi(input_dir, output_dir, processes=1, chunk_size=CHUNK_RECORDS,
+            compression=None, pool=None, max_pending=None, stats=None):
+    # Returns the number of read pairs tagged. The statistics of the reads
+    # are added to stats, a read_stats.ReadStats, if given.
     R1 = glob.glob(input_dir + '/*R1*fastq*')[0]
     R2 = glob.glob(input_dir + '/*R3*fastq*')[0]
     umi = glob.glob(input_dir + '/*R2*fastq*')[0]
-    sample_file = R1.split('/')[-1]
-    sample_file_split =  sample_file.split('_')
-    if len(sample_file_split) == 4:
-        sample_name = sample_file_split[0]
-    else:
-        sample_name = '_'.join(sample_file_split[:-3])
-    r1 = open(output_dir + '/' + sample_name + '_R1_UMI_001.fastq.gz', 'w')
-    r2 = open(output_dir + '/' + sample_name + '_R2_UMI_001.fastq.gz', 'w')
-    # Use subprocess to pipe to gzip
-    r1_out = subprocess.Popen('gzip', stdin=subprocess.PIPE, stdout=r1)
-    r2_out = subprocess.Popen('gzip', stdin=subprocess.PIPE, stdout=r2)
-
-    with io.BufferedReader(gzip.open(R1, 'rb')) as read1, \
-            io.BufferedReader(gzip.open(R2, 'rb')) as read2, \
-            io.BufferedReader(gzip.open(umi, 'rb')) as uid:
-        for data1, data2, umidata in itertools.izip(readfq(read1),
-                                                    readfq(read2),
-                                                    readfq(uid)):
-            r1_name, r1_suffix = data1[0].split()
-            r2_name, r2_suffix = data2[0].split()
-            umi_name = umidata[0].split()[0]
-            umi_id = umidata[1]
-            assert(r1_name == r2_name == umi_name), 'Mismatch in read names'
-            r1_umi = r1_name + ':' + umi_id + ' ' + r1_suffix
-            r2_umi = r2_name + ':' + umi_id + ' ' + r2_suffix
-            writefq(r1_out.stdin, (r1_umi, data1[1], data1[2]))
-            writefq(r2_out.stdin, (r2_umi, data2[1], data2[2]))
-
-    r1_out.communicate()
-    r2_out.communicate()
+    sample_name = get_sample_name(R1)
+    chunk_compression, out_compression = split_compression(
+        compression, pool is not None or processes > 1)
+    r1 = open_output(output_dir + '/' + sample_name + '_R1_UMI_001.fastq.gz',
+                     out_compression)
+    r2 = open_output(output_dir + '/' + sample_name + '_R2_UMI_001.fastq.gz',
+                     out_compression)
+
+    counter = RecordCounter()
+    with open_input(R1, compression) as read1, \
+            open_input(R2, compression) as read2, \
+            open_input(umi, compression) as uid:
+        chunks = read_chunks_lockstep((read1, read2, uid), chunk_size)
+        tasks = ((chunk, chunk_compression, stats is not None)
+                 for chunk in counter.count(chunks))
+        for out1, out2, chunk in ordered_map(tag_chunk, tasks, processes,
+                                             max_pending, pool):
+            r1.write(out1)
+            r2.write(out2)
+            if stats is not None:
+                stats.add(chunk)
+
     r1.close()
     r2.close()
+    return counter.records
 
 
-def add_umi_se(input_dir, output_dir):
+def add_umi_se(input_dir, output_dir, processes=1, chunk_size=CHUNK_RECORDS,
+               compression=None, pool=None, max_pending=None, stats=None):
+    # Returns the number of reads tagged
     R1 = glob.glob(input_dir + '/*R1*fastq*')[0]
     umi = glob.glob(input_dir + '/*R2*fastq*')[0]
     sample_name = R1.split('/')[-1].split('_')[0]
-    r1 = open(output_dir + '/' + sample_name + '_R1_UMI_001.fastq.gz', 'w')
-    # Use subprocess to pipe to gzip
-    r1_out = subprocess.Popen('gzip', stdin=subprocess.PIPE, stdout=r1)
-
-    with io.BufferedReader(gzip.open(R1, 'rb')) as read1, \
-            io.BufferedReader(gzip.open(umi, 'rb')) as uid:
-        for data1, umidata in itertools.izip(readfq(read1),
-                                             readfq(uid)):
-            r1_name, r1_suffix = data1[0].split()
-            umi_name = umidata[0].split()[0]
-            umi_id = umidata[1]
-            assert(r1_name == umi_name), 'Mismatch in read names'
-            r1_umi = r1_name + ':' + umi_id + ' ' + r1_suffix
-            writefq(r1_out.stdin, (r1_umi, data1[1], data1[2]))
-
-    r1_out.communicate()
+    chunk_compression, out_compression = split_compression(
+        compression, pool is not None or processes > 1)
+    r1 = open_output(output_dir + '/' + sample_name + '_R1_UMI_001.fastq.gz',
+                     out_compression)
+
+    counter = RecordCounter()
+    with open_input(R1, compression) as read1, \
+            open_input(umi, compression) as uid:
+        chunks = read_chunks_lockstep((read1, uid), chunk_size)
+        tasks = ((chunk, chunk_compression, stats is not None)
+                 for chunk in counter.count(chunks))
+        for out1, chunk in ordered_map(tag_chunk_se, tasks, processes,
+                                       max_pending, pool):
+            r1.write(out1)
+            if stats is not None:
+                stats.add(chunk)
+
     r1.close()
+    return counter.records
 
 if __name__ == '__main__':
 
@@ -83,9 +191,25 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output_dir', help='Output directory')
     parser.add_argument('-s', '--single_end', action='store_true',
                         default=False)
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of worker processes')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_RECORDS,
+                        help='Number of reads per worker chunk')
+    parser.add_argument('-z', '--compression', choices=BACKENDS,
+                        default=DEFAULT_COMPRESSION['backend'])
+    parser.add_argument('-l', '--level', type=int,
+                        default=DEFAULT_COMPRESSION['level'],
+                        help='Compression level')
+    parser.add_argument('-t', '--threads', type=int,
+                        default=DEFAULT_COMPRESSION['threads'],
+                        help='Compression threads for pigz')
 
     opts = parser.parse_args()
+    compression = {'backend': opts.compression, 'level': opts.level,
+                   'threads': opts.threads}
     if opts.single_end:
-        add_umi_se(opts.input_dir, opts.output_dir)
+        add_umi_se(opts.input_dir, opts.output_dir, opts.processes,
+                   opts.chunk_size, compression)
     else:
-        add_umi(opts.input_dir, opts.output_dir)
+        add_umi(opts.input_dir, opts.output_dir, opts.processes,
+                opts.chunk_size, compression)
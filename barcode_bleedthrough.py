@@ -2,8 +2,10 @@
 import sys
 import argparse
 from collections import defaultdict
-from rank_barcodes import count_barcodes
-import distance
+from rank_barcodes import (add_counting_args, count_barcodes_parallel,
+                           counted_reads, top_barcodes)
+from compression import DEFAULT_COMPRESSION
+from barcode_index import BarcodeIndex
 
 i5_barcodes = {'A501':['TGAACCTT','AAGGTTCA'],
                'A502':['TGCTAAGT','ACTTAGCA'],
@@ -48,30 +50,25 @@ i7_barcodes = {'A701':'ATCACGAC',
                'D712':'AGCGATAG'}
 
 i5_list = i5_barcodes.values()
-i5 = [i for s in i5_list for i in s]
-i7 = i7_barcodes.values()
-
-def get_distance(barcode, barcode_list):
-    dist = []
-    for b in barcode_list:
-        d = distance.hamming(barcode, b)
-        # Ignore the distance from itself
-        if d != 0:
-            dist.append(d)
-    return dist
+i5 = BarcodeIndex(i for s in i5_list for i in s)
+i7 = BarcodeIndex(i7_barcodes.values())
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-s", "--summary",
                     help="index summary from Run")
 parser.add_argument("-f", "--fastq", nargs='+',
                     help="Undetermined fastq files")
+add_counting_args(parser)
 
 opts = parser.parse_args()
+compression = dict(DEFAULT_COMPRESSION, backend=opts.compression,
+                   threads=opts.threads)
 
 sys.stderr.write("Parsing undetermined barcodes\n")
-undetermined_barcodes = defaultdict(int)
-for f in opts.fastq:
-    undetermined_barcodes = count_barcodes(f, undetermined_barcodes)
+undetermined_barcodes = count_barcodes_parallel(opts.fastq, opts.processes,
+                                                compression, opts.max_reads,
+                                                opts.fraction,
+                                                opts.sketch_size)
 
 sys.stderr.write("Parsing index summary file\n")
 mapped_barcodes = defaultdict(int)
@@ -86,8 +83,13 @@ with open(opts.summary, "r") as inf:
 
 all_barcodes = {}
 all_barcodes.update(mapped_barcodes)
-all_barcodes.update(undetermined_barcodes)
-total_reads = sum(all_barcodes.values())
+undetermined_top = top_barcodes(undetermined_barcodes)
+all_barcodes.update((k, count) for k, count, error in undetermined_top)
+# With a sketch only the frequent undetermined barcodes are kept, the rest
+# still count towards the total
+total_reads = sum(all_barcodes.values()) + \
+    counted_reads(undetermined_barcodes) - \
+    sum(count for k, count, error in undetermined_top)
 
 barcode_perc = {}
 for k,v in all_barcodes.iteritems():
@@ -97,19 +99,17 @@ filtered_barcodes = {k: v for k,v in barcode_perc.items() if v >= 0.05}
 
 sys.stderr.write("Number of filtered barcodes %d\n" % len(filtered_barcodes.keys()))
 
-barcode_dist = {}
-# Get hamming distance to barcodes in samplesheet
-for b in filtered_barcodes.keys():
-    barcode_dist[b] = get_distance(b, mapped_barcodes.keys())
+# Get hamming distance to the nearest other barcode in samplesheet
+samplesheet = BarcodeIndex(mapped_barcodes.keys())
+barcode_dist = samplesheet.search(filtered_barcodes.keys())
 
-print "Barcode\t%Reads\tMinDist\tSampleSheet\tIlluminaI7\tIlluminaI5"
+print "Barcode\t%Reads\tMinDist\tNearest\tSampleSheet\tIlluminaI7\tIlluminaI5"
 
 for k in filtered_barcodes.keys():
-    is_i5, is_i7 = False, False
     k_i7, k_i5 = k.split("+")
-    if k_i7 in i7:
-        is_i7 = True
-    if k_i5 in i5:
-        is_i5 = True
-    print "%s\t%.2f\t%d\t%s\t%s\t%s" % (k, barcode_perc[k], min(barcode_dist[k]),
-                                mapped_barcodes.has_key(k), is_i7, is_i5)
+    min_dist, nearest = barcode_dist[k]
+    if min_dist is None:
+        min_dist, nearest = 'NA', 'NA'
+    print "%s\t%.2f\t%s\t%s\t%s\t%s\t%s" % (k, barcode_perc[k], min_dist,
+                                        nearest, k in samplesheet,
+                                        k_i7 in i7, k_i5 in i5)
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Barcodes are encoded one-hot, 4 bits per base, with N and other characters
+# all zero. The number of matching bases of two barcodes of the same length
+# is then the popcount of their AND, so a Hamming distance takes one int
+# operation instead of a loop over the bases. The '+' between i7 and i5 is
+# dropped, barcodes of different lengths are never compared.
+ONE_HOT = {'A': '0001', 'C': '0010', 'G': '0100', 'T': '1000'}
+# Nearest barcodes are first searched among those sharing a chunk with the
+# query: barcodes within r mismatches agree exactly on one of r + 1 chunks
+# (see samplesheet.candidate_pairs). The radius grows up to MAX_RADIUS with
+# chunks of at least MIN_CHUNK bases, only queries farther from every
+# barcode are compared to all barcodes of their length.
+MAX_RADIUS = 3
+MIN_CHUNK = 3
+
+
+def encode_barcode(barcode):
+    bases = barcode.replace('+', '')
+    return int('0' + ''.join([ONE_HOT.get(base, '0000') for base in bases]),
+               2), len(bases)
+
+
+def chunk_buckets(bases_list, radius):
+    # [(start, end, {chunk: [positions in bases_list]})] for r + 1 chunks
+    length = len(bases_list[0])
+    bounds = [length * k // (radius + 1) for k in range(radius + 2)]
+    chunks = []
+    for start, end in zip(bounds, bounds[1:]):
+        buckets = {}
+        for i, bases in enumerate(bases_list):
+            buckets.setdefault(bases[start:end], []).append(i)
+        chunks.append((start, end, buckets))
+    return chunks
+
+
+class BarcodeIndex(object):
+    # Index of known barcodes for nearest neighbour and membership queries
+
+    def __init__(self, barcodes):
+        self.barcodes = frozenset(barcodes)
+        self.by_length = {}
+        for barcode in sorted(self.barcodes):
+            code, length = encode_barcode(barcode)
+            codes, names = self.by_length.setdefault(length, ([], []))
+            codes.append(code)
+            names.append(barcode)
+        # {length: [(radius, chunks)]} with growing radius
+        self.chunks = {}
+        for length, (codes, names) in self.by_length.iteritems():
+            bases_list = [name.replace('+', '') for name in names]
+            self.chunks[length] = [
+                (radius, chunk_buckets(bases_list, radius))
+                for radius in range(1, MAX_RADIUS + 1)
+                if length // (radius + 1) >= MIN_CHUNK]
+
+    def __contains__(self, barcode):
+        return barcode in self.barcodes
+
+    def _closest(self, code, length, positions):
+        # (distance, barcode) of the most matching bases among positions,
+        # the first in sorted order on ties, exact matches ignored
+        codes, names = self.by_length[length]
+        best = -1
+        best_position = None
+        for i in sorted(positions):
+            num_matches = bin(code & codes[i]).count('1')
+            if best < num_matches < length:
+                best = num_matches
+                best_position = i
+        if best_position is None:
+            return None, None
+        return length - best, names[best_position]
+
+    def nearest(self, barcode):
+        # (distance, barcode) of the closest indexed barcode, ignoring exact
+        # matches, (None, None) if there is no other barcode of that length
+        code, length = encode_barcode(barcode)
+        if length not in self.by_length:
+            return None, None
+        bases = barcode.replace('+', '')
+        for radius, chunks in self.chunks[length]:
+            positions = set()
+            for start, end, buckets in chunks:
+                positions.update(buckets.get(bases[start:end], ()))
+            distance, name = self._closest(code, length, positions)
+            if distance is not None and distance <= radius:
+                return distance, name
+        return self._closest(code, length,
+                             xrange(len(self.by_length[length][0])))
+
+    def search(self, barcodes):
+        # Batch version of nearest, a dict of barcode -> (distance, nearest)
+        return dict((barcode, self.nearest(barcode))
+                    for barcode in set(barcodes))
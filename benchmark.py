@@ -0,0 +1,315 @@
+#!/usr/bin/python
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from AddUmiNEB import add_umi_neb
+from AddUmiNugen import add_umi, add_umi_se
+from barcode_index import BarcodeIndex
+from compression import BACKENDS, DEFAULT_COMPRESSION, open_input
+from interop import read_index_metrics, run_summary
+from rank_barcodes import count_file_barcodes, counted_reads, top_barcodes
+from read_stats import ReadStats
+from readfq import read_chunks, readfq, readfq_fast
+from samplesheet import SampleSheet
+from synthetic_run import make_run
+
+# Benchmarks of the processing hot paths on synthetic data. Every benchmark
+# runs in its own process so peak memory is its own, and reports records/s,
+# MB/s of input and peak RSS. Results can be saved as a baseline and later
+# runs compared to it, a benchmark slower than the baseline by more than
+# the tolerance is reported as a regression and fails the run.
+
+DATA_MARKER = 'synthetic.json'
+
+
+def fastq_bytes(path, compression):
+    # Uncompressed size, MB/s are given on the FASTQ text
+    size = 0
+    inf = open_input(path, compression)
+    try:
+        for block in iter(lambda: inf.read(1 << 22), ''):
+            size += len(block)
+    finally:
+        inf.close()
+    return size
+
+
+def sample_bytes(paths, compression):
+    return sum(fastq_bytes(path, compression) for path in paths)
+
+
+def bench_readfq(data, work_dir, compression):
+    path = data['umi_pe'] + '/Sample1_S1_L001_R1_001.fastq.gz'
+    inf = open_input(path, compression)
+    try:
+        records = sum(1 for _ in readfq(inf))
+    finally:
+        inf.close()
+    return records, fastq_bytes(path, compression)
+
+
+def bench_readfq_fast(data, work_dir, compression):
+    path = data['umi_pe'] + '/Sample1_S1_L001_R1_001.fastq.gz'
+    inf = open_input(path, compression)
+    try:
+        records = sum(1 for _ in readfq_fast(inf))
+    finally:
+        inf.close()
+    return records, fastq_bytes(path, compression)
+
+
+def bench_read_chunks(data, work_dir, compression):
+    path = data['umi_pe'] + '/Sample1_S1_L001_R1_001.fastq.gz'
+    inf = open_input(path, compression)
+    try:
+        records = sum(chunk.count('\n') // 4 for chunk in read_chunks(inf))
+    finally:
+        inf.close()
+    return records, fastq_bytes(path, compression)
+
+
+def _umi_input(data, name):
+    return [os.path.join(data[name], f) for f in sorted(os.listdir(
+        data[name])) if f.endswith('_001.fastq.gz') and '_UMI_' not in f]
+
+
+def bench_add_umi(data, work_dir, compression, processes=1):
+    records = add_umi(data['umi_pe'], work_dir, processes=processes,
+                      compression=compression)
+    return records, sample_bytes(_umi_input(data, 'umi_pe'), compression)
+
+
+def bench_add_umi_stats(data, work_dir, compression):
+    # add_umi with the per sample statistics of processUMI
+    records = add_umi(data['umi_pe'], work_dir, compression=compression,
+                      stats=ReadStats())
+    return records, sample_bytes(_umi_input(data, 'umi_pe'), compression)
+
+
+def bench_add_umi_parallel(data, work_dir, compression):
+    return bench_add_umi(data, work_dir, compression,
+                         processes=multiprocessing.cpu_count())
+
+
+def bench_add_umi_se(data, work_dir, compression):
+    records = add_umi_se(data['umi_se'], work_dir, compression=compression)
+    return records, sample_bytes(_umi_input(data, 'umi_se'), compression)
+
+
+def bench_add_umi_neb(data, work_dir, compression):
+    add_umi_neb(data['neb'], work_dir, compression)
+    paths = [os.path.join(data['neb'], f) for f in os.listdir(data['neb'])]
+    return data['reads'], sample_bytes(paths, compression)
+
+
+def bench_count_barcodes(data, work_dir, compression, capacity=None):
+    barcodes = count_file_barcodes(data['undetermined'], compression,
+                                   capacity=capacity)
+    return counted_reads(barcodes), fastq_bytes(data['undetermined'],
+                                                compression)
+
+
+def bench_count_barcodes_sketch(data, work_dir, compression):
+    return bench_count_barcodes(data, work_dir, compression, capacity=10000)
+
+
+def bench_bleedthrough(data, work_dir, compression):
+    # Nearest sample sheet barcode of the most frequent Undetermined ones,
+    # the search barcode_bleedthrough.py does
+    sheet = SampleSheet.parse(open(data['samplesheet']).read().splitlines())
+    known = set(i7 + '+' + i5 for samples in sheet.lane_indexes().values()
+                for name, (i7, i5) in samples)
+    barcodes = count_file_barcodes(data['undetermined'], compression)
+    top = [barcode for barcode, count, error in top_barcodes(barcodes, 5000)]
+    BarcodeIndex(known).search(top)
+    return len(top), 0
+
+
+def bench_samplesheet(data, work_dir, compression):
+    with open(data['samplesheet']) as f:
+        content = f.read()
+    sheet = SampleSheet.parse(content.splitlines())
+    sheet.mismatch_plan()
+    return len(sheet.samples), len(content)
+
+
+def bench_interop_summary(data, work_dir, compression):
+    interop_dir = os.path.join(data['run'], 'InterOp')
+    size = sum(os.path.getsize(os.path.join(interop_dir, f))
+               for f in os.listdir(interop_dir))
+    run_summary(data['run'])
+    return len(read_index_metrics(data['run'])), size
+
+
+BENCHMARKS = (('readfq', bench_readfq),
+              ('readfq_fast', bench_readfq_fast),
+              ('read_chunks', bench_read_chunks),
+              ('add_umi', bench_add_umi),
+              ('add_umi_stats', bench_add_umi_stats),
+              ('add_umi_parallel', bench_add_umi_parallel),
+              ('add_umi_se', bench_add_umi_se),
+              ('add_umi_neb', bench_add_umi_neb),
+              ('count_barcodes', bench_count_barcodes),
+              ('count_barcodes_sketch', bench_count_barcodes_sketch),
+              ('bleedthrough_search', bench_bleedthrough),
+              ('samplesheet_plan', bench_samplesheet),
+              ('interop_summary', bench_interop_summary))
+
+
+def _run_child(func, data, compression, queue):
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        start = time.time()
+        records, num_bytes = func(data, work_dir, compression)
+        seconds = time.time() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        queue.put({'seconds': seconds, 'records': records,
+                   'bytes': num_bytes,
+                   'peak_rss_mb': max(usage.ru_maxrss,
+                                      children.ru_maxrss) / 1024.0})
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_benchmark(func, data, compression, repeat=1):
+    # Best of repeat runs, each in a fresh process
+    best = None
+    for _ in range(repeat):
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_run_child,
+                                       args=(func, data, compression, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        if 'error' in result:
+            return result
+        seconds = max(result['seconds'], 1e-9)
+        result['records_per_second'] = result['records'] / seconds
+        result['mb_per_second'] = result['bytes'] / 1e6 / seconds
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def prepare_data(data_dir, reads, samples, seed):
+    # Reuse data_dir if it holds data of the same parameters
+    params = {'reads': reads, 'samples': samples, 'seed': seed}
+    marker = os.path.join(data_dir, DATA_MARKER)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            data = json.load(f)
+        if data.get('params') == params:
+            return dict((str(k), str(v)) for k, v in data['paths'].items())
+    sys.stderr.write('Generating %d reads and %d samples in %s\n' % (
+        reads, samples, data_dir))
+    paths = make_run(data_dir, reads, samples, seed=seed)
+    with open(marker, 'w') as f:
+        json.dump({'params': params, 'paths': paths}, f)
+    return paths
+
+
+def compare(results, baseline, tolerance):
+    # Names of benchmarks more than tolerance slower than the baseline
+    regressions = []
+    for name, result in results.iteritems():
+        base = baseline.get(name)
+        if not base or 'error' in result or not base.get('seconds'):
+            continue
+        result['vs_baseline'] = base['seconds'] / max(result['seconds'],
+                                                      1e-9)
+        if result['vs_baseline'] < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results, names):
+    print '%-22s %9s %12s %9s %9s %9s' % ('Benchmark', 'Seconds',
+                                          'Records/s', 'MB/s', 'Peak MB',
+                                          'Speedup')
+    for name in names:
+        result = results[name]
+        if 'error' in result:
+            print '%-22s failed: %s' % (name,
+                                        result['error'].splitlines()[-1])
+            continue
+        speedup = '%.2fx' % result['vs_baseline'] if 'vs_baseline' in \
+            result else '-'
+        print '%-22s %9.2f %12.0f %9.1f %9.1f %9s' % (
+            name, result['seconds'], result['records_per_second'],
+            result['mb_per_second'], result['peak_rss_mb'], speedup)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the processing hot paths on synthetic data')
+    parser.add_argument('-d', '--data_dir',
+                        help='Synthetic data directory, reused when it '
+                        'matches (default: temporary)')
+    parser.add_argument('-r', '--reads', type=int, default=200000,
+                        help='Reads per FASTQ')
+    parser.add_argument('-s', '--samples', type=int, default=384,
+                        help='Samples in the sample sheet and InterOp')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-b', '--benchmarks', nargs='+',
+                        choices=[name for name, func in BENCHMARKS],
+                        help='Benchmarks to run (default all)')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='Runs per benchmark, the fastest counts')
+    parser.add_argument('-z', '--compression', choices=BACKENDS,
+                        default=DEFAULT_COMPRESSION['backend'])
+    parser.add_argument('--baseline', help='Baseline JSON to compare to')
+    parser.add_argument('--save-baseline',
+                        help='Write the results as baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline')
+
+    opts = parser.parse_args()
+    data_dir = opts.data_dir or tempfile.mkdtemp(prefix='synthetic_run_')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    compression = dict(DEFAULT_COMPRESSION, backend=opts.compression)
+    try:
+        data = prepare_data(data_dir, opts.reads, opts.samples, opts.seed)
+        data['reads'] = opts.reads
+        names = opts.benchmarks or [name for name, func in BENCHMARKS]
+        functions = dict(BENCHMARKS)
+        results = {}
+        for name in names:
+            sys.stderr.write('Running %s\n' % name)
+            results[name] = run_benchmark(functions[name], data, compression,
+                                          opts.repeat)
+        regressions = []
+        if opts.baseline:
+            with open(opts.baseline) as f:
+                baseline = json.load(f)
+            if (baseline['reads'], baseline['samples']) != (opts.reads,
+                                                            opts.samples):
+                sys.stderr.write('Baseline was run with %d reads and %d '
+                                 'samples\n' % (baseline['reads'],
+                                                 baseline['samples']))
+            regressions = compare(results, baseline['results'],
+                                  opts.tolerance)
+        print_results(results, names)
+        if opts.save_baseline:
+            with open(opts.save_baseline, 'w') as f:
+                json.dump({'reads': opts.reads, 'samples': opts.samples,
+                           'seed': opts.seed, 'results': results}, f,
+                          indent=4, sort_keys=True)
+    finally:
+        if not opts.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    if regressions:
+        print 'Regressions against %s: %s' % (opts.baseline,
+                                              ', '.join(regressions))
+        sys.exit(1)
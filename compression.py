@@ -0,0 +1,147 @@
+#!/usr/bin/python
+import gzip
+import io
+import subprocess
+import zlib
+
+# Backends that can be selected with the compression option in config.cfg.
+# pigz and gzip run as child processes, zlib compresses in process and none
+# writes plain text for scratch output.
+BACKENDS = ('gzip', 'pigz', 'zlib', 'none')
+
+DEFAULT_COMPRESSION = {'backend': 'gzip', 'level': 6, 'threads': 1}
+
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def get_compression(settings):
+    compression = dict(DEFAULT_COMPRESSION)
+    if settings.get('compression'):
+        compression['backend'] = settings['compression'].lower()
+    if settings.get('compression_level'):
+        compression['level'] = int(settings['compression_level'])
+    if settings.get('compression_threads'):
+        compression['threads'] = int(settings['compression_threads'])
+    if compression['backend'] not in BACKENDS:
+        raise ValueError('Unknown compression backend %s, use one of %s' %
+                         (compression['backend'], ', '.join(BACKENDS)))
+    return compression
+
+
+class PipeWriter(object):
+    # File-like object writing through a compression child process
+
+    def __init__(self, cmd, path):
+        self.cmd = cmd
+        self.out = open(path, 'wb')
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=self.out)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        ret = self.proc.wait()
+        self.out.close()
+        if ret != 0:
+            raise IOError('%s exited with %d' % (' '.join(self.cmd), ret))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PipeReader(object):
+    # File-like object reading from a decompression child process. A
+    # failure of the child, e.g. on a truncated file, is raised on close
+    # once all output was read instead of passing for the end of the file.
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=-1)
+        self.eof = False
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and size != 0:
+            self.eof = True
+        return data
+
+    def readline(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            self.eof = True
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.proc.stdout.close()
+        ret = self.proc.wait()
+        # Stopping early kills the child with SIGPIPE, that is no error
+        if self.eof and ret != 0:
+            raise IOError('%s exited with %d' % (' '.join(self.cmd), ret))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_gzipped(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_input(path, compression=None):
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
+    backend = compression['backend']
+    if not is_gzipped(path):
+        # Scratch output written with the none backend
+        return io.open(path, 'rb')
+    if backend == 'pigz':
+        return PipeReader(['pigz', '-dc', '-p', str(compression['threads']),
+                           path])
+    return io.BufferedReader(gzip.open(path, 'rb'))
+
+
+def open_output(path, compression=None):
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
+    backend = compression['backend']
+    level = compression['level']
+    if backend == 'none':
+        return io.open(path, 'wb')
+    elif backend == 'pigz':
+        return PipeWriter(['pigz', '-c', '-%d' % level, '-p',
+                           str(compression['threads'])], path)
+    elif backend == 'gzip':
+        return PipeWriter(['gzip', '-c', '-%d' % level], path)
+    return gzip.open(path, 'wb', level)
+
+
+def compress_block(data, compression=None):
+    # Compress data into a complete gzip member. Concatenated members form
+    # a valid multi-member gzip file, which lets workers compress chunks
+    # independently. pigz and gzip fall back to in-process zlib here since
+    # the parallelism already comes from the workers.
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
+    backend = compression['backend']
+    if backend == 'none':
+        return data
+    compressor = zlib.compressobj(compression['level'], zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
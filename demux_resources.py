@@ -0,0 +1,121 @@
+#!/usr/bin/python
+import os
+import xml.etree.ElementTree as ET
+from multiprocessing import cpu_count
+
+# bcl2fastq thread counts are derived from the host and the run unless set
+# with the bcl2fastq_*_threads options in config.cfg. Loading and writing
+# threads mostly wait on storage, so they are capped by what the storage
+# of the run and output folders keeps up with. Processing threads get the
+# remaining cores, limited by the available memory.
+THREAD_OPTIONS = (('loading_threads', '-r'), ('demux_threads', '-d'),
+                  ('processing_threads', '-p'), ('writing_threads', '-w'))
+IO_THREADS = {'ssd': 8, 'network': 4, 'hdd': 2, 'unknown': 4}
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'lustre', 'gpfs', 'beegfs',
+              'glusterfs', 'fuse.sshfs')
+DEFAULT_THREAD_MEMORY_MB = 512
+
+
+def available_memory_mb():
+    # MemAvailable of /proc/meminfo, None where it can't be read
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    return None
+
+
+def _existing(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def storage_type(path):
+    # 'network', 'ssd', 'hdd' or 'unknown' for the file system of path
+    path = os.path.realpath(_existing(path))
+    fstype = None
+    mount_point = ''
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') +
+                                                     '/')) and \
+                        len(mount) >= len(mount_point):
+                    mount_point, fstype = mount, fields[2]
+    except IOError:
+        pass
+    if fstype in NETWORK_FS:
+        return 'network'
+    dev = os.stat(path).st_dev
+    sys_dir = os.path.realpath('/sys/dev/block/%d:%d' % (os.major(dev),
+                                                         os.minor(dev)))
+    # Partitions have the queue settings on the parent device
+    for queue_dir in (sys_dir, os.path.dirname(sys_dir)):
+        try:
+            with open(os.path.join(queue_dir, 'queue', 'rotational')) as f:
+                return 'hdd' if f.read().strip() == '1' else 'ssd'
+        except IOError:
+            continue
+    return 'unknown'
+
+
+def lane_count(run_dir):
+    try:
+        tree = ET.parse(os.path.join(run_dir, 'RunInfo.xml'))
+    except (IOError, ET.ParseError):
+        return 1
+    layout = tree.find('.//FlowcellLayout')
+    if layout is None or not layout.get('LaneCount'):
+        return 1
+    return int(layout.get('LaneCount'))
+
+
+def distinct_samples(samples):
+    # Samples bcl2fastq writes FASTQs for, sheets with a Lane column list a
+    # sample once per lane
+    return len(set(sample.get('Sample_ID') for sample in samples))
+
+
+def plan_threads(run_path, output_path, settings, num_samples=None):
+    # bcl2fastq thread counts with the facts they are based on, recorded
+    # in run_details.json
+    cpus = cpu_count()
+    memory_mb = available_memory_mb()
+    lanes = lane_count(run_path)
+    run_storage = storage_type(run_path)
+    output_storage = storage_type(output_path)
+    loading = max(1, min(IO_THREADS[run_storage], 2 * lanes, cpus))
+    writing = max(1, min(IO_THREADS[output_storage], cpus))
+    if num_samples:
+        # bcl2fastq refuses more writing threads than samples
+        writing = min(writing, num_samples)
+    processing = max(1, cpus - (loading + writing) // 2)
+    if memory_mb is not None:
+        thread_memory = int(settings.get('bcl2fastq_thread_memory_mb') or
+                            DEFAULT_THREAD_MEMORY_MB)
+        processing = max(1, min(processing, memory_mb // thread_memory))
+    plan = {'cpus': cpus, 'memory_mb': memory_mb, 'lanes': lanes,
+            'run_storage': run_storage, 'output_storage': output_storage,
+            'loading_threads': loading, 'processing_threads': processing,
+            'writing_threads': writing,
+            # Only used by bcl2fastq before 2.20, its default was 20% of
+            # the processing threads
+            'demux_threads': max(1, processing // 5)}
+    for name, option in THREAD_OPTIONS:
+        if settings.get('bcl2fastq_' + name):
+            plan[name] = int(settings['bcl2fastq_' + name])
+    return plan
+
+
+def thread_options(plan):
+    return ' '.join('%s %d' % (option, plan[name])
+                    for name, option in THREAD_OPTIONS)
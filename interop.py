@@ -0,0 +1,457 @@
+#!/usr/bin/python
+import math
+import mmap
+import os
+import struct
+import sys
+import xml.etree.ElementTree as ET
+
+# Reader for the Illumina InterOp binaries of a run folder. The files are
+# memory mapped and decoded record by record with struct, only the sums
+# needed for the SAV style lane and read summaries are kept. A truncated
+# last record, as found while the run is still sequencing, is ignored, so
+# the summaries can be computed on in-progress runs.
+
+# Version of the summary written to SAV_summary.tsv
+SUMMARY_VERSION = 'native'
+
+# Tile metric codes of TileMetricsOut.bin version 2
+CLUSTER_DENSITY = 100
+CLUSTER_DENSITY_PF = 101
+CLUSTER_COUNT = 102
+CLUSTER_COUNT_PF = 103
+PERCENT_ALIGNED_BASE = 300
+
+READ_FIELDS = ['Level', 'Yield', 'Projected Yield', 'Aligned%',
+               'Error Rate%', '%>=Q30']
+LANE_FIELDS = ['Lane', 'Read', 'Tiles', 'Density(k/mm2)', 'Density PF',
+               'Cluster PF%', 'Reads', 'Reads PF', '%>=Q30', 'Yield',
+               'Aligned%', 'Error%']
+INDEX_FIELDS = ['Lane', 'Tile', 'Read', 'Index', 'Sample', 'Project',
+                'Count']
+
+NAN = float('nan')
+
+
+def read_run_info(run_dir):
+    # Reads of the run in sequencing order with their cycle ranges
+    tree = ET.parse(os.path.join(run_dir, 'RunInfo.xml'))
+    reads = []
+    first_cycle = 1
+    for read in sorted(tree.iter('Read'), key=lambda r: int(r.get('Number'))):
+        cycles = int(read.get('NumCycles'))
+        reads.append({'number': int(read.get('Number')), 'cycles': cycles,
+                      'is_index': read.get('IsIndexedRead') == 'Y',
+                      'first_cycle': first_cycle,
+                      'last_cycle': first_cycle + cycles - 1})
+        first_cycle += cycles
+    return reads
+
+
+def read_instrument(run_dir):
+    # Instrument id of RunInfo.xml, '' if it has none
+    instrument = ET.parse(os.path.join(run_dir, 'RunInfo.xml')).find(
+        'Run/Instrument')
+    if instrument is None or not instrument.text:
+        return ''
+    return instrument.text.strip()
+
+
+def cycle_to_read(reads):
+    # List indexed by cycle with the position of its read in reads
+    lookup = [None]
+    for i, read in enumerate(reads):
+        lookup.extend([i] * read['cycles'])
+    return lookup
+
+
+def map_interop(run_dir, name):
+    # Memory map InterOp/name, None if it is missing or empty
+    path = os.path.join(run_dir, 'InterOp', name)
+    if not os.path.isfile(path) or not os.path.getsize(path):
+        return None
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_records(data, offset, record):
+    # Unpack fixed size records from offset, dropping a truncated last one
+    end = len(data) - record.size + 1
+    unpack_from = record.unpack_from
+    for start in xrange(offset, end, record.size):
+        yield unpack_from(data, start)
+
+
+def unsupported(name, version):
+    sys.stderr.write('Skipping %s, version %d is not supported\n' % (
+        name, version))
+
+
+# Longest file header before the first record, Q metrics with 255 bins
+HEADER_BYTES = 4 + 3 * 255
+
+
+def tile_layout(header):
+    # (offset of the first record, record struct, version, tile area) of a
+    # TileMetricsOut.bin header. The run summary needs the cluster counts,
+    # so unlike the other metrics an unsupported version is an error.
+    version = ord(header[0])
+    if version == 2:
+        return 2, struct.Struct('<HHHf'), version, None
+    elif version == 3:
+        # Cluster counts and the tile area replace the densities
+        area = struct.unpack_from('<f', header, 2)[0]
+        return 6, struct.Struct('<HIc4s4s'), version, area
+    raise ValueError('TileMetricsOut.bin version %d is not supported' %
+                     version)
+
+
+def update_tile_metrics(tiles, layout, records):
+    # Add decoded tile records to the per (lane, tile) dict of tiles
+    offset, record, version, area = layout
+    for values in records:
+        lane, tile, code = values[:3]
+        metrics = tiles.setdefault((lane, tile), {'aligned': {}})
+        if version == 2:
+            value = values[3]
+            if code == CLUSTER_DENSITY:
+                metrics['density'] = value
+            elif code == CLUSTER_DENSITY_PF:
+                metrics['density_pf'] = value
+            elif code == CLUSTER_COUNT:
+                metrics['count'] = value
+            elif code == CLUSTER_COUNT_PF:
+                metrics['count_pf'] = value
+            elif PERCENT_ALIGNED_BASE <= code < PERCENT_ALIGNED_BASE + 100:
+                metrics['aligned'][code - PERCENT_ALIGNED_BASE + 1] = value
+        elif code == 't':
+            count, count_pf = struct.unpack('<ff', values[3] + values[4])
+            metrics['count'] = count
+            metrics['count_pf'] = count_pf
+            if area > 0:
+                metrics['density'] = count / area
+                metrics['density_pf'] = count_pf / area
+        elif code == 'r':
+            read, aligned = struct.unpack('<If', values[3] + values[4])
+            metrics['aligned'][read] = aligned
+
+
+def q_layout(header):
+    # (offset of the first record, record struct, index of the first
+    # histogram entry >= Q30) of a QMetricsOut.bin header, None for
+    # unsupported versions. Records are (lane, tile, cycle, histogram...).
+    version = ord(header[0])
+    record_size = ord(header[1])
+    if version not in (4, 5, 6, 7):
+        unsupported('QMetricsOut.bin', version)
+        return None
+    offset = 2
+    qscores = None
+    if version > 4:
+        has_bins = ord(header[2])
+        offset = 3
+        if has_bins:
+            num_bins = ord(header[3])
+            offset = 4 + 3 * num_bins
+            qscores = [ord(q) for q in header[4 + 2 * num_bins:offset]]
+    tile_format = 'I' if version == 7 else 'H'
+    num_entries = (record_size - 4 - struct.calcsize(tile_format)) // 4
+    if qscores is None or len(qscores) != num_entries:
+        # Unbinned histogram, entry i counts Q i + 1
+        qscores = range(1, num_entries + 1)
+    q30 = [i for i, q in enumerate(qscores) if q >= 30]
+    first_q30 = q30[0] if q30 else num_entries
+    record = struct.Struct('<H%sH%dI' % (tile_format, num_entries))
+    return offset, record, first_q30
+
+
+def error_layout(header):
+    # (offset of the first record, record struct) of an ErrorMetricsOut.bin
+    # header, None for unsupported versions. Records are (lane, tile,
+    # cycle, error rate).
+    version = ord(header[0])
+    record_size = ord(header[1])
+    if version == 3:
+        return 2, struct.Struct('<HHHf%dx' % (record_size - 10))
+    elif version == 4:
+        return 2, struct.Struct('<HIHf%dx' % (record_size - 12))
+    unsupported('ErrorMetricsOut.bin', version)
+    return None
+
+
+def read_tile_metrics(run_dir):
+    # Per (lane, tile) cluster density, counts and percent aligned per read
+    # number
+    data = map_interop(run_dir, 'TileMetricsOut.bin')
+    tiles = {}
+    if data is None:
+        return tiles
+    try:
+        layout = tile_layout(data)
+        update_tile_metrics(tiles, layout,
+                            iter_records(data, layout[0], layout[1]))
+    finally:
+        data.close()
+    return tiles
+
+
+def read_q_metrics(run_dir, cycle_reads):
+    # Per (lane, read position) [bases, bases >= Q30, last cycle seen]
+    data = map_interop(run_dir, 'QMetricsOut.bin')
+    totals = {}
+    if data is None:
+        return totals
+    try:
+        layout = q_layout(data)
+        if layout is None:
+            return totals
+        offset, record, first_q30 = layout
+        num_cycles = len(cycle_reads)
+        for values in iter_records(data, offset, record):
+            cycle = values[2]
+            if cycle >= num_cycles:
+                continue
+            hist = values[3:]
+            key = (values[0], cycle_reads[cycle])
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = [0, 0, 0]
+            total[0] += sum(hist)
+            total[1] += sum(hist[first_q30:])
+            if cycle > total[2]:
+                total[2] = cycle
+    finally:
+        data.close()
+    return totals
+
+
+def read_error_metrics(run_dir, cycle_reads, reads):
+    # Per (lane, read position, tile) [sum of error rates, cycles]. The
+    # last cycle of every read is left out like in SAV.
+    data = map_interop(run_dir, 'ErrorMetricsOut.bin')
+    errors = {}
+    if data is None:
+        return errors
+    try:
+        layout = error_layout(data)
+        if layout is None:
+            return errors
+        num_cycles = len(cycle_reads)
+        for lane, tile, cycle, error in iter_records(data, *layout):
+            if cycle >= num_cycles:
+                continue
+            read = cycle_reads[cycle]
+            if cycle == reads[read]['last_cycle']:
+                continue
+            key = (lane, read, tile)
+            total = errors.get(key)
+            if total is None:
+                total = errors[key] = [0.0, 0]
+            total[0] += error
+            total[1] += 1
+    finally:
+        data.close()
+    return errors
+
+
+def iter_index_metrics(data):
+    # (row, start, end) of the records of a mapped IndexMetricsOut.bin,
+    # rows as in read_index_metrics and start:end the bytes of the record
+    version = ord(data[0])
+    if version not in (1, 2):
+        unsupported('IndexMetricsOut.bin', version)
+        return
+    head = struct.Struct('<HIH' if version == 2 else '<HHH')
+    size = len(data)
+    offset = 1
+    while offset + head.size <= size:
+        start = offset
+        lane, tile, read = head.unpack_from(data, offset)
+        offset += head.size
+        fields = []
+        for fmt in ('s', 'I', 's', 's'):
+            if fmt == 'I':
+                if offset + 4 > size:
+                    return
+                fields.append(struct.unpack_from('<I', data, offset)[0])
+                offset += 4
+                continue
+            if offset + 2 > size:
+                return
+            length = struct.unpack_from('<H', data, offset)[0]
+            offset += 2
+            if offset + length > size:
+                return
+            fields.append(data[offset:offset + length])
+            offset += length
+        index, count, sample, project = fields
+        yield (lane, tile, read, index, sample, project, count), start, offset
+
+
+def read_index_metrics(run_dir):
+    # Rows of (lane, tile, read, index, sample, project, count) as written
+    # by interop2csv
+    data = map_interop(run_dir, 'IndexMetricsOut.bin')
+    if data is None:
+        return []
+    try:
+        return [row for row, start, end in iter_index_metrics(data)]
+    finally:
+        data.close()
+
+
+def merge_index_metrics(run_dir, new_dir, lanes):
+    # Replace the records of lanes in the IndexMetricsOut.bin of run_dir by
+    # those of new_dir, which bcl2fastq wrote for these lanes only
+    path = os.path.join(run_dir, 'InterOp', 'IndexMetricsOut.bin')
+    new = map_interop(new_dir, 'IndexMetricsOut.bin')
+    if new is None:
+        return
+    old = map_interop(run_dir, 'IndexMetricsOut.bin')
+    try:
+        if old is not None and old[0] != new[0]:
+            raise ValueError('IndexMetricsOut.bin versions %d and %d differ'
+                             % (ord(old[0]), ord(new[0])))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(new[0])
+            if old is not None:
+                for row, start, end in iter_index_metrics(old):
+                    if row[0] not in lanes:
+                        f.write(old[start:end])
+            for row, start, end in iter_index_metrics(new):
+                if row[0] in lanes:
+                    f.write(new[start:end])
+    finally:
+        new.close()
+        if old is not None:
+            old.close()
+    os.rename(path + '.tmp', path)
+
+
+def mean_sd(values):
+    values = [v for v in values if not math.isnan(v)]
+    if not values:
+        return NAN, NAN
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    var = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    return mean, math.sqrt(var)
+
+
+def format_stat(values, precision, scale=1.0):
+    mean, sd = mean_sd(values)
+    return '%.*f +/- %.*f' % (precision, mean / scale, precision, sd / scale)
+
+
+def percent(part, total):
+    if not total:
+        return NAN
+    return 100.0 * part / total
+
+
+def read_name(read):
+    return 'Read %d%s' % (read['number'], ' (I)' if read['is_index'] else '')
+
+
+def run_summary(run_dir):
+    # Read and lane summaries like the SAV summary tab, lists of dicts
+    # with the formatted values of READ_FIELDS and LANE_FIELDS
+    reads = read_run_info(run_dir)
+    cycle_reads = cycle_to_read(reads)
+    tiles = read_tile_metrics(run_dir)
+    if not tiles:
+        raise ValueError('No tile metrics in %s' % run_dir)
+    qtotals = read_q_metrics(run_dir, cycle_reads)
+    errors = read_error_metrics(run_dir, cycle_reads, reads)
+
+    tile_errors = {}
+    for (lane, read, tile), (total, num) in errors.iteritems():
+        tile_errors.setdefault((lane, read), []).append(total / num)
+    lanes = sorted(set(lane for lane, tile in tiles) |
+                   set(lane for lane, read in qtotals))
+
+    read_stats = []
+    lane_summary = []
+    for lane in lanes:
+        lane_tiles = [m for (l, t), m in tiles.iteritems() if l == lane]
+        for i, read in enumerate(reads):
+            bases, q30, last_cycle = qtotals.get((lane, i), (0, 0, 0))
+            if not lane_tiles and not bases:
+                continue
+            aligned = [m['aligned'].get(read['number'], NAN)
+                       for m in lane_tiles]
+            lane_summary.append({
+                'Lane': str(lane), 'Read': read_name(read),
+                'Tiles': str(len(lane_tiles)),
+                'Density(k/mm2)': format_stat(
+                    [m.get('density', NAN) for m in lane_tiles], 0, 1e3),
+                'Density PF': format_stat(
+                    [m.get('density_pf', NAN) for m in lane_tiles], 0, 1e3),
+                'Cluster PF%': format_stat(
+                    [percent(m.get('count_pf', 0), m.get('count', 0))
+                     for m in lane_tiles], 2),
+                'Reads': '%.0f' % sum(m.get('count', 0) for m in lane_tiles),
+                'Reads PF': '%.0f' % sum(m.get('count_pf', 0)
+                                         for m in lane_tiles),
+                '%>=Q30': '%.2f' % percent(q30, bases),
+                'Yield': '%.2f' % (bases / 1e9),
+                'Aligned%': format_stat(aligned, 2),
+                'Error%': format_stat(tile_errors.get((lane, i), []), 2)})
+            read_stats.append((i, bases, q30, last_cycle, aligned,
+                               tile_errors.get((lane, i), [])))
+
+    read_summary = []
+    levels = [(read_name(read), [i]) for i, read in enumerate(reads)]
+    levels.append(('Non-indexed', [i for i, read in enumerate(reads)
+                                   if not read['is_index']]))
+    levels.append(('Total', range(len(reads))))
+    for level, positions in levels:
+        bases = q30 = projected = 0
+        aligned = []
+        read_errors = []
+        for i in positions:
+            stats = [s for s in read_stats if s[0] == i]
+            read_bases = sum(s[1] for s in stats)
+            read_aligned = [a for s in stats for a in s[4]]
+            read_error = [e for s in stats for e in s[5]]
+            bases += read_bases
+            q30 += sum(s[2] for s in stats)
+            cycles_done = max([s[3] for s in stats] or [0]) - \
+                reads[i]['first_cycle'] + 1
+            if cycles_done > 0:
+                projected += float(read_bases) * reads[i]['cycles'] / cycles_done
+            if read_aligned:
+                aligned.append(mean_sd(read_aligned)[0])
+            if read_error:
+                read_errors.append(mean_sd(read_error)[0])
+        read_summary.append({
+            'Level': level, 'Yield': '%.2f' % (bases / 1e9),
+            'Projected Yield': '%.2f' % (projected / 1e9),
+            'Aligned%': '%.2f' % mean_sd(aligned)[0],
+            'Error Rate%': '%.2f' % mean_sd(read_errors)[0],
+            '%>=Q30': '%.2f' % percent(q30, bases)})
+    return read_summary, lane_summary
+
+
+def write_sav_summary(path, read_summary, lane_summary):
+    # Same layout as the output of the summary tool
+    with open(path, 'w') as f:
+        f.write('# Version: %s\n' % SUMMARY_VERSION)
+        f.write('\t'.join(READ_FIELDS) + '\n')
+        for read in read_summary:
+            f.write('\t'.join(read[field] for field in READ_FIELDS) + '\n')
+        f.write('#Per Lane Statistics\n')
+        f.write('\t'.join(LANE_FIELDS) + '\n')
+        for lane in lane_summary:
+            f.write('\t'.join(lane[field] for field in LANE_FIELDS) + '\n')
+
+
+def write_index_summary(path, index_metrics):
+    # Same columns as interop2csv, the header starts with 'L' so readers
+    # of that format skip it
+    with open(path, 'w') as f:
+        f.write('# Index metrics\n')
+        f.write(','.join(INDEX_FIELDS) + '\n')
+        for row in index_metrics:
+            f.write(','.join(str(value) for value in row) + '\n')
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import traceback
+from interop import (HEADER_BYTES, error_layout, iter_records, q_layout,
+                     read_run_info, tile_layout, update_tile_metrics)
+
+# Quality thresholds for runs that are still sequencing, overridden from
+# config.cfg with the qc_ prefixed keys. Density is in k/mm2, the rest in
+# percent. None disables a check. Q30 and error rate are judged over the
+# last window cycles once a lane has min_cycles cycles.
+DEFAULT_QC = {'min_density': None, 'max_density': None, 'min_pf': 50.0,
+              'min_q30': 75.0, 'max_error': 2.0, 'min_cycles': 25,
+              'window': 10, 'max_age_hours': 24}
+
+
+def get_qc_options(settings):
+    options = dict(DEFAULT_QC)
+    for key in DEFAULT_QC:
+        value = settings.get('qc_' + key)
+        if value:
+            options[key] = float(value)
+        elif value is not None and key.startswith(('min_', 'max_')) and \
+                key not in ('min_cycles', 'max_age_hours'):
+            options[key] = None
+    return options
+
+
+# (metric, option, test of value and threshold, message) of the live checks
+QC_CHECKS = (('density', 'min_density', lambda v, t: v < t,
+              'cluster density %.0f k/mm2 below %.0f'),
+             ('density', 'max_density', lambda v, t: v > t,
+              'cluster density %.0f k/mm2 above %.0f'),
+             ('pf', 'min_pf', lambda v, t: v < t,
+              'clusters PF %.2f%% below %.2f%%'),
+             ('q30', 'min_q30', lambda v, t: v < t,
+              '%%>=Q30 %.2f%% below %.2f%%'),
+             ('error', 'max_error', lambda v, t: v > t,
+              'error rate %.2f%% above %.2f%%'))
+
+
+class InterOpTail(object):
+    # Follows one growing InterOp file and returns the records appended
+    # since the last call, so each poll only reads the new bytes. A file
+    # that was replaced or truncated is read again from the start.
+
+    def __init__(self, path, layout_func):
+        self.path = path
+        self.layout_func = layout_func
+        self.layout = None
+        self.inode = None
+        self.offset = 0
+        # Set when the last call started over on a replaced file
+        self.restarted = False
+
+    def new_records(self):
+        self.restarted = False
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+        if stat.st_ino == self.inode and self.offset == float('inf'):
+            # Unsupported version, until the file is replaced
+            return []
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.restarted = self.inode is not None
+            self.inode = stat.st_ino
+            self.layout = None
+        with open(self.path, 'rb') as f:
+            if self.layout is None:
+                header = f.read(HEADER_BYTES)
+                if len(header) < 2:
+                    return []
+                try:
+                    self.layout = self.layout_func(header)
+                except ValueError:
+                    # tile_layout raises for the batch summary
+                    self.layout = None
+                if self.layout is None:
+                    # Unsupported version, stop following the file
+                    self.offset = float('inf')
+                    return []
+                self.offset = self.layout[0]
+            record = self.layout[1]
+            num_records = (stat.st_size - self.offset) // record.size
+            if num_records <= 0:
+                return []
+            f.seek(self.offset)
+            data = f.read(num_records * record.size)
+        num_records = len(data) // record.size
+        self.offset += num_records * record.size
+        return list(iter_records(data, 0, record))
+
+
+class RunMonitor(object):
+    # Rolling metrics of one run in progress, fed from InterOp tails
+
+    def __init__(self, run_dir, options):
+        self.run_dir = run_dir
+        self.options = options
+        interop_dir = os.path.join(run_dir, 'InterOp')
+        self.tile_tail = InterOpTail(
+            os.path.join(interop_dir, 'TileMetricsOut.bin'), tile_layout)
+        self.q_tail = InterOpTail(
+            os.path.join(interop_dir, 'QMetricsOut.bin'), q_layout)
+        self.error_tail = InterOpTail(
+            os.path.join(interop_dir, 'ErrorMetricsOut.bin'), error_layout)
+        self.tiles = {}
+        # Per lane {cycle: [bases, bases >= Q30]} and {cycle: [sum, tiles]}
+        self.q_cycles = {}
+        self.error_cycles = {}
+        self.alerted = set()
+        reads = read_run_info(run_dir)
+        self.index_cycles = set(cycle for read in reads if read['is_index']
+                                for cycle in xrange(read['first_cycle'],
+                                                    read['last_cycle'] + 1))
+
+    def update(self):
+        records = self.tile_tail.new_records()
+        if self.tile_tail.restarted:
+            self.tiles = {}
+        if records:
+            update_tile_metrics(self.tiles, self.tile_tail.layout, records)
+        records = self.q_tail.new_records()
+        if self.q_tail.restarted:
+            self.q_cycles = {}
+        if records:
+            first_q30 = self.q_tail.layout[2]
+            for values in records:
+                hist = values[3:]
+                cycles = self.q_cycles.setdefault(values[0], {})
+                total = cycles.get(values[2])
+                if total is None:
+                    total = cycles[values[2]] = [0, 0]
+                total[0] += sum(hist)
+                total[1] += sum(hist[first_q30:])
+        records = self.error_tail.new_records()
+        if self.error_tail.restarted:
+            self.error_cycles = {}
+        for lane, tile, cycle, error in records:
+            total = self.error_cycles.setdefault(lane, {}).setdefault(
+                cycle, [0.0, 0])
+            total[0] += error
+            total[1] += 1
+
+    def _window(self, cycles):
+        # Totals of the last window complete non-index cycles, the newest
+        # cycle may still be written
+        done = sorted(c for c in cycles if c not in self.index_cycles)[:-1]
+        if len(done) < self.options['min_cycles']:
+            return None
+        window = done[-int(self.options['window']):]
+        return [sum(cycles[c][i] for c in window) for i in (0, 1)]
+
+    def metrics(self):
+        # Per lane dict of density (k/mm2), percent PF, rolling Q30 and
+        # rolling error rate, missing where there is no data yet
+        lanes = {}
+        for (lane, tile), tile_metrics in self.tiles.iteritems():
+            totals = lanes.setdefault(lane, {'density': [], 'count': 0,
+                                             'count_pf': 0})
+            if 'density' in tile_metrics:
+                totals['density'].append(tile_metrics['density'] / 1e3)
+            totals['count'] += tile_metrics.get('count', 0)
+            totals['count_pf'] += tile_metrics.get('count_pf', 0)
+        metrics = {}
+        for lane, totals in lanes.iteritems():
+            lane_metrics = metrics.setdefault(lane, {})
+            if totals['density']:
+                lane_metrics['density'] = sum(totals['density']) / len(
+                    totals['density'])
+            if totals['count']:
+                lane_metrics['pf'] = 100.0 * totals['count_pf'] / \
+                    totals['count']
+        for lane, cycles in self.q_cycles.iteritems():
+            window = self._window(cycles)
+            if window is not None and window[0]:
+                metrics.setdefault(lane, {})['q30'] = \
+                    100.0 * window[1] / window[0]
+        for lane, cycles in self.error_cycles.iteritems():
+            window = self._window(cycles)
+            if window is not None and window[1]:
+                metrics.setdefault(lane, {})['error'] = window[0] / window[1]
+        return metrics
+
+    def check(self):
+        # Update the metrics and return messages for thresholds crossed
+        # for the first time
+        self.update()
+        alerts = []
+        for lane, lane_metrics in sorted(self.metrics().iteritems()):
+            for metric, option, failed, message in QC_CHECKS:
+                threshold = self.options[option]
+                if threshold is None or metric not in lane_metrics or \
+                        (lane, option) in self.alerted:
+                    continue
+                if failed(lane_metrics[metric], threshold):
+                    self.alerted.add((lane, option))
+                    alerts.append('Lane %d: ' % lane + message % (
+                        lane_metrics[metric], threshold))
+        return alerts
+
+
+class LiveQC(object):
+    # Watches the runs that are still sequencing and calls alert(subject,
+    # body) when a lane crosses a threshold. Runs whose InterOp folder did
+    # not change for max_age_hours, e.g. aborted runs, are not followed.
+    # Errors of a run, e.g. a partly written RunInfo.xml, are printed and
+    # the run is tried again on the next poll.
+
+    def __init__(self, alert, options=None):
+        if options is None:
+            options = DEFAULT_QC
+        self.alert = alert
+        self.options = options
+        self.monitors = {}
+        # Last error printed per run, so a lasting one is printed once
+        self.errors = {}
+
+    def _recent(self, run_dir):
+        interop_dir = os.path.join(run_dir, 'InterOp')
+        try:
+            mtime = os.stat(interop_dir).st_mtime
+        except OSError:
+            return False
+        return time.time() - mtime < self.options['max_age_hours'] * 3600 \
+            and os.path.isfile(os.path.join(run_dir, 'RunInfo.xml'))
+
+    def poll(self, run_dirs):
+        run_dirs = set(run_dirs)
+        for runs in (self.monitors, self.errors):
+            for run_dir in list(runs):
+                if run_dir not in run_dirs:
+                    del runs[run_dir]
+        for run_dir in sorted(run_dirs):
+            try:
+                self._poll_run(run_dir)
+                self.errors.pop(run_dir, None)
+            except Exception:
+                # Live QC must never stop the demultiplexing
+                error = traceback.format_exc()
+                if self.errors.get(run_dir) != error:
+                    self.errors[run_dir] = error
+                    sys.stderr.write('Live QC of %s failed\n%s' % (run_dir,
+                                                                  error))
+
+    def _poll_run(self, run_dir):
+        monitor = self.monitors.get(run_dir)
+        if monitor is None:
+            if not self._recent(run_dir):
+                return
+            monitor = self.monitors[run_dir] = RunMonitor(run_dir,
+                                                          self.options)
+        alerts = monitor.check()
+        if alerts:
+            self.alert('QC warning for %s' % os.path.basename(run_dir),
+                       '\n'.join(alerts) + '\n')
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+
+# One row per run, lane, read level and sample. Run level values are copied
+# into runs so that trends over many runs need no join.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    date TEXT,
+    instrument TEXT,
+    experiment TEXT,
+    investigator TEXT,
+    cluster_density REAL,
+    cluster_density_pf REAL,
+    clusters INTEGER,
+    clusters_pf INTEGER,
+    percent_pf REAL,
+    percent_phix_aligned REAL,
+    error_rate REAL,
+    q30 REAL
+);
+CREATE TABLE IF NOT EXISTS lanes (
+    run TEXT,
+    lane TEXT,
+    read TEXT,
+    density REAL,
+    density_pf REAL,
+    cluster_pf REAL,
+    reads REAL,
+    reads_pf REAL,
+    q30 REAL,
+    aligned REAL,
+    error_rate REAL
+);
+CREATE TABLE IF NOT EXISTS reads (
+    run TEXT,
+    level TEXT,
+    yield REAL,
+    aligned REAL,
+    error_rate REAL,
+    q30 REAL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    run TEXT,
+    sample_id TEXT,
+    sample_name TEXT,
+    project TEXT,
+    barcode TEXT,
+    counts INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_date ON runs (date);
+CREATE INDEX IF NOT EXISTS runs_instrument_date ON runs (instrument, date);
+CREATE INDEX IF NOT EXISTS lanes_run ON lanes (run);
+CREATE INDEX IF NOT EXISTS reads_run ON reads (run);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (run);
+CREATE INDEX IF NOT EXISTS samples_counts ON samples (counts);
+"""
+
+
+def to_float(value):
+    # SAV values come as '250.12 +/- 3.4' or 'nan', keep the leading number
+    match = re.match(r'\s*(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)', str(value))
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+# SAV summary columns stored per lane and read level, numbers are parsed
+LANE_FIELDS = (('Lane', None), ('Read', None),
+               ('Density(k/mm2)', to_float), ('Density PF', to_float),
+               ('Cluster PF%', to_float), ('Reads', to_float),
+               ('Reads PF', to_float), ('%>=Q30', to_float),
+               ('Aligned%', to_float), ('Error%', to_float))
+READ_FIELDS = (('Level', None), ('Yield', to_float), ('Aligned%', to_float),
+               ('Error Rate%', to_float), ('%>=Q30', to_float))
+
+
+def get_instrument(run_name):
+    # Run folders are named <date>_<instrument>_<run number>_<flowcell>,
+    # output folders can have a prefix before the date
+    fields = run_name.split('_')
+    for i, field in enumerate(fields[:-1]):
+        if re.match(r'^[0-9]{6}$', field):
+            return fields[i + 1]
+    return ''
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _row(summary, fields):
+    return [summary.get(name) if convert is None else
+            convert(summary.get(name)) for name, convert in fields]
+
+
+def record_run(conn, exp_details):
+    # Store the metrics of one run_details.json, replacing earlier rows of
+    # the same run
+    run = exp_details['run']
+    # Older run_details.json only have the output folder name
+    instrument = exp_details.get('instrument') or get_instrument(
+        exp_details.get('run_folder') or run)
+    reads = exp_details.get('read_summary', [])
+    non_indexed = [item for item in reads
+                   if item.get('Level') == 'Non-indexed']
+    q30 = to_float(non_indexed[0].get('%>=Q30')) if non_indexed else None
+    with conn:
+        for table in ('runs', 'lanes', 'reads', 'samples'):
+            conn.execute('DELETE FROM %s WHERE run = ?' % table, (run,))
+        conn.execute(
+            'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (run, exp_details.get('date'), instrument,
+             exp_details.get('experiment'), exp_details.get('investigator'),
+             exp_details.get('Cluster Density'),
+             exp_details.get('Cluster Density (PF)'),
+             exp_details.get('Number of Clusters'),
+             exp_details.get('Number of Clusters (PF)'),
+             exp_details.get('Percentage Clusters (PF)'),
+             exp_details.get('Percentage PhiX Aligned'),
+             exp_details.get('Error%'), q30))
+        conn.executemany(
+            'INSERT INTO lanes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [[run] + _row(lane, LANE_FIELDS)
+             for lane in exp_details.get('lane_summary', [])])
+        conn.executemany('INSERT INTO reads VALUES (?, ?, ?, ?, ?, ?)',
+                         [[run] + _row(read, READ_FIELDS) for read in reads])
+        conn.executemany(
+            'INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)',
+            [(run, sample.get('Sample_ID'), sample.get('Sample_Name'),
+              sample.get('Sample_Project'),
+              '+'.join(filter(None, (sample.get('index'),
+                                     sample.get('index2')))),
+              sample.get('Counts') or 0)
+             for sample in exp_details.get('samples', [])])
+
+
+def record_run_json(db_path, run_json):
+    with open(run_json) as f:
+        exp_details = json.load(f)
+    conn = connect(db_path)
+    try:
+        record_run(conn, exp_details)
+    finally:
+        conn.close()
+
+
+def backfill(conn, run_jsons):
+    # Ingest existing run_details.json files, returns the number of runs
+    num_runs = 0
+    for run_json in run_jsons:
+        try:
+            with open(run_json) as f:
+                record_run(conn, json.load(f))
+            num_runs += 1
+        except (IOError, ValueError, KeyError) as e:
+            sys.stderr.write('Skipping %s: %s\n' % (run_json, e))
+    return num_runs
+
+
+def q30_trend(conn, since=None, instrument=None, period='%Y-%m'):
+    # Mean Q30 of the non-indexed reads per instrument and period
+    # (strftime format of the run date)
+    query = ('SELECT instrument, strftime(?, date) AS period, AVG(q30), '
+             'COUNT(*) FROM runs WHERE q30 IS NOT NULL')
+    args = [period]
+    if since is not None:
+        query += ' AND date >= ?'
+        args.append(since)
+    if instrument is not None:
+        query += ' AND instrument = ?'
+        args.append(instrument)
+    query += ' GROUP BY instrument, period ORDER BY instrument, period'
+    return conn.execute(query, args).fetchall()
+
+
+def low_count_samples(conn, max_reads=1000000, since=None):
+    # Samples with fewer than max_reads reads, newest runs first
+    query = ('SELECT runs.date, samples.run, sample_id, sample_name, '
+             'project, counts FROM samples JOIN runs ON runs.run = '
+             'samples.run WHERE counts < ?')
+    args = [max_reads]
+    if since is not None:
+        query += ' AND runs.date >= ?'
+        args.append(since)
+    query += ' ORDER BY runs.date DESC, counts'
+    return conn.execute(query, args).fetchall()
+
+
+def print_rows(rows):
+    for row in rows:
+        print '\t'.join('' if value is None else str(value) for value in row)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--db', required=True,
+                        help='SQLite metrics database')
+    commands = parser.add_subparsers(dest='command')
+    backfill_parser = commands.add_parser(
+        'backfill', help='Ingest run_details.json of existing runs')
+    backfill_parser.add_argument('dirs', nargs='+',
+                                 help='Run output directories')
+    trend_parser = commands.add_parser('q30-trend',
+                                       help='Mean Q30 per instrument')
+    trend_parser.add_argument('--since', help='First run date (YYYY-MM-DD)')
+    trend_parser.add_argument('--instrument')
+    trend_parser.add_argument('--period', default='%Y-%m',
+                              help='strftime format grouping the run dates')
+    low_parser = commands.add_parser('low-samples',
+                                     help='Samples with few reads')
+    low_parser.add_argument('--max-reads', type=int, default=1000000)
+    low_parser.add_argument('--since', help='First run date (YYYY-MM-DD)')
+
+    opts = parser.parse_args()
+    conn = connect(opts.db)
+    if opts.command == 'backfill':
+        run_jsons = [os.path.join(d, 'run_details.json') for d in opts.dirs]
+        run_jsons = [f for f in run_jsons if os.path.isfile(f)]
+        sys.stderr.write('Added %d runs\n' % backfill(conn, run_jsons))
+    elif opts.command == 'q30-trend':
+        print_rows(q30_trend(conn, opts.since, opts.instrument, opts.period))
+    elif opts.command == 'low-samples':
+        print_rows(low_count_samples(conn, opts.max_reads, opts.since))
+    conn.close()
@@ -9,17 +9,29 @@ import subprocess
 import smtplib
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
+import threading
 import traceback
 import time
 import glob
 from utils import *
+from compression import get_compression
+from run_watcher import INACTIVE_HOURS, RunWatcher
+from metrics_store import record_run_json
+from demux_resources import distinct_samples, plan_threads, thread_options
+from s3_upload import get_upload_options, local_files, start_pipelined_upload
+from stage_metrics import StageMetrics, append_metrics_log, write_textfile
+from samplesheet import check_plan, load_samplesheet, save_samplesheet_cache
+from live_qc import LiveQC, get_qc_options
+from run_state import RunState
+from redemux import (SCRATCH_SUFFIX, lane_tiles, merge_output, merge_stats,
+                     merge_umi_stats, parse_lanes)
+from interop import merge_index_metrics, read_instrument
 import argparse
 import ConfigParser
 import re
 
 
-def demultiplex_run(run_path, output_path, settings, umi=False,
-                    umi_single_end=False):
+def remove_output_dir(run_path, output_path):
     if os.path.isdir(output_path):
         # Make sure we don't delete data above current dir
         # We are assuming the parent directories for run_path and output_path
@@ -27,56 +39,45 @@ def demultiplex_run(run_path, output_path, settings, umi=False,
         parent_dir, run = os.path.split(run_path)
         if output_path.startswith(os.path.abspath(parent_dir) + '/'):
             shutil.rmtree(output_path)
-    try:
-        umi_opts = ""
-        if umi:
-            base_mask = 'y*,i8y*,y*'
-            if umi_single_end:
-                base_mask = 'y*,i8y*'
-            umi_opts = (" --use-bases-mask %s "
-                        " --minimum-trimmed-read-length=0 "
-                        " --mask-short-adapter-reads=0 " % base_mask)
-        cmd_opts = "-r 8 -d 8 -p 8 --ignore-missing-bcls --no-lane-splitting"
-        cmd = "%s -R %s -o %s %s %s" % (settings['bcl2fastq'], run_path,
-                                        output_path, cmd_opts, umi_opts)
-        sys.stderr.write("Demultiplexing command\n%s\n" % cmd)
-        subprocess.check_call(shlex.split(cmd))
-    except Exception as e:
-        print traceback.format_exc()
-        send_email(settings['from'], settings['to'],
-                   settings['server'], settings['password'],
-                   settings['port'],
-                   run, traceback.format_exc())
-
-    # Generate SAV summary
-    summary_file = os.path.join(run_path, "SAV_summary.tsv")
-    summary_cmd = "%s %s" % (settings['summary'], run_path)
-    sys.stderr.write("Generating summary stats\n%s\n" % summary_cmd)
-    with open(summary_file, 'w') as f:
-        subprocess.check_call(shlex.split(summary_cmd), stdout=f)
-
-    # Generate index summary
-    index_interop = os.path.join(run_path, "InterOp/IndexMetricsOut.bin")
-    if os.path.exists(index_interop):
-        index_file = os.path.join(run_path, "index_summary.csv")
-        index_cmd = "%s %s" % (settings['interopcsv'], index_interop)
-        sys.stderr.write("Generating index summary\n%s\n" % index_cmd)
-        with open(index_file, 'w') as f:
-            subprocess.check_call(shlex.split(index_cmd), stdout=f)
-    else:
-        sys.stderr.write("Index metrics are not present\n")
 
 
-def get_dirs_to_process(datadir):
-    run_dirs = []
-    for dirs in os.listdir(datadir):
-        run_dir = os.path.join(datadir, dirs)
-        if os.path.isdir(run_dir):
-            if os.path.exists(os.path.join(run_dir, 'RTAComplete.txt')):
-                if not os.path.exists(os.path.join(run_dir,
-                                                   'DemuxComplete.txt')):
-                    run_dirs.append(run_dir)
-    return run_dirs
+def demultiplex_run(run_path, output_path, settings, umi=False,
+                    umi_single_end=False, umi_fast_intermediates=False,
+                    clean=True, barcode_mismatches=None, threads=None,
+                    samplesheet=None, tiles=None, interop_dir=None):
+    run = os.path.split(run_path)[1]
+    if clean:
+        remove_output_dir(run_path, output_path)
+    umi_opts = ""
+    if umi:
+        base_mask = 'y*,i8y*,y*'
+        if umi_single_end:
+            base_mask = 'y*,i8y*'
+        umi_opts = (" --use-bases-mask %s "
+                    " --minimum-trimmed-read-length=0 "
+                    " --mask-short-adapter-reads=0 " % base_mask)
+        if umi_fast_intermediates:
+            # The untagged FASTQs are only an intermediate for the UMI
+            # tagger, store them with the fastest level bcl2fastq has (1-9).
+            # This saves CPU, the files are larger than at the default level.
+            umi_opts += " --fastq-compression-level 1 "
+    if threads is None:
+        threads = plan_threads(run_path, output_path, settings)
+    cmd_opts = "%s --ignore-missing-bcls --no-lane-splitting" % (
+        thread_options(threads))
+    if barcode_mismatches:
+        cmd_opts += " --barcode-mismatches %s" % ",".join(
+            str(m) for m in barcode_mismatches)
+    # Set when only some lanes are demultiplexed again
+    for option, value in (('--sample-sheet', samplesheet),
+                          ('--tiles', tiles), ('--interop-dir', interop_dir)):
+        if value:
+            cmd_opts += " %s %s" % (option, value)
+    cmd = "%s -R %s -o %s %s %s" % (settings['bcl2fastq'], run_path,
+                                    output_path, cmd_opts, umi_opts)
+    sys.stderr.write("Demultiplexing command\n%s\n" % cmd)
+    # A failure stops the run, the callers report it
+    subprocess.check_call(shlex.split(cmd))
 
 
 def mark_demux_complete(run_dir):
@@ -130,15 +131,28 @@ def pretty_print_run_stats(run, overall_metrics, read_summary, lane_summary,
     return subject, body
 
 
-def process_run(run, settings, upload, nomail, upload_only):
+def plan_barcode_mismatches(sheet, settings, umi):
+    # barcode_mismatches is auto or fixed numbers per index read. UMI runs
+    # only demultiplex on the first 8 bases of the i7 read.
+    lengths = [8] if umi else None
+    value = settings.get('barcode_mismatches') or 'auto'
+    if value == 'auto':
+        return sheet.mismatch_plan(
+            max_mismatches=int(settings.get('max_barcode_mismatches') or 2),
+            lengths=lengths)
+    return sheet.mismatch_plan([int(m) for m in value.split(',')],
+                               lengths=lengths)
+
+
+def prepare_run(run, settings):
+    # Locate the samplesheet and work out the output directory, returns the
+    # state handed from stage to stage
     sender = settings['from']
     rcpt = settings['to']
     smtp_server = settings['server']
     smtp_password = settings['password']
     smtp_port = settings['port']
     samplesheet = os.path.join(run, "SampleSheet.csv")
-    sav_summary = os.path.join(run, "SAV_summary.tsv")
-    index_summary = os.path.join(run, "index_summary.csv")
     if not os.path.isfile(samplesheet):
         # Check if a csv file is present in the directory
         csvfiles = glob.glob(run + "/*.csv")
@@ -154,7 +168,8 @@ def process_run(run, settings, upload, nomail, upload_only):
             send_email(sender, rcpt, smtp_server, smtp_password, smtp_port,
                        run, body)
     print "Parsing SampleSheet"
-    exp_details = parse_samplesheet(samplesheet)
+    sheet = load_samplesheet(samplesheet)
+    exp_details = sheet.exp_details(samplesheet)
     if re.search("\%", exp_details["experiment"]):
         # Munich style samplesheet
         prefix, suffix = exp_details["experiment"].split("%")
@@ -167,81 +182,462 @@ def process_run(run, settings, upload, nomail, upload_only):
             output_suffix = "_".join(exp_details["experiment"].split("_")[1:])
         else:
             output_suffix = exp_details["experiment"]
-    output_dir = output_prefix + "_" + output_suffix
-    if not upload_only:
-        print "Demultiplexing %s" % run
-        umi = False
-        umi_single_end = False
-        if re.search("umi", exp_details["description"].lower()) or re.search("umi", exp_details["experiment"].lower()):
-            umi = True
-            if len(exp_details['read_lengths']) == 1:
-                umi_single_end = True
-        demultiplex_run(run, output_dir, settings, umi, umi_single_end)
-        if umi:
-            # Add barcodes to read names
-            processUMI(output_dir, exp_details, umi_single_end)
+    umi = False
+    umi_single_end = False
+    if re.search("umi", exp_details["description"].lower()) or re.search("umi", exp_details["experiment"].lower()):
+        umi = True
+        if len(exp_details['read_lengths']) == 1:
+            umi_single_end = True
+    save_samplesheet_cache(samplesheet, sheet)
+    return {'run': run, 'samplesheet': samplesheet,
+            'samplesheet_md5': sheet.md5, 'exp_details': exp_details,
+            'output_dir': output_prefix + "_" + output_suffix,
+            'umi': umi, 'umi_single_end': umi_single_end}
+
+
+def plan_demux(state, settings):
+    # Fail on index collisions now rather than after bcl2fastq ran for an
+    # hour, the plan is cached with the parsed sheet. Only done before
+    # demultiplexing, so runs past it are not held up by a stricter check.
+    sheet = load_samplesheet(state['samplesheet'])
+    state['demux_plan'] = plan_barcode_mismatches(sheet, settings,
+                                                  state['umi'])
+    save_samplesheet_cache(state['samplesheet'], sheet)
+    check_plan(state['demux_plan'])
+
+
+def demux_stage(state, settings, upload, nomail, upload_only):
+    if upload_only:
+        return
+    plan_demux(state, settings)
+    print "Demultiplexing %s" % state['run']
+    # Only reached without a demux checkpoint, output of an earlier attempt
+    # or sample sheet must not be mixed in
+    remove_output_dir(state['run'], state['output_dir'])
+    options = get_upload_options(settings)
+    if upload and options['pipelined']:
+        # Upload the FASTQs while the rest of the run is processed, for UMI
+        # runs only the tagged ones
+        pattern = '*_UMI_001.fastq.gz' if state['umi'] else '*.fastq.gz'
+        state['pipeline'] = start_pipelined_upload(
+            settings['s3cfg'], state['output_dir'], settings['s3folder'],
+            settings['region'], options, pattern)
+    threads = plan_threads(state['run'], state['output_dir'], settings,
+                           distinct_samples(state['exp_details']['samples']))
+    start = time.time()
+    demultiplex_run(state['run'], state['output_dir'], settings,
+                    state['umi'], state['umi_single_end'],
+                    umi_fast_intermediates(settings), clean=False,
+                    barcode_mismatches=state['demux_plan'][
+                        'barcode_mismatches'], threads=threads)
+    threads['seconds'] = time.time() - start
+    state['demux_resources'] = threads
+    state['checkpoints'].mark_done('demux', demux_resources=threads,
+                                   demux_plan=state['demux_plan'])
+
+
+def umi_stage(state, settings, upload, nomail, upload_only):
+    if upload_only or not state['umi']:
+        return
+    # Add barcodes to read names, samples tagged before a restart are kept
+    checkpoints = state['checkpoints']
+    throughput = processUMI(state['output_dir'], state['exp_details'],
+                            state['umi_single_end'], get_compression(settings),
+                            done_samples=checkpoints.umi_samples(),
+                            sample_done=checkpoints.mark_umi_sample,
+                            sample_stats=checkpoints.umi_stats(),
+                            **get_umi_options(settings))
+    record = state['metrics'].current
+    record['samples'] = throughput
+    record['records'] = sum(sample['records'] for sample in throughput)
+    record['data_bytes'] = sum(sample['bytes'] for sample in throughput)
+    state['umi_stats'] = checkpoints.umi_stats()
+    checkpoints.mark_done('umi', umi_stats=state['umi_stats'])
+
+
+def report_stage(state, settings, upload, nomail, upload_only):
+    run = state['run']
+    output_dir = state['output_dir']
+    exp_details = state['exp_details']
+    sav_summary = os.path.join(run, "SAV_summary.tsv")
+    index_summary = os.path.join(run, "index_summary.csv")
     print "Parsing SAV Summary"
     read_summary, lane_summary, overall_metrics, index_metrics = summarize_SAV(
         run)
     print "Adding sample names to index"
     index_metrics = add_samplenames_to_index(index_metrics, exp_details)
     exp_details = update_expdetails_with_counts(exp_details, index_metrics)
+    if state.get('umi_stats'):
+        exp_details = update_expdetails_with_read_stats(exp_details,
+                                                        state['umi_stats'])
+    if 'demux_plan' in state:
+        exp_details["demux_plan"] = state['demux_plan']
+    if 'demux_resources' in state:
+        # Achieved throughput to tune the thread settings from
+        resources = state['demux_resources']
+        if resources['seconds'] > 0:
+            resources['reads_per_second'] = overall_metrics[
+                'Number of Clusters (PF)'] / resources['seconds']
+        exp_details["demux_resources"] = resources
+    # Stages up to this one, the later ones go to the metrics log
+    state['metrics'].set_records('demux',
+                                 overall_metrics['Number of Clusters (PF)'])
+    exp_details["stage_metrics"] = state['metrics'].stages
     exp_details["lane_summary"] = lane_summary
     exp_details["read_summary"] = read_summary
     exp_details["run"] = os.path.split(output_dir)[1]
+    # The output folder name can have a prefix, keep what identifies the run
+    exp_details["run_folder"] = os.path.basename(run.rstrip('/'))
+    exp_details["instrument"] = read_instrument(run)
     exp_details.update(overall_metrics)
     run_json = output_dir + "/run_details.json"
     with open(run_json, "w") as f:
         f.write(json.dumps(exp_details, indent=4, sort_keys=True))
-    shutil.copy(samplesheet, output_dir)
+    state['exp_details'] = exp_details
+    if settings.get('metrics_db'):
+        try:
+            record_run_json(settings['metrics_db'], run_json)
+        except Exception:
+            # Metrics can be backfilled later, don't fail the run
+            print traceback.format_exc()
+    shutil.copy(state['samplesheet'], output_dir)
     shutil.copy(sav_summary, output_dir)
     shutil.copy(index_summary, output_dir)
-    mark_demux_complete(run)
     subject, body = pretty_print_run_stats(run, overall_metrics, read_summary,
                                            lane_summary, index_metrics,
                                            output_dir, settings['web_loc'])
     if not nomail:
-        send_email(sender, rcpt, smtp_server, smtp_password, smtp_port,
-                   subject, body)
-    if upload:
-        s4opts = False
-        if settings['s4cmd'].lower() == 'true':
-            s4opts = True
-        error = upload_run_to_S3(settings['s3cfg'], output_dir, settings[
-                                 's3folder'], settings['region'], s4opts)
-        if error != 0:
-            subject = "Upload failure for %s" % output_dir
-            body = "Failed to upload %s after 5 tries" % output_dir
-            if nomail:
-                print body
-            else:
-                send_email(sender, rcpt, smtp_server, smtp_password, smtp_port,
-                           subject, body)
+        send_email(settings['from'], settings['to'], settings['server'],
+                   settings['password'], settings['port'], subject, body)
+    state['run_json'] = run_json
+    state['checkpoints'].mark_done('report', run_json=run_json)
+
+
+def upload_stage(state, settings, upload, nomail, upload_only):
+    if not upload:
+        return
+    output_dir = state['output_dir']
+    state['metrics'].current['data_bytes'] = sum(
+        os.path.getsize(os.path.join(output_dir, rel))
+        for rel in local_files(output_dir))
+    error = upload_run_to_S3(settings['s3cfg'], output_dir, settings[
+                             's3folder'], settings['region'],
+                             get_upload_options(settings),
+                             state.pop('pipeline', None))
+    state['upload_error'] = error
+    if error == 0:
+        state['checkpoints'].mark_done('upload')
+    else:
+        subject = "Upload failure for %s" % output_dir
+        body = "Failed to upload %d files of %s, rerun to resume" % (
+            error, output_dir)
+        if nomail:
+            print body
         else:
-            # Upload run information to database
-            data, exists = create_run_in_db(settings['dbserver'],
-                                            settings['dbuser'],
-                                            settings['dbpasswd'], run_json)
-            if exists:
-                subject = 'Run %s already in db' % exp_details['run']
-            else:
-                subject = "Created %s in db" % exp_details['run']
-            send_email(sender, rcpt,  smtp_server, smtp_password,
-                       smtp_port, subject, json.dumps(data, indent=4))
+            send_email(settings['from'], settings['to'], settings['server'],
+                       settings['password'], settings['port'], subject, body)
+
+
+def db_stage(state, settings, upload, nomail, upload_only):
+    if not upload or state.get('upload_error', 0) != 0:
+        return
+    # Upload run information to database
+    data, exists = create_run_in_db(settings['dbserver'],
+                                    settings['dbuser'],
+                                    settings['dbpasswd'], state['run_json'])
+    run_name = os.path.split(state['output_dir'])[1]
+    if exists:
+        subject = 'Run %s already in db' % run_name
+    else:
+        subject = "Created %s in db" % run_name
+    send_email(settings['from'], settings['to'], settings['server'],
+               settings['password'], settings['port'], subject,
+               json.dumps(data, indent=4))
+    state['checkpoints'].mark_done('db')
+
+
+# Stages of a run in order. In daemon mode each stage with a slot count in
+# config.cfg (<stage>_slots) is limited to that many runs at a time, so one
+# run can upload while the next one is demultiplexed. Stages checkpoint
+# themselves in the run folder (run_state.py) once they completed and are
+# skipped when the run is processed again.
+STAGES = (('demux', demux_stage),
+          ('umi', umi_stage),
+          ('report', report_stage),
+          ('upload', upload_stage),
+          ('db', db_stage))
+
+DEFAULT_STAGE_SLOTS = {'demux': 1, 'umi': 1, 'upload': 2, 'db': 1}
+
+
+def get_stage_slots(settings):
+    # Semaphores limiting the number of runs in each stage, empty values in
+    # config.cfg use DEFAULT_STAGE_SLOTS and stages without a limit are
+    # missing
+    slots = {}
+    for stage, func in STAGES:
+        value = settings.get(stage + '_slots') or \
+            DEFAULT_STAGE_SLOTS.get(stage)
+        if value:
+            slots[stage] = threading.BoundedSemaphore(int(value))
+    return slots
+
+
+def process_run(run, settings, upload, nomail, upload_only, slots=None,
+                restart=False):
+    # Resumes at the first stage without a checkpoint, restart processes
+    # the run from the beginning. DemuxComplete.txt is written once every
+    # stage completed, state['complete'] tells whether it was.
+    if slots is None:
+        slots = {}
+    metrics = StageMetrics(run)
+    status = 'failed'
+    try:
+        with metrics.measure('prepare'):
+            state = prepare_run(run, settings)
+        checkpoints = RunState(run)
+        checkpoints.start(state['samplesheet_md5'], restart)
+        state['metrics'] = metrics
+        state['checkpoints'] = checkpoints
+        try:
+            for stage, func in STAGES:
+                if checkpoints.done(stage):
+                    print "Skipping %s of %s, completed before" % (stage, run)
+                    state.update(checkpoints.restore(stage))
+                    continue
+                slot = slots.get(stage)
+                if slot is None:
+                    with metrics.measure(stage):
+                        func(state, settings, upload, nomail, upload_only)
+                    continue
+                start = time.time()
+                with slot:
+                    with metrics.measure(stage, time.time() - start):
+                        func(state, settings, upload, nomail, upload_only)
+        finally:
+            if 'pipeline' in state:
+                # The run failed before the upload stage
+                state.pop('pipeline').finish()
+        state['complete'] = state.get('upload_error', 0) == 0
+        if state['complete']:
+            mark_demux_complete(run)
+        status = 'ok'
+    finally:
+        write_stage_metrics(settings, metrics, status)
+    return state
+
+
+def checkpoint_processed_run(state, checkpoints, run_json):
+    # Runs processed before the checkpoints were added have no
+    # ProcessingState.json, their run_details.json shows the stages up to
+    # the report completed. The upload is redone after re-demultiplexing
+    # anyway and registering an existing run only reports it.
+    checkpoints.start(state['samplesheet_md5'])
+    checkpoints.mark_done('demux')
+    if state['umi']:
+        checkpoints.mark_done('umi', umi_stats={})
+    checkpoints.mark_done('report', run_json=run_json)
+
+
+def redemux_run(run, settings, lanes, upload, nomail, tiles=None):
+    # Demultiplex lanes of a processed run again with the corrected sample
+    # sheet and merge them into its output, see redemux.py. Only the
+    # samples, counts and plan in run_details.json are updated, then the
+    # run resumes from its checkpoints to upload the changed files.
+    state = prepare_run(run, settings)
+    plan_demux(state, settings)
+    checkpoints = RunState(run)
+    output_dir = state['output_dir']
+    run_json = os.path.join(output_dir, "run_details.json")
+    if not os.path.isfile(checkpoints.path) and os.path.isfile(run_json):
+        checkpoint_processed_run(state, checkpoints, run_json)
+    if not checkpoints.done('report'):
+        raise ValueError("%s has not been processed, can't re-demultiplex "
+                         "lanes" % run)
+    with open(run_json) as f:
+        exp_details = json.load(f)
+    scratch = output_dir.rstrip('/') + SCRATCH_SUFFIX
+    remove_output_dir(run, scratch)
+    os.makedirs(scratch)
+    start = time.time()
+    try:
+        sheet = load_samplesheet(state['samplesheet']).subset(lanes)
+        if not sheet.samples:
+            raise ValueError('No samples in lanes %s of the sample sheet' %
+                             ','.join(str(lane) for lane in lanes))
+        samplesheet = os.path.join(scratch, 'SampleSheet.csv')
+        sheet.write(samplesheet)
+        plan = plan_barcode_mismatches(sheet, settings, state['umi'])
+        check_plan(plan)
+        new_dir = os.path.join(scratch, 'output')
+        threads = plan_threads(run, scratch, settings,
+                               distinct_samples(sheet.sample_dicts()))
+        demultiplex_run(run, new_dir, settings, state['umi'],
+                        state['umi_single_end'],
+                        umi_fast_intermediates(settings), clean=False,
+                        barcode_mismatches=plan['barcode_mismatches'],
+                        threads=threads, samplesheet=samplesheet,
+                        tiles=tiles or lane_tiles(lanes),
+                        interop_dir=os.path.join(scratch, 'InterOp'))
+        new_details = sheet.exp_details(samplesheet)
+        new_stats = {}
+        if state['umi']:
+            processUMI(new_dir, new_details, state['umi_single_end'],
+                       get_compression(settings),
+                       sample_done=new_stats.__setitem__,
+                       **get_umi_options(settings))
+        written, removed = merge_output(
+            output_dir, new_dir, lanes, exp_details['samples'],
+            new_details['samples'], get_compression(settings))
+        if state['umi']:
+            checkpoints.update_umi_stats(merge_umi_stats(
+                os.path.join(output_dir,
+                             new_details['samples'][0]['Sample_Project']),
+                lanes, exp_details['samples'], new_details['samples'],
+                checkpoints.umi_stats(), new_stats,
+                get_compression(settings)))
+        merge_stats(output_dir, new_dir, lanes)
+        merge_index_metrics(run, scratch, lanes)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    index_metrics = add_samplenames_to_index(count_indices(run),
+                                             state['exp_details'])
+    details = update_expdetails_with_counts(state['exp_details'],
+                                            index_metrics)
+    if state['umi']:
+        details = update_expdetails_with_read_stats(details,
+                                                    checkpoints.umi_stats())
+    samples = details['samples']
+    exp_details['samples'] = samples
+    exp_details['demux_plan'] = state['demux_plan']
+    exp_details.setdefault('redemux', []).append(
+        {'lanes': lanes, 'tiles': tiles, 'time': time.time(),
+         'seconds': time.time() - start, 'demux_plan': plan,
+         'demux_resources': threads, 'written': written,
+         'removed': removed})
+    # Missing in run_details.json of runs processed before they were added
+    exp_details.setdefault("run_folder", os.path.basename(run.rstrip('/')))
+    exp_details.setdefault("instrument", read_instrument(run))
+    with open(run_json, "w") as f:
+        f.write(json.dumps(exp_details, indent=4, sort_keys=True))
+    if settings.get('metrics_db'):
+        try:
+            record_run_json(settings['metrics_db'], run_json)
+        except Exception:
+            print traceback.format_exc()
+    shutil.copy(state['samplesheet'], output_dir)
+    shutil.copy(os.path.join(run, "index_summary.csv"), output_dir)
+    # The earlier upload is out of date, the run stays registered
+    checkpoints.amend(state['samplesheet_md5'], ('upload',))
+    lane_names = set(str(lane) for lane in lanes)
+    body = '\n'.join('%s\t%s\t%s' % (sample.get('Lane', ''),
+                                     sample['Sample_Name'], sample['Counts'])
+                     for sample in samples
+                     if sample.get('Lane', '') in lane_names or
+                     not sample.get('Lane'))
+    subject = "Re-demultiplexed lanes %s of %s" % (
+        ','.join(str(lane) for lane in lanes), os.path.split(output_dir)[1])
+    if nomail:
+        print subject
+        print body
+    else:
+        send_email(settings['from'], settings['to'], settings['server'],
+                   settings['password'], settings['port'], subject, body)
+    return process_run(run, settings, upload, nomail, False)
+
+
+def write_stage_metrics(settings, metrics, status):
+    # Errors here must not hide the outcome of the run
+    try:
+        if settings.get('stage_metrics_log'):
+            append_metrics_log(settings['stage_metrics_log'], metrics, status)
+        if settings.get('stage_metrics_textfile'):
+            write_textfile(settings['stage_metrics_textfile'], metrics)
+    except (IOError, OSError):
+        print traceback.format_exc()
+
+
+class RunScheduler(object):
+    # Processes runs in the background, one thread per run. The threads
+    # share the stage slots, so independent runs overlap in different
+    # stages. A run that fails or is left incomplete, e.g. by upload
+    # errors, is reported and not retried until restart, which resumes it
+    # from its checkpoints.
+
+    def __init__(self, settings, upload, nomail, upload_only):
+        self.settings = settings
+        self.upload = upload
+        self.nomail = nomail
+        self.upload_only = upload_only
+        self.slots = get_stage_slots(settings)
+        self.lock = threading.Lock()
+        self.active = {}
+        self.failed = set()
+
+    def pending(self, run_list):
+        with self.lock:
+            return [run for run in run_list
+                    if run not in self.active and run not in self.failed]
+
+    def submit(self, run):
+        thread = threading.Thread(target=self._process, args=(run,),
+                                  name=os.path.basename(run))
+        thread.daemon = True
+        with self.lock:
+            self.active[run] = thread
+        thread.start()
+
+    def _process(self, run):
+        try:
+            state = process_run(run, self.settings, self.upload, self.nomail,
+                                self.upload_only, self.slots)
+            if not state['complete']:
+                with self.lock:
+                    self.failed.add(run)
+        except Exception:
+            print traceback.format_exc()
+            with self.lock:
+                self.failed.add(run)
+            if not self.nomail:
+                settings = self.settings
+                send_email(settings['from'], settings['to'],
+                           settings['server'], settings['password'],
+                           settings['port'], "Processing error %s" % run,
+                           traceback.format_exc())
+        finally:
+            with self.lock:
+                del self.active[run]
 
 
 def main(settings, upload, nomail, upload_only):
+    scheduler = RunScheduler(settings, upload, nomail, upload_only)
+    watcher = RunWatcher(settings['run_directory'],
+                         int(settings.get('poll_interval') or 30),
+                         float(settings.get('run_inactive_hours') or
+                               INACTIVE_HOURS))
+    live_qc = None
+    if settings.get('live_qc', '').lower() == 'true':
+        def qc_alert(subject, body):
+            if nomail:
+                print subject
+                print body
+            else:
+                send_email(settings['from'], settings['to'],
+                           settings['server'], settings['password'],
+                           settings['port'], subject, body)
+        live_qc = LiveQC(qc_alert, get_qc_options(settings))
+    print "Waiting to process runs"
     while 1 == 1:
-        run_list = get_dirs_to_process(settings['run_directory'])
+        run_list = scheduler.pending(watcher.scan())
+        if live_qc is not None:
+            live_qc.poll(watcher.sequencing)
         if run_list:
             print "Processing Runs"
             for run in run_list:
                 print run
             for run in run_list:
-                process_run(run, settings, upload, nomail, upload_only)
-
-        print "Waiting to process runs, sleeping 10 min"
-        time.sleep(600)
+                scheduler.submit(run)
+        watcher.wait()
 
 
 parser = argparse.ArgumentParser()
@@ -252,6 +648,14 @@ parser.add_argument("-u", "--upload", help="Upload the data to S3",
 parser.add_argument("--upload_only", help="Don't demux, upload existing data",
                     action="store_true", default=False)
 parser.add_argument("--nomail", action="store_true", default=False)
+parser.add_argument("--lanes", help="Demultiplex only these lanes of a "
+                    "processed run again, e.g. 1,3, and merge them into its "
+                    "output")
+parser.add_argument("--tiles", help="bcl2fastq --tiles expression for "
+                    "--lanes (default all tiles of the lanes)")
+parser.add_argument("--restart", help="Ignore the checkpoints of the run "
+                    "and process it from the beginning", action="store_true",
+                    default=False)
 group.add_argument("-i", "--input_dir", help="Run folder to analyze")
 group.add_argument(
     "-d", "--daemon", help="Run program as a daemon", action="store_true")
@@ -284,8 +688,12 @@ if args.daemon:
                        traceback.format_exc())
 elif args.input_dir:
     try:
-        process_run(args.input_dir, settings, args.upload, args.nomail,
-                    args.upload_only)
+        if args.lanes:
+            redemux_run(args.input_dir, settings, parse_lanes(args.lanes),
+                        args.upload, args.nomail, args.tiles)
+        else:
+            process_run(args.input_dir, settings, args.upload, args.nomail,
+                        args.upload_only, restart=args.restart)
     except Exception as e:
         print traceback.format_exc()
         if not args.nomail:
@@ -1,42 +1,181 @@
 #!/usr/bin/python
 
 import sys
-import gzip
+import re
+import itertools
 from collections import defaultdict
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 import argparse
+from compression import BACKENDS, DEFAULT_COMPRESSION, open_input
+from readfq import chunk_lines, read_record_blocks
+from AddUmiNugen import join_lines, ordered_map
+from topk import SpaceSaving, pack_barcode, unpack_barcode
 
+# Matches one whole 4-line record and captures the last ':' field of the
+# header, so matches stay aligned on records
+BARCODE_RE = re.compile(r'[^\n]*:([^\n:]*?)[ \t\r]*\n[^\n]*\n[^\n]*\n[^\n]*\n')
 
-def count_barcodes(infile, barcodes):
 
-    inf = gzip.open(infile, 'r')
+def count_block(task):
+    # Count barcodes in a raw block of whole records, only the barcode of
+    # each header is turned into a string. With a sampling fraction the
+    # leading part of every block is counted, which spreads the sample
+    # evenly over the file. Barcodes are packed for the bounded memory
+    # counter.
+    block, fraction, pack = task
+    barcodes = BARCODE_RE.findall(block)
+    if len(barcodes) * 4 != block.count('\n'):
+        # Some header has no ':' field, fall back to splitting lines
+        barcodes = [header.rstrip().split(':')[-1]
+                    for header in chunk_lines(block)[0::4]]
+    if fraction is not None:
+        del barcodes[int(round(len(barcodes) * fraction)):]
+    barcodes.sort()
+    counts = [(barcode, sum(1 for _ in group))
+              for barcode, group in itertools.groupby(barcodes)]
+    if pack:
+        counts = [(pack_barcode(barcode), count) for barcode, count in counts]
+    return counts
 
-    header = inf.readline()
 
-    while header:
-        seq = inf.readline()
-        comment = inf.readline()
-        quality = inf.readline()
-        barcode = header.rstrip().split(':')[-1]
-        barcodes[barcode] += 1
+def barcode_blocks(infile, compression=None, max_reads=None):
+    # Yield raw record blocks of infile, stopping after max_reads reads
+    reads = 0
+    inf = open_input(infile, compression)
+    try:
+        for block in read_record_blocks(inf):
+            num_reads = block.count('\n') // 4
+            if max_reads is not None and reads + num_reads >= max_reads:
+                yield join_lines(chunk_lines(block)[:4 * (max_reads - reads)])
+                break
+            reads += num_reads
+            yield block
+    finally:
+        inf.close()
 
-        header = inf.readline()
 
-    inf.close()
+def count_barcodes(infile, barcodes, compression=None, processes=1,
+                   pool=None, max_reads=None, fraction=None):
+    # barcodes is either a defaultdict(int) for exact counts or a
+    # SpaceSaving sketch keyed by packed barcodes
+    sketch = isinstance(barcodes, SpaceSaving)
+    blocks = barcode_blocks(infile, compression, max_reads)
+    tasks = ((block, fraction, sketch) for block in blocks)
+    for counts in ordered_map(count_block, tasks, processes, pool=pool):
+        if sketch:
+            barcodes.update(counts)
+        else:
+            for barcode, count in counts:
+                barcodes[barcode] += count
     return barcodes
 
 
+def new_counter(capacity=None):
+    if capacity:
+        return SpaceSaving(capacity)
+    return defaultdict(int)
+
+
+def count_file_barcodes(infile, compression=None, pool=None, max_reads=None,
+                        fraction=None, capacity=None):
+    return count_barcodes(infile, new_counter(capacity), compression,
+                          pool=pool, max_reads=max_reads, fraction=fraction)
+
+
+def split_reads(max_reads, num_files):
+    # Shares of max_reads per file that add up to exactly max_reads
+    if max_reads is None:
+        return [None] * num_files
+    share, rest = divmod(max_reads, num_files)
+    return [share + 1] * rest + [share] * (num_files - rest)
+
+
+def count_barcodes_parallel(infiles, processes=None, compression=None,
+                            max_reads=None, fraction=None, capacity=None):
+    # Count barcodes of all infiles on a shared pool of counting processes.
+    # Files are read concurrently and split into blocks, the per file
+    # tables are merged at the end. max_reads is split over the files, a
+    # file with fewer reads than its share leaves the rest unused. With a
+    # capacity the counts are approximate and kept in a
+    # SpaceSaving sketch of that many barcodes, see top_barcodes.
+    if not processes:
+        processes = cpu_count()
+    barcodes = new_counter(capacity)
+    pool = Pool(processes=processes)
+    readers = ThreadPool(processes=min(len(infiles), processes))
+    try:
+        file_counts = readers.map(
+            lambda task: count_file_barcodes(task[0], compression, pool,
+                                             task[1], fraction, capacity),
+            zip(infiles, split_reads(max_reads, len(infiles))), chunksize=1)
+        pool.close()
+    finally:
+        readers.terminate()
+        pool.terminate()
+        pool.join()
+    for counts in file_counts:
+        if capacity:
+            barcodes.merge(counts)
+            continue
+        for barcode, count in counts.iteritems():
+            barcodes[barcode] += count
+    return barcodes
+
+
+def top_barcodes(barcodes, count=None):
+    # (barcode, count, error) of the count most frequent barcodes, all of
+    # them if count is None. The true count lies between count - error and
+    # count, error is always 0 for exact counts.
+    if isinstance(barcodes, SpaceSaving):
+        return [(unpack_barcode(key), num, error)
+                for key, num, error in barcodes.top(count)]
+    keys = sorted(barcodes, key=barcodes.get, reverse=True)[:count]
+    return [(key, barcodes[key], 0) for key in keys]
+
+
+def counted_reads(barcodes):
+    if isinstance(barcodes, SpaceSaving):
+        return barcodes.total
+    return sum(barcodes.itervalues())
+
+
+def add_counting_args(parser):
+    parser.add_argument("-p", "--processes", type=int, default=None,
+                        help="Counting processes (default all cores)")
+    parser.add_argument("--max-reads", type=int, default=None,
+                        help="Stop after reading this many reads in total")
+    parser.add_argument("--fraction", type=float, default=None,
+                        help="Only count this fraction of the reads")
+    parser.add_argument("-z", "--compression", choices=BACKENDS,
+                        default=DEFAULT_COMPRESSION['backend'])
+    parser.add_argument("-t", "--threads", type=int,
+                        default=DEFAULT_COMPRESSION['threads'],
+                        help="Decompression threads for pigz")
+    parser.add_argument("--sketch-size", type=int, default=None,
+                        help="Count approximately with this many counters, "
+                        "memory stays bounded on any input (default exact)")
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--infiles", nargs='+',
                         help="Undetermined fastq files")
     parser.add_argument("-c", "--count", type=int, default=15)
+    add_counting_args(parser)
 
     opts = parser.parse_args()
+    compression = dict(DEFAULT_COMPRESSION, backend=opts.compression,
+                       threads=opts.threads)
 
-    barcodes = defaultdict(int)
-    for f in opts.infiles:
-        barcodes = count_barcodes(f, barcodes)
+    barcodes = count_barcodes_parallel(opts.infiles, opts.processes,
+                                       compression, opts.max_reads,
+                                       opts.fraction, opts.sketch_size)
 
-    for k in sorted(barcodes.keys(), key=barcodes.get, reverse=True)[:opts.count]:
-        print k, barcodes[k]
+    for k, count, error in top_barcodes(barcodes, opts.count):
+        if opts.sketch_size:
+            # Upper bound of the count and its maximum overestimate
+            print k, count, error
+        else:
+            print k, count
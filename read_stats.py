@@ -0,0 +1,88 @@
+#!/usr/bin/python
+from compression import open_input
+from readfq import chunk_lines, read_chunks
+from topk import HyperLogLog
+
+# Per sample read statistics gathered by the UMI tagger on the chunks it
+# tags anyway, so they cost no extra pass over the FASTQs. Qualities are
+# kept as a histogram of the quality characters, counted with str.count on
+# all qualities of a chunk, which is cheap for the few binned values of
+# current instruments. Distinct UMIs are estimated with HyperLogLog.
+
+PHRED_OFFSET = 33
+# Characters looked for first, the rest are found in what is left
+SNIFF_BYTES = 65536
+
+
+def quality_histogram(quals):
+    present = set(quals[:SNIFF_BYTES])
+    rest = quals.translate(None, ''.join(present))
+    histogram = dict((char, quals.count(char)) for char in present)
+    for char in set(rest):
+        histogram[char] = rest.count(char)
+    return histogram
+
+
+def chunk_stats(read_lines, umi_lines):
+    # Statistics of the lines of the reads of one chunk and its UMI lines
+    quals = ''.join(''.join(lines[3::4]) for lines in read_lines)
+    umis = HyperLogLog()
+    umis.update(set(umi_lines[1::4]))
+    return {'records': len(umi_lines) // 4, 'bases': len(quals),
+            'qualities': quality_histogram(quals), 'umis': umis}
+
+
+class ReadStats(object):
+    # Totals of the chunk statistics of one sample
+
+    def __init__(self):
+        self.records = 0
+        self.bases = 0
+        self.qualities = {}
+        self.umis = HyperLogLog()
+
+    def add(self, stats):
+        self.records += stats['records']
+        self.bases += stats['bases']
+        for char, count in stats['qualities'].iteritems():
+            self.qualities[char] = self.qualities.get(char, 0) + count
+        self.umis.merge(stats['umis'])
+
+    def summary(self):
+        # Values added to the samples in run_details.json
+        quality_sum = 0
+        q30 = 0
+        for char, count in self.qualities.iteritems():
+            quality = ord(char) - PHRED_OFFSET
+            quality_sum += quality * count
+            if quality >= 30:
+                q30 += count
+        bases = max(self.bases, 1)
+        return {'Reads': self.records, 'Bases': self.bases,
+                'Mean Quality': round(float(quality_sum) / bases, 2),
+                '%>=Q30': round(q30 * 100.0 / bases, 2),
+                'Distinct UMIs': self.umis.count()}
+
+
+def tagged_stats(paths, compression=None):
+    # ReadStats of UMI tagged FASTQs, paths[0] with the first reads, for
+    # samples whose statistics were not kept while tagging. The UMIs are
+    # taken from the read names.
+    stats = ReadStats()
+    for i, path in enumerate(paths):
+        inf = open_input(path, compression)
+        try:
+            for chunk in read_chunks(inf):
+                lines = chunk_lines(chunk)
+                quals = ''.join(lines[3::4])
+                umis = HyperLogLog()
+                if i == 0:
+                    umis.update(set(header.split()[0].rsplit(':', 1)[1]
+                                    for header in lines[0::4]))
+                stats.add({'records': len(lines) // 4 if i == 0 else 0,
+                           'bases': len(quals),
+                           'qualities': quality_histogram(quals),
+                           'umis': umis})
+        finally:
+            inf.close()
+    return stats
@@ -1,4 +1,8 @@
 # https://github.com/lh3/readfq
+import io
+import itertools
+
+
 def readfq(fp):  # this is a generator function
     last = None  # this is a buffer keeping the last unprocessed line
     while True:  # mimic closure; is it a bad idea?
@@ -33,3 +37,157 @@ def readfq(fp):  # this is a generator function
             if last:  # reach EOF before reading enough quality
                 yield (name, seq, None)  # yield a fasta record instead
                 break
+
+
+
+# Fast path for strict 4-line FASTQ as written by bcl2fastq. Input is read in
+# large blocks that are split into lines in C, batches are plain lists of
+# lines so callers can take columns with slices (lines[1::4] are sequences)
+# without building per-record objects.
+BLOCK_SIZE = 4 * 1024 * 1024
+BATCH_RECORDS = 100000
+# Number of leading records checked to decide between the fast path and the
+# generic readfq parser
+SNIFF_RECORDS = 100
+
+
+def is_strict_fastq(lines):
+    # Check that the lines form whole 4-line records with single line
+    # sequence and quality
+    num_records = len(lines) // 4
+    if not num_records:
+        return False
+    for i in xrange(0, num_records * 4, 4):
+        if lines[i][:1] != '@' or lines[i + 2][:1] != '+' or \
+                len(lines[i + 1]) != len(lines[i + 3]):
+            return False
+    return True
+
+
+def check_batch(lines):
+    separators = lines[2::4]
+    if len(lines) % 4 or (separators.count('+') != len(separators) and
+                          not all(sep[:1] == '+' for sep in separators)):
+        raise ValueError('Malformed FASTQ record near %s' % lines[0])
+
+
+def _generic_line_batches(fp, head, num_records):
+    # Regroup records from readfq into strict 4-line batches
+    lines = []
+    for name, seq, qual in readfq(itertools.chain(io.BytesIO(head), fp)):
+        if qual is None:
+            raise ValueError('FASTA record %s in FASTQ input' % name)
+        lines.extend(('@' + name, seq, '+', qual))
+        if len(lines) == 4 * num_records:
+            yield lines
+            lines = []
+    if lines:
+        yield lines
+
+
+def _sniff(fp, block_size):
+    # Read the first block, ending on a full line, and check whether the
+    # file is strict 4-line FASTQ
+    block = fp.read(block_size)
+    if not block:
+        return block, True
+    while block.count('\n') < 4 * SNIFF_RECORDS:
+        more = fp.read(block_size)
+        if not more:
+            break
+        block += more
+    if not block.endswith('\n'):
+        block += fp.readline()
+    head = block.split('\n', 4 * SNIFF_RECORDS)[:4 * SNIFF_RECORDS]
+    return block, is_strict_fastq(head)
+
+
+def read_line_batches(fp, num_records=BATCH_RECORDS, block_size=BLOCK_SIZE):
+    # Yield lists of 4 * num_records lines without newlines (the last batch
+    # may be shorter). Files that are not strict 4-line FASTQ are detected
+    # from their first records and parsed with readfq instead.
+    block, strict = _sniff(fp, block_size)
+    if not block:
+        return
+    if not strict:
+        for lines in _generic_line_batches(fp, block, num_records):
+            yield lines
+        return
+    batch_lines = 4 * num_records
+    pending = []
+    tail = ''
+    while block:
+        lines = (tail + block).split('\n')
+        tail = lines.pop()
+        pending.extend(lines)
+        while len(pending) >= batch_lines:
+            batch = pending[:batch_lines]
+            del pending[:batch_lines]
+            check_batch(batch)
+            yield batch
+        block = fp.read(block_size)
+    if tail:
+        pending.append(tail)
+    if pending:
+        check_batch(pending)
+        yield pending
+
+
+def read_chunks(fp, num_records=BATCH_RECORDS, block_size=BLOCK_SIZE):
+    # Yield raw record-aligned chunks of num_records records, used to hand
+    # whole chunks to worker processes
+    for lines in read_line_batches(fp, num_records, block_size):
+        lines.append('')
+        yield '\n'.join(lines)
+
+
+def read_record_blocks(fp, block_size=BLOCK_SIZE):
+    # Yield raw blocks of whole records of roughly block_size bytes. Unlike
+    # read_chunks the number of records per block varies, record boundaries
+    # are found with str.count and str.rfind so no lines are split here.
+    block, strict = _sniff(fp, block_size)
+    if not block:
+        return
+    if not strict:
+        for lines in _generic_line_batches(fp, block, BATCH_RECORDS):
+            lines.append('')
+            yield '\n'.join(lines)
+        return
+    tail = ''
+    while block:
+        buf = tail + block
+        end = len(buf)
+        for _ in xrange(buf.count('\n') % 4 + 1):
+            end = buf.rfind('\n', 0, end)
+        end += 1
+        tail = buf[end:]
+        if end:
+            yield buf[:end]
+        block = fp.read(block_size)
+    if tail.strip():
+        if not tail.endswith('\n'):
+            tail += '\n'
+        yield tail
+
+
+def chunk_lines(chunk):
+    # Split a chunk from read_chunks back into its lines
+    lines = chunk.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def readfq_batches(fp, batch_size=BATCH_RECORDS):
+    # Yield lists of up to batch_size (name, seq, qual) tuples, the same
+    # records readfq would produce
+    for lines in read_line_batches(fp, batch_size):
+        names = [header[1:] for header in lines[0::4]]
+        yield zip(names, lines[1::4], lines[3::4])
+
+
+def readfq_fast(fp):
+    # Drop-in replacement for readfq on FASTQ input
+    for batch in readfq_batches(fp):
+        for record in batch:
+            yield record
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+import json
+import os
+import re
+import shutil
+import sys
+from compression import is_gzipped, open_input, open_output
+from read_stats import tagged_stats
+from readfq import read_record_blocks
+
+# Re-demultiplexing of some lanes of a processed run. bcl2fastq runs on the
+# tiles of those lanes only, with the rows of the corrected sample sheet for
+# them, into a scratch folder next to the output folder. Its FASTQs then
+# replace the reads of the lanes in the output: FASTQs of samples that were
+# only in these lanes are replaced, FASTQs shared with other lanes
+# (Undetermined, samples over several lanes) keep the reads of the other
+# lanes, told apart by the lane field of the read names, and get the new
+# reads appended as further gzip members.
+
+SCRATCH_SUFFIX = '.redemux'
+# Sample name, S number, lane and read of bcl2fastq and UMI tagged FASTQs
+FASTQ_NAME = re.compile(
+    r'^(.*?)(_S[0-9]+)?(_L[0-9]{3})?(_[RI][0-9]_(?:UMI_)?001\.fastq\.gz)$')
+UNDETERMINED = 'Undetermined'
+
+
+def parse_lanes(value):
+    # '1,3' or '1-2,4' to a sorted list of lane numbers
+    lanes = set()
+    for part in value.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            lanes.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            lanes.add(int(part))
+    return sorted(lanes)
+
+
+def lane_tiles(lanes):
+    # bcl2fastq --tiles expression selecting every tile of lanes
+    return ','.join('s_%d_' % lane for lane in lanes)
+
+
+def sample_lanes(samples):
+    # {Sample_Name or Sample_ID: set of lanes}, None for samples without a
+    # lane that are in every lane
+    lanes = {}
+    for sample in samples:
+        lane = str(sample.get('Lane', '')).strip()
+        for key in ('Sample_Name', 'Sample_ID'):
+            name = sample.get(key)
+            if not name:
+                continue
+            if not lane.isdigit() or lanes.get(name, set()) is None:
+                lanes[name] = None
+            else:
+                lanes.setdefault(name, set()).add(int(lane))
+    return lanes
+
+
+def fastq_files(top_dir):
+    # {(folder relative to top_dir, sample name, read): path}
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(top_dir):
+        rel_dir = os.path.relpath(dir_path, top_dir)
+        for name in file_names:
+            match = FASTQ_NAME.match(name)
+            if match:
+                files[(rel_dir, match.group(1), match.group(4))] = \
+                    os.path.join(dir_path, name)
+    return files
+
+
+def keep_other_lanes(block, lanes):
+    # Records of a block of whole FASTQ records from lanes not in lanes
+    lines = block.split('\n')
+    kept = []
+    for i in xrange(0, len(lines) - 3, 4):
+        # @instrument:run:flowcell:lane:tile:x:y
+        fields = lines[i].split(':', 4)
+        if len(fields) < 5 or fields[3] not in lanes:
+            kept.extend(lines[i:i + 4])
+    if not kept:
+        return ''
+    kept.append('')
+    return '\n'.join(kept)
+
+
+def merge_fastq(old_path, new_path, out_path, lanes, compression):
+    # Write the reads of old_path outside lanes followed by the reads of
+    # new_path to out_path. Gzipped new reads are appended as they are.
+    lanes = set(str(lane) for lane in lanes)
+    append = new_path is not None and is_gzipped(new_path) and \
+        compression['backend'] != 'none'
+    out = open_output(out_path, compression)
+    try:
+        if old_path is not None:
+            inf = open_input(old_path, compression)
+            try:
+                for block in read_record_blocks(inf):
+                    out.write(keep_other_lanes(block, lanes))
+            finally:
+                inf.close()
+        if new_path is not None and not append:
+            inf = open_input(new_path, compression)
+            try:
+                shutil.copyfileobj(inf, out)
+            finally:
+                inf.close()
+    finally:
+        out.close()
+    if append:
+        with open(out_path, 'ab') as out:
+            with open(new_path, 'rb') as inf:
+                shutil.copyfileobj(inf, out)
+
+
+def affected(name, lanes, old_lanes, new_lanes):
+    # Whether the FASTQs of name hold reads of lanes, before or now
+    return name == UNDETERMINED or any(
+        name in by_name and (by_name[name] is None or by_name[name] & lanes)
+        for by_name in (old_lanes, new_lanes))
+
+
+def only_in_lanes(name, lanes, old_lanes, new_lanes):
+    # Whether all reads of name, before and now, are from lanes
+    if name == UNDETERMINED:
+        return False
+    sets = [by_name[name] for by_name in (old_lanes, new_lanes)
+            if name in by_name]
+    return all(lane_set is not None and lane_set <= lanes
+               for lane_set in sets)
+
+
+def merge_output(output_dir, new_dir, lanes, old_samples, new_samples,
+                 compression):
+    # Merge the FASTQs of new_dir into output_dir. FASTQs of samples that
+    # were or are now in lanes are rewritten, those only in lanes lose all
+    # their old reads and are removed if there are no new ones. Returns the
+    # relative paths written and removed.
+    lanes = set(lanes)
+    old_lanes = sample_lanes(old_samples)
+    new_lanes = sample_lanes(new_samples)
+    old_files = fastq_files(output_dir)
+    new_files = fastq_files(new_dir)
+    written = []
+    removed = []
+    keys = set(new_files) | set(key for key in old_files
+                                if affected(key[1], lanes, old_lanes,
+                                            new_lanes))
+    for key in sorted(keys):
+        rel_dir, name, read = key
+        old_path = old_files.get(key)
+        new_path = new_files.get(key)
+        if old_path is not None and only_in_lanes(name, lanes, old_lanes,
+                                                  new_lanes):
+            old_path = None
+        if old_path is None and new_path is None:
+            path = old_files[key]
+            sys.stderr.write('removing %s\n' % path)
+            os.remove(path)
+            removed.append(os.path.relpath(path, output_dir))
+            continue
+        target = old_files.get(key) or os.path.join(
+            output_dir, rel_dir, os.path.basename(new_path))
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        sys.stderr.write('merging lanes %s into %s\n' % (
+            ','.join(str(lane) for lane in sorted(lanes)), target))
+        merge_fastq(old_path, new_path, target + '.tmp', lanes, compression)
+        os.rename(target + '.tmp', target)
+        written.append(os.path.relpath(target, output_dir))
+    return written, removed
+
+
+def merge_umi_stats(project_dir, lanes, old_samples, new_samples, umi_stats,
+                    new_stats, compression):
+    # {sample folder: read statistics, None if gone} of the UMI tagged
+    # samples merge_output changed. new_stats are those of the tagged
+    # lanes, samples also in other lanes are counted again from their
+    # merged FASTQs.
+    lanes = set(lanes)
+    old_lanes = sample_lanes(old_samples)
+    new_lanes = sample_lanes(new_samples)
+    names = set(new_stats) | set(name for name in umi_stats
+                                 if affected(name, lanes, old_lanes,
+                                             new_lanes))
+    stats = {}
+    for name in names:
+        sample_dir = os.path.join(project_dir, name)
+        paths = sorted(path for (rel_dir, prefix, read), path in
+                       fastq_files(sample_dir).iteritems()
+                       if rel_dir == '.' and '_UMI_' in read)
+        if not paths:
+            stats[name] = None
+        elif name in new_stats and only_in_lanes(name, lanes, old_lanes,
+                                                 new_lanes):
+            stats[name] = new_stats[name]
+        else:
+            sys.stderr.write('counting reads of %s\n' % sample_dir)
+            stats[name] = tagged_stats(paths, compression).summary()
+    return stats
+
+
+def merge_stats(output_dir, new_dir, lanes):
+    # Replace the lanes in the bcl2fastq Stats/Stats.json of output_dir
+    path = os.path.join(output_dir, 'Stats', 'Stats.json')
+    new_path = os.path.join(new_dir, 'Stats', 'Stats.json')
+    if not os.path.isfile(path) or not os.path.isfile(new_path):
+        return
+    with open(path) as f:
+        stats = json.load(f)
+    with open(new_path) as f:
+        new_stats = json.load(f)
+    for section, key in (('ReadInfosForLanes', 'LaneNumber'),
+                         ('ConversionResults', 'LaneNumber'),
+                         ('UnknownBarcodes', 'Lane')):
+        entries = [entry for entry in stats.get(section, [])
+                   if entry.get(key) not in lanes]
+        entries.extend(entry for entry in new_stats.get(section, [])
+                       if entry.get(key) in lanes)
+        stats[section] = sorted(entries, key=lambda entry: entry.get(key))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(stats, f, indent=4, sort_keys=True)
+    os.rename(path + '.tmp', path)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+import json
+import os
+import threading
+import time
+
+# Checkpoints of the processing of a run, kept in the run folder so a
+# restarted daemon or a rerun of process_seq_run.py -i resumes at the first
+# stage that did not finish. Values stored with a stage are put back into
+# the stage state when the stage is skipped, e.g. the path of
+# run_details.json for the database stage or the read statistics of the
+# UMI tagged samples for the summaries. Checkpoints are dropped when the
+# sample sheet changes.
+STATE_NAME = 'ProcessingState.json'
+
+
+class RunState(object):
+
+    def __init__(self, run_dir):
+        self.path = os.path.join(run_dir, STATE_NAME)
+        self.lock = threading.Lock()
+        self.data = self._empty()
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except IOError:
+            pass
+        except ValueError:
+            # Unreadable checkpoints, start over
+            pass
+
+    @staticmethod
+    def _empty():
+        return {'samplesheet_md5': None, 'stages': {}, 'umi_samples': [],
+                'umi_stats': {}}
+
+    def _save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.data, f, indent=4, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+    def start(self, samplesheet_md5, restart=False):
+        # Keep the checkpoints unless the sample sheet changed or restart
+        with self.lock:
+            if restart or self.data.get('samplesheet_md5') != samplesheet_md5:
+                self.data = self._empty()
+                self.data['samplesheet_md5'] = samplesheet_md5
+                self._save()
+
+    def amend(self, samplesheet_md5, stages=()):
+        # Keep the checkpoints for a corrected sample sheet, after the run
+        # output was updated, e.g. lanes re-demultiplexed, and redo stages
+        with self.lock:
+            self.data['samplesheet_md5'] = samplesheet_md5
+            for stage in stages:
+                self.data['stages'].pop(stage, None)
+            self._save()
+
+    def done(self, stage):
+        return stage in self.data['stages']
+
+    def restore(self, stage):
+        # Values stored with the checkpoint of stage
+        values = dict(self.data['stages'][stage])
+        values.pop('time', None)
+        return dict((str(key), value) for key, value in values.iteritems())
+
+    def mark_done(self, stage, **values):
+        with self.lock:
+            values['time'] = time.time()
+            self.data['stages'][stage] = values
+            self._save()
+
+    def umi_samples(self):
+        with self.lock:
+            return set(self.data['umi_samples'])
+
+    def umi_stats(self):
+        # {sample: read statistics} of the tagged samples
+        with self.lock:
+            return dict(self.data.get('umi_stats', {}))
+
+    def update_umi_stats(self, stats):
+        # Statistics of samples tagged again, e.g. after re-demultiplexing,
+        # None for samples that are gone
+        with self.lock:
+            umi_stats = self.data.setdefault('umi_stats', {})
+            for sample, sample_stats in stats.iteritems():
+                if sample_stats is None:
+                    umi_stats.pop(sample, None)
+                else:
+                    umi_stats[sample] = sample_stats
+            if 'umi' in self.data['stages']:
+                self.data['stages']['umi']['umi_stats'] = dict(umi_stats)
+            self._save()
+
+    def mark_umi_sample(self, sample, stats=None):
+        # Called from the tagging threads as samples finish
+        with self.lock:
+            self.data['umi_samples'].append(sample)
+            if stats is not None:
+                self.data.setdefault('umi_stats', {})[sample] = stats
+            self._save()
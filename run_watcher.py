@@ -0,0 +1,156 @@
+#!/usr/bin/python
+import os
+import time
+
+# Directories in the run directory are listed again at least this often even
+# if its mtime did not change, in case a new run was missed (coarse mtime
+# resolution, NFS attribute caching)
+RESCAN_SECONDS = 3600
+# Directories without RunInfo.xml and runs that stop being written to for
+# this long are ignored until restart: output folders next to the runs,
+# aborted runs and anything else that is not a run being sequenced
+INACTIVE_HOURS = 24
+
+
+def _import_inotify():
+    # pyinotify is optional, without it the watcher only polls
+    try:
+        import pyinotify
+    except ImportError:
+        return None
+    return pyinotify
+
+
+class RunWatcher(object):
+    # Finds runs with RTAComplete.txt and without DemuxComplete.txt. The
+    # state of every run directory is cached, so a scan only stats the run
+    # directory itself and the runs still being sequenced or processed,
+    # not the whole archive. With pyinotify the watcher wakes up as soon as
+    # a run directory or RTAComplete.txt is created, otherwise it polls
+    # every poll_interval seconds. Events do not reach inotify for files
+    # written by other NFS clients, so the poll stays as a fallback.
+    # Directories are runs once they have a RunInfo.xml, until then and
+    # while sequencing they are dropped to ignored after inactive_hours
+    # without changes.
+
+    def __init__(self, datadir, poll_interval=30,
+                 inactive_hours=INACTIVE_HOURS):
+        self.datadir = datadir
+        self.poll_interval = poll_interval
+        self.inactive_seconds = inactive_hours * 3600
+        self.candidates = set()
+        self.sequencing = set()
+        self.ready = set()
+        self.done = set()
+        self.ignored = set()
+        self.dir_mtime = None
+        self.last_listing = 0
+        self.watches = {}
+        self.notifier = None
+        pyinotify = _import_inotify()
+        if pyinotify is not None:
+            self.mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+            self.watch_manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(self.watch_manager,
+                                               lambda event: None)
+            self.watch_manager.add_watch(datadir, self.mask)
+
+    def _all(self):
+        return (self.candidates, self.sequencing, self.ready, self.done,
+                self.ignored)
+
+    def _list_runs(self):
+        known = set().union(*self._all())
+        entries = set(os.path.join(self.datadir, name)
+                      for name in os.listdir(self.datadir))
+        for run_dir in entries - known:
+            if os.path.isdir(run_dir):
+                self.candidates.add(run_dir)
+            else:
+                self.ignored.add(run_dir)
+        for run_dir in known - entries:
+            self._unwatch(run_dir)
+            for runs in self._all():
+                runs.discard(run_dir)
+
+    def _last_change(self, run_dir):
+        # The run folder gets new files and the InterOp files are rewritten
+        # every cycle while a run is sequenced
+        mtime = os.stat(run_dir).st_mtime
+        interop_dir = os.path.join(run_dir, 'InterOp')
+        try:
+            names = os.listdir(interop_dir)
+        except OSError:
+            return mtime
+        for name in names:
+            try:
+                mtime = max(mtime, os.stat(os.path.join(interop_dir,
+                                                        name)).st_mtime)
+            except OSError:
+                pass
+        return mtime
+
+    def _inactive(self, run_dir, now):
+        try:
+            return now - self._last_change(run_dir) > self.inactive_seconds
+        except OSError:
+            # Removed since the listing
+            return True
+
+    def _ignore(self, run_dir, runs):
+        runs.discard(run_dir)
+        self._unwatch(run_dir)
+        self.ignored.add(run_dir)
+
+    def _watch(self, run_dir):
+        if self.notifier is not None and run_dir not in self.watches:
+            self.watches.update(self.watch_manager.add_watch(run_dir,
+                                                             self.mask))
+
+    def _unwatch(self, run_dir):
+        wd = self.watches.pop(run_dir, None)
+        if wd is not None and wd > 0:
+            self.watch_manager.rm_watch(wd, quiet=True)
+
+    def scan(self):
+        # Update the cached run states and return the runs to process
+        mtime = os.stat(self.datadir).st_mtime
+        now = time.time()
+        if mtime != self.dir_mtime or now - self.last_listing > \
+                RESCAN_SECONDS:
+            self.dir_mtime = mtime
+            self.last_listing = now
+            self._list_runs()
+        for run_dir in list(self.candidates):
+            if os.path.exists(os.path.join(run_dir, 'RTAComplete.txt')):
+                # Finished while the daemon was not watching
+                self.candidates.discard(run_dir)
+                self.ready.add(run_dir)
+            elif self._inactive(run_dir, now):
+                self._ignore(run_dir, self.candidates)
+            elif os.path.exists(os.path.join(run_dir, 'RunInfo.xml')):
+                self.candidates.discard(run_dir)
+                self.sequencing.add(run_dir)
+                self._watch(run_dir)
+        for run_dir in list(self.sequencing):
+            if os.path.exists(os.path.join(run_dir, 'RTAComplete.txt')):
+                self.sequencing.discard(run_dir)
+                self._unwatch(run_dir)
+                self.ready.add(run_dir)
+            elif self._inactive(run_dir, now):
+                # Aborted run
+                self._ignore(run_dir, self.sequencing)
+        for run_dir in list(self.ready):
+            if os.path.exists(os.path.join(run_dir, 'DemuxComplete.txt')):
+                self.ready.discard(run_dir)
+                self.done.add(run_dir)
+        return sorted(self.ready)
+
+    def wait(self):
+        # Block until something changed in the run directory or the poll
+        # interval passed
+        if self.notifier is None:
+            time.sleep(self.poll_interval)
+        elif self.notifier.check_events(self.poll_interval * 1000):
+            self.notifier.read_events()
+            self.notifier.process_events()
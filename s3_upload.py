@@ -0,0 +1,531 @@
+#!/usr/bin/python
+import base64
+import binascii
+import ConfigParser
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+MB = 2 ** 20
+
+# Upload settings, overridden from config.cfg with the s3_ prefixed keys.
+# bandwidth_mb is in MB/s over all workers, 0 means unlimited. endpoint
+# points the client at an S3 compatible store such as MinIO or moto. With
+# pipelined the FASTQs are uploaded while the run is still being processed,
+# once they have not changed for stable_seconds.
+DEFAULT_UPLOAD = {'part_size_mb': 64, 'concurrency': 8, 'bandwidth_mb': 0,
+                  'retries': 5, 'endpoint': None, 'pipelined': False,
+                  'stable_seconds': 120}
+
+# Upload state of a run, kept in the run output directory and never uploaded
+MANIFEST_NAME = '.s3_manifest.json'
+
+# Save the manifest at least this often while uploading single part files
+MANIFEST_SAVE_SECONDS = 10
+
+# Seconds between checks for finished files in pipelined mode
+PIPELINE_INTERVAL = 30
+
+
+def get_upload_options(settings):
+    options = dict(DEFAULT_UPLOAD)
+    for key in ('part_size_mb', 'concurrency', 'bandwidth_mb', 'retries',
+                'stable_seconds'):
+        if settings.get('s3_' + key):
+            options[key] = int(settings['s3_' + key])
+    if settings.get('s3_endpoint'):
+        options['endpoint'] = settings['s3_endpoint']
+    if settings.get('s3_pipelined'):
+        options['pipelined'] = settings['s3_pipelined'].lower() == 'true'
+    return options
+
+
+def read_s3cfg(s3cfg):
+    # Credentials from an s3cmd config file, an empty dict lets boto3 fall
+    # back to its own credential chain
+    if not s3cfg or not os.path.isfile(s3cfg):
+        return {}
+    config = ConfigParser.RawConfigParser()
+    config.read(s3cfg)
+    credentials = {}
+    for key, option in (('aws_access_key_id', 'access_key'),
+                        ('aws_secret_access_key', 'secret_key')):
+        if config.has_option('default', option):
+            credentials[key] = config.get('default', option)
+    return credentials
+
+
+def make_client(s3cfg, region, options):
+    import boto3
+    from botocore.config import Config
+    session = boto3.session.Session(region_name=region, **read_s3cfg(s3cfg))
+    return session.client(
+        's3', endpoint_url=options['endpoint'],
+        config=Config(max_pool_connections=options['concurrency']))
+
+
+def split_s3_url(url):
+    # s3://bucket/prefix/ -> (bucket, prefix/)
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return bucket, prefix
+
+
+def run_prefix(s3_folder, output_dir):
+    # Bucket and key prefix of a run, s3_folder/<run name>/ like s3cmd sync
+    bucket, prefix = split_s3_url(s3_folder)
+    return bucket, prefix + os.path.basename(os.path.normpath(output_dir)) + '/'
+
+
+def local_files(local_dir):
+    # Relative paths of all files to upload from local_dir
+    for root, dirs, files in os.walk(local_dir):
+        for name in sorted(files):
+            rel = os.path.relpath(os.path.join(root, name), local_dir)
+            if rel not in (MANIFEST_NAME, MANIFEST_NAME + '.tmp'):
+                yield rel
+
+
+def md5_digest(data):
+    digest = hashlib.md5(data)
+    return digest.hexdigest(), base64.b64encode(digest.digest())
+
+
+def multipart_etag(part_md5s):
+    # ETag S3 gives a multipart upload: MD5 of the binary part MD5s and the
+    # number of parts
+    digests = ''.join(binascii.unhexlify(md5) for md5 in part_md5s)
+    return '%s-%d' % (hashlib.md5(digests).hexdigest(), len(part_md5s))
+
+
+def file_etag(path, size, part_size):
+    # ETag of path as uploaded by S3Uploader with part_size, computed
+    # locally to find files that were rewritten with the same content
+    with open(path, 'rb') as f:
+        part_md5s = [hashlib.md5(data).hexdigest()
+                     for data in iter(lambda: f.read(part_size), '')]
+    if size <= part_size:
+        return part_md5s[0] if part_md5s else hashlib.md5('').hexdigest()
+    return multipart_etag(part_md5s)
+
+
+class RateLimiter(object):
+    # Paces uploads of all workers to bytes_per_second, each call reserves
+    # the time its bytes take at that rate
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_free = 0
+
+    def consume(self, num_bytes):
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_free)
+            self.next_free = start + float(num_bytes) / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class Manifest(object):
+    # Per file upload state: size, mtime and ETag of the uploaded version,
+    # the multipart upload id and the MD5 and ETag of every finished part.
+    # verified is set once S3 was checked to hold every file and reset by
+    # any upload, so an unchanged run is not listed again. Only touched from
+    # the thread collecting the worker results.
+
+    def __init__(self, path):
+        self.path = path
+        self.last_save = time.time()
+        self.files = {}
+        self.verified = False
+        if os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.files = data['files']
+            self.verified = data['verified']
+
+    def save(self, force=True):
+        if not force and \
+                time.time() - self.last_save < MANIFEST_SAVE_SECONDS:
+            return
+        self.last_save = time.time()
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'files': self.files, 'verified': self.verified}, f,
+                      indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def file_state(path, part_size):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'part_size': part_size}
+
+
+def same_file(entry, state):
+    return entry is not None and all(entry.get(key) == value
+                                     for key, value in state.iteritems())
+
+
+def same_content(entry, state, path):
+    # A finished upload of a file that was only touched, e.g. a metadata
+    # file copied again by --upload_only
+    if entry is None or not entry.get('etag') or \
+            entry.get('size') != state['size'] or \
+            entry.get('part_size') != state['part_size']:
+        return False
+    return file_etag(path, state['size'], state['part_size']) == \
+        entry['etag'].strip('"')
+
+
+class S3Uploader(object):
+    # Uploads a directory with a pool of workers. Files larger than one part
+    # are sent as multipart uploads and every part is retried on its own.
+    # The manifest records finished files and parts, so after a failure or a
+    # restart only the missing parts are uploaded again.
+
+    def __init__(self, client, bucket, options=None):
+        if options is None:
+            options = DEFAULT_UPLOAD
+        self.client = client
+        self.bucket = bucket
+        self.part_size = options['part_size_mb'] * MB
+        self.concurrency = options['concurrency']
+        self.retries = options['retries']
+        self.limiter = RateLimiter(options['bandwidth_mb'] * MB)
+
+    def _retry(self, func, **kwargs):
+        for attempt in xrange(self.retries + 1):
+            try:
+                return func(Bucket=self.bucket, **kwargs)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                time.sleep(min(2 ** attempt, 60))
+
+    def _read(self, path, offset, size):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _put_file(self, task):
+        rel, path, key, entry = task
+        try:
+            data = self._read(path, 0, entry['size'])
+            md5, content_md5 = md5_digest(data)
+            self.limiter.consume(len(data))
+            response = self._retry(self.client.put_object, Key=key,
+                                   Body=data, ContentMD5=content_md5,
+                                   ServerSideEncryption='AES256')
+            return rel, None, {'md5': md5, 'etag': response['ETag']}, None
+        except Exception as e:
+            return rel, None, None, '%s: %s' % (type(e).__name__, e)
+
+    def _put_part(self, task):
+        rel, path, key, entry, number = task
+        try:
+            data = self._read(path, (number - 1) * self.part_size,
+                              self.part_size)
+            md5, content_md5 = md5_digest(data)
+            self.limiter.consume(len(data))
+            response = self._retry(self.client.upload_part, Key=key,
+                                   UploadId=entry['upload_id'],
+                                   PartNumber=number, Body=data,
+                                   ContentMD5=content_md5)
+            return rel, number, {'md5': md5, 'etag': response['ETag']}, None
+        except Exception as e:
+            return rel, number, None, '%s: %s' % (type(e).__name__, e)
+
+    def _uploaded_parts(self, key, upload_id):
+        # Parts S3 already has for a multipart upload, None if the upload
+        # no longer exists
+        parts = {}
+        kwargs = {'Key': key, 'UploadId': upload_id}
+        try:
+            while True:
+                response = self._retry(self.client.list_parts, **kwargs)
+                for part in response.get('Parts', []):
+                    parts[str(part['PartNumber'])] = {'etag': part['ETag']}
+                if not response.get('IsTruncated'):
+                    return parts
+                kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
+        except Exception:
+            return None
+
+    def _plan_multipart(self, key, entry, state):
+        # Resume the upload in the manifest if the file did not change,
+        # otherwise start a new one. Returns the manifest entry with the
+        # parts that are already uploaded.
+        if same_file(entry, state) and entry.get('upload_id'):
+            uploaded = self._uploaded_parts(key, entry['upload_id'])
+            if uploaded is not None:
+                parts = entry.setdefault('parts', {})
+                for number in list(parts):
+                    if number not in uploaded:
+                        del parts[number]
+                for number, part in uploaded.iteritems():
+                    parts.setdefault(number, part)
+                return entry
+        if entry is not None and entry.get('upload_id'):
+            # The file changed, drop the parts of the old version
+            try:
+                self._retry(self.client.abort_multipart_upload, Key=key,
+                            UploadId=entry['upload_id'])
+            except Exception:
+                pass
+        entry = dict(state, parts={})
+        entry['upload_id'] = self._retry(
+            self.client.create_multipart_upload, Key=key,
+            ServerSideEncryption='AES256')['UploadId']
+        return entry
+
+    def _complete(self, key, entry):
+        parts = [{'PartNumber': int(number), 'ETag': part['etag']}
+                 for number, part in entry['parts'].iteritems()]
+        parts.sort(key=lambda part: part['PartNumber'])
+        response = self._retry(self.client.complete_multipart_upload,
+                               Key=key, UploadId=entry['upload_id'],
+                               MultipartUpload={'Parts': parts})
+        entry['etag'] = response['ETag']
+        entry['complete'] = True
+        del entry['upload_id']
+
+    def _prune(self, local_dir, prefix, manifest):
+        # Delete uploaded files that are gone locally, e.g. FASTQs moved to
+        # raw_data after they were uploaded by a pipelined upload
+        for rel in list(manifest.files):
+            if os.path.exists(os.path.join(local_dir, rel)):
+                continue
+            entry = manifest.files.pop(rel)
+            manifest.verified = False
+            key = prefix + rel.replace(os.sep, '/')
+            if entry.get('upload_id'):
+                self._retry(self.client.abort_multipart_upload, Key=key,
+                            UploadId=entry['upload_id'])
+            elif entry.get('complete'):
+                self._retry(self.client.delete_object, Key=key)
+
+    def verify(self, local_dir, prefix):
+        # Compare local_dir with the objects below prefix, returns a list of
+        # (file, error) for files missing in S3 or with a different size.
+        # Nothing is listed if the manifest shows no upload since the last
+        # successful check.
+        manifest = Manifest(os.path.join(local_dir, MANIFEST_NAME))
+        if manifest.verified:
+            return []
+        sizes = {}
+        kwargs = {'Prefix': prefix}
+        while True:
+            response = self._retry(self.client.list_objects_v2, **kwargs)
+            for obj in response.get('Contents', []):
+                sizes[obj['Key']] = obj['Size']
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+        errors = []
+        for rel in local_files(local_dir):
+            key = prefix + rel.replace(os.sep, '/')
+            size = os.path.getsize(os.path.join(local_dir, rel))
+            if key not in sizes:
+                errors.append((rel, 'missing in S3'))
+            elif sizes[key] != size:
+                errors.append((rel, 'size %d in S3, %d local' % (sizes[key],
+                                                                size)))
+        if not errors:
+            manifest.verified = True
+            manifest.save()
+        return errors
+
+    def upload_dir(self, local_dir, prefix, files=None, prune=False):
+        # Upload every file of local_dir, or only the relative paths in
+        # files, below prefix and return a list of (file, error) for the
+        # files that failed. With prune uploads of files that no longer
+        # exist are removed from S3.
+        manifest = Manifest(os.path.join(local_dir, MANIFEST_NAME))
+        failed = {}
+        tasks = []
+        remaining = {}
+        keys = {}
+        if prune:
+            try:
+                self._prune(local_dir, prefix, manifest)
+            except Exception as e:
+                failed[MANIFEST_NAME] = 'Pruning failed, %s: %s' % (
+                    type(e).__name__, e)
+        for rel in local_files(local_dir):
+            if files is not None and rel not in files:
+                continue
+            path = os.path.join(local_dir, rel)
+            key = prefix + rel.replace(os.sep, '/')
+            keys[rel] = key
+            state = file_state(path, self.part_size)
+            entry = manifest.files.get(rel)
+            if same_file(entry, state) and entry.get('complete'):
+                continue
+            if entry is not None and entry.get('complete') and \
+                    same_content(entry, state, path):
+                entry['mtime'] = state['mtime']
+                continue
+            manifest.verified = False
+            if state['size'] <= self.part_size:
+                entry = dict(state)
+                manifest.files[rel] = entry
+                tasks.append((self._put_file, (rel, path, key, entry)))
+                continue
+            try:
+                entry = self._plan_multipart(key, entry, state)
+            except Exception as e:
+                failed[rel] = '%s: %s' % (type(e).__name__, e)
+                continue
+            manifest.files[rel] = entry
+            num_parts = -(-state['size'] // self.part_size)
+            missing = [number for number in xrange(1, num_parts + 1)
+                       if str(number) not in entry['parts']]
+            remaining[rel] = len(missing)
+            if not missing:
+                try:
+                    self._complete(key, entry)
+                except Exception as e:
+                    failed[rel] = '%s: %s' % (type(e).__name__, e)
+            for number in missing:
+                tasks.append((self._put_part,
+                              (rel, path, key, entry, number)))
+        manifest.save()
+
+        pool = ThreadPool(processes=self.concurrency)
+        try:
+            for rel, number, result, error in pool.imap_unordered(
+                    _run_task, tasks):
+                entry = manifest.files[rel]
+                if error is not None:
+                    failed[rel] = error
+                elif number is None and result is not None:
+                    entry.update(result, complete=True)
+                elif number is not None:
+                    entry['parts'][str(number)] = result
+                    remaining[rel] -= 1
+                if rel in remaining and not remaining[rel] and \
+                        rel not in failed:
+                    try:
+                        self._complete(keys[rel], entry)
+                    except Exception as e:
+                        failed[rel] = '%s: %s' % (type(e).__name__, e)
+                manifest.save(force=number is not None)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            manifest.save()
+        return sorted(failed.items())
+
+
+def _run_task(task):
+    func, args = task
+    return func(args)
+
+
+class PipelinedUpload(threading.Thread):
+    # Uploads the files of a run matching pattern while the run is still
+    # being demultiplexed. A file counts as finished once its size and mtime
+    # did not change between two checks and it is older than
+    # stable_seconds. The final upload_run call re-uploads anything that
+    # changed later, so an early upload is never trusted blindly.
+
+    def __init__(self, uploader, local_dir, prefix, pattern='*.fastq.gz',
+                 stable_seconds=120, interval=PIPELINE_INTERVAL):
+        threading.Thread.__init__(self, name='upload ' + local_dir)
+        self.daemon = True
+        self.uploader = uploader
+        self.local_dir = local_dir
+        self.prefix = prefix
+        self.pattern = pattern
+        self.stable_seconds = stable_seconds
+        self.interval = interval
+        self.seen = {}
+        self.stopped = threading.Event()
+
+    def stable_files(self):
+        stable = set()
+        if not os.path.isdir(self.local_dir):
+            return stable
+        now = time.time()
+        seen = {}
+        for rel in local_files(self.local_dir):
+            if not fnmatch.fnmatch(os.path.basename(rel), self.pattern):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.local_dir, rel))
+            except OSError:
+                continue
+            seen[rel] = (stat.st_size, stat.st_mtime)
+            if self.seen.get(rel) == seen[rel] and \
+                    now - stat.st_mtime >= self.stable_seconds:
+                stable.add(rel)
+        self.seen = seen
+        return stable
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                files = self.stable_files()
+                if files:
+                    self.uploader.upload_dir(self.local_dir, self.prefix,
+                                             files)
+            except Exception as e:
+                sys.stderr.write('Pipelined upload of %s: %s: %s\n' % (
+                    self.local_dir, type(e).__name__, e))
+
+    def finish(self):
+        self.stopped.set()
+        self.join()
+
+
+def start_pipelined_upload(s3cfg, output_dir, s3_folder, region='us-east-1',
+                           options=None, pattern='*.fastq.gz', client=None):
+    if options is None:
+        options = DEFAULT_UPLOAD
+    if client is None:
+        client = make_client(s3cfg, region, options)
+    bucket, prefix = run_prefix(s3_folder, output_dir)
+    pipeline = PipelinedUpload(S3Uploader(client, bucket, options),
+                               output_dir, prefix, pattern,
+                               options['stable_seconds'])
+    pipeline.start()
+    return pipeline
+
+
+def upload_run(s3cfg, output_dir, s3_folder, region='us-east-1',
+               options=None, client=None, pipeline=None):
+    # Upload output_dir to s3_folder/<run name>/ like s3cmd sync and check
+    # that S3 has every file, returns the list of (file, error) that
+    # failed. A running pipelined upload is stopped first and the files it
+    # uploaded that are gone by now are removed from S3.
+    if options is None:
+        options = DEFAULT_UPLOAD
+    bucket, prefix = run_prefix(s3_folder, output_dir)
+    if pipeline is not None:
+        pipeline.finish()
+        uploader = pipeline.uploader
+    else:
+        if client is None:
+            client = make_client(s3cfg, region, options)
+        uploader = S3Uploader(client, bucket, options)
+    failed = uploader.upload_dir(output_dir, prefix,
+                                 prune=pipeline is not None)
+    if not failed:
+        try:
+            failed = uploader.verify(output_dir, prefix)
+        except Exception as e:
+            failed = [(output_dir, 'Verification failed, %s: %s' % (
+                type(e).__name__, e))]
+    for rel, error in failed:
+        sys.stderr.write('Failed to upload %s: %s\n' % (rel, error))
+    return failed
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import re
+from collections import defaultdict
+from barcode_index import encode_barcode
+
+# Parsed sheets are cached next to the sample sheet, keyed by the MD5 of its
+# content, so retries and --upload_only runs skip parsing and validation
+CACHE_NAME = '.SampleSheet.cache.json'
+CACHE_VERSION = 2
+REQUIRED_SECTIONS = ('Header', 'Reads', 'Settings', 'Data')
+INDEX_COLUMNS = ('index', 'index2')
+# Close sample pairs kept in a mismatch plan
+MAX_REPORTED_PAIRS = 50
+
+
+class SampleSheetError(Exception):
+    pass
+
+
+def _str(value):
+    # json gives unicode strings, the rest of the code works with str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_str(k), _str(v)) for k, v in value.iteritems())
+    return value
+
+
+def candidate_pairs(indexes, limit):
+    # Pairs (i, j), i < j, of equal length indexes that may be within limit
+    # mismatches. Such indexes agree exactly on at least one of limit + 1
+    # chunks, so only indexes sharing a chunk are paired instead of all.
+    length = len(indexes[0]) if indexes else 0
+    if length <= limit:
+        return [(i, j) for i in xrange(len(indexes))
+                for j in xrange(i + 1, len(indexes))]
+    bounds = [length * k // (limit + 1) for k in range(limit + 2)]
+    pairs = set()
+    for start, end in zip(bounds, bounds[1:]):
+        buckets = defaultdict(list)
+        for i, index in enumerate(indexes):
+            buckets[index[start:end]].append(i)
+        for members in buckets.itervalues():
+            for k, i in enumerate(members):
+                for j in members[k + 1:]:
+                    pairs.add((i, j))
+    return sorted(pairs)
+
+
+class SampleSheet(object):
+    # Sections of an Illumina sample sheet read in one pass. Header and
+    # Settings are dicts of the first two columns, reads the read lengths
+    # and samples one tuple per Data row in the order of fields.
+
+    def __init__(self, sections, fields, samples):
+        self.sections = sections
+        self.fields = fields
+        self.samples = samples
+        self.header = {}
+        for line in sections.get('Header', []):
+            values = line.split(',')
+            if len(values) > 1:
+                self.header[values[0]] = values[1]
+        self.settings = {}
+        for line in sections.get('Settings', []):
+            values = line.split(',')
+            if values[0]:
+                self.settings[values[0]] = values[1] if len(values) > 1 \
+                    else ''
+        self.reads = [int(length) for length in re.findall(
+            '[0-9]+', ' '.join(sections.get('Reads', [])))]
+        # Mismatch plans by their arguments
+        self.plans = {}
+        # MD5 of the file content, set by load_samplesheet
+        self.md5 = None
+
+    @classmethod
+    def parse(cls, lines):
+        sections = {}
+        section = None
+        fields = None
+        samples = []
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if line.startswith('['):
+                section = line[1:line.find(']')]
+                sections.setdefault(section, [])
+            elif section == 'Data':
+                if fields is None:
+                    fields = line.split(',')
+                elif line.strip(','):
+                    samples.append(tuple(line.split(',')))
+            elif section is not None:
+                sections[section].append(line)
+        missing = [name for name in REQUIRED_SECTIONS if name not in sections]
+        if missing or fields is None:
+            raise SampleSheetError('Sample sheet without %s section' %
+                                   ', '.join(missing or ['Data header']))
+        return cls(sections, fields, samples)
+
+    def to_dict(self):
+        return {'sections': self.sections, 'fields': self.fields,
+                'samples': self.samples, 'plans': self.plans}
+
+    @classmethod
+    def from_dict(cls, data):
+        data = _str(data)
+        sheet = cls(data['sections'], data['fields'],
+                    [tuple(sample) for sample in data['samples']])
+        sheet.plans = data['plans']
+        return sheet
+
+    def subset(self, lanes):
+        # Sheet with the Data rows of lanes, all of them without a Lane
+        # column
+        if 'Lane' not in self.fields:
+            return SampleSheet(self.sections, self.fields, self.samples)
+        column = self.fields.index('Lane')
+        lanes = set(str(lane) for lane in lanes)
+        return SampleSheet(self.sections, self.fields,
+                           [sample for sample in self.samples
+                            if column < len(sample) and
+                            sample[column].strip() in lanes])
+
+    def write(self, path):
+        # Sections in the usual order, other sections and Data rows as read
+        names = [name for name in REQUIRED_SECTIONS if name != 'Data'] + \
+            sorted(set(self.sections) - set(REQUIRED_SECTIONS))
+        with open(path, 'w') as f:
+            for name in names:
+                f.write('[%s]\n' % name)
+                for line in self.sections[name]:
+                    f.write(line + '\n')
+            f.write('[Data]\n%s\n' % ','.join(self.fields))
+            for sample in self.samples:
+                f.write(','.join(sample) + '\n')
+
+    def header_value(self, prefix):
+        # Header keys are matched on their start, 'Investigator' finds
+        # 'Investigator Name'. The last matching line wins.
+        value = None
+        for line in self.sections['Header']:
+            values = line.split(',')
+            if len(values) > 1 and values[0].startswith(prefix):
+                value = values[1]
+        return value
+
+    def sample_dicts(self):
+        annotations = self.header_value('Annotations')
+        if annotations is None:
+            return [dict(zip(self.fields, sample)) for sample in self.samples]
+        names = annotations.split('|')
+        samples = []
+        for sample in self.samples:
+            sample_data = dict(zip(self.fields[:-1], sample[:-1]))
+            sample_data['annotations'] = dict(zip(names,
+                                                  sample[-1].split('|')))
+            samples.append(sample_data)
+        return samples
+
+    def lane_indexes(self):
+        # {lane: [(Sample_ID, (index, index2))]}, the lane is '' without a
+        # Lane column. Samples without any index are left out.
+        columns = [self.fields.index(name) for name in INDEX_COLUMNS
+                   if name in self.fields]
+        lane_column = self.fields.index('Lane') if 'Lane' in self.fields \
+            else None
+        id_column = self.fields.index('Sample_ID') if 'Sample_ID' in \
+            self.fields else 0
+        lanes = {}
+        for sample in self.samples:
+            lane = sample[lane_column] if lane_column is not None and \
+                lane_column < len(sample) else ''
+            indexes = tuple(sample[c].strip() if c < len(sample) else ''
+                            for c in columns)
+            if any(indexes):
+                lanes.setdefault(lane, []).append((sample[id_column],
+                                                   indexes))
+        return lanes
+
+    def exp_details(self, path):
+        # The dict process_seq_run works with and run_details.json is
+        # written from
+        exp_details = {}
+        for key, prefix in (('investigator', 'Investigator'),
+                            ('experiment', 'Experiment'),
+                            ('description', 'Description')):
+            value = self.header_value(prefix)
+            if value is not None:
+                exp_details[key] = value.rstrip().replace(' ', '_')
+        if 'description' in exp_details:
+            experiment = exp_details.get('experiment', '')
+            created = datetime.datetime.fromtimestamp(
+                os.path.getctime(path)).isoformat()
+            if re.search('\%', experiment):
+                # Munich style samplesheet
+                exp_details['date'] = created
+            else:
+                try:
+                    exp_details['date'] = datetime.datetime.strptime(
+                        experiment.split('_')[0], '%Y%b%d').isoformat()
+                except ValueError:
+                    exp_details['date'] = created
+        annotations = self.header_value('Annotations')
+        if annotations is not None:
+            exp_details['annotations'] = annotations.split('|')
+        exp_details['read_lengths'] = [str(length) for length in self.reads]
+        exp_details['samples'] = self.sample_dicts()
+        return exp_details
+
+    def close_pairs(self, limits, lengths=None):
+        # [lane, sample, sample, distances] of samples in the same lane
+        # whose index distances are within limits in every index read.
+        # Indexes are cut to lengths, the bases bcl2fastq reads of each
+        # index read, and compared on their common prefix if they differ.
+        pairs = []
+        for lane, samples in sorted(self.lane_indexes().iteritems()):
+            read_lengths = [min(len(indexes[i]) for name, indexes in samples)
+                            for i in range(len(samples[0][1]))]
+            if lengths is not None:
+                read_lengths = [min(length, used) for length, used in
+                                zip(read_lengths, lengths)]
+            codes = [[encode_barcode(index[:length])[0] for index, length in
+                      zip(indexes, read_lengths)] for name, indexes in samples]
+            first_index = [indexes[0][:read_lengths[0]] for name, indexes in
+                           samples]
+            for i, j in candidate_pairs(first_index, limits[0]):
+                distances = []
+                for a, b, length, limit in zip(codes[i], codes[j],
+                                               read_lengths, limits):
+                    distance = length - bin(a & b).count('1')
+                    if distance > limit:
+                        break
+                    distances.append(distance)
+                else:
+                    pairs.append([lane, samples[i][0], samples[j][0],
+                                  distances])
+        return pairs
+
+    def index_reads(self, lengths=None):
+        # Number of index reads demultiplexed on, index2 only counts when a
+        # sample has one
+        lanes = self.lane_indexes().values()
+        num_columns = len([name for name in INDEX_COLUMNS
+                           if name in self.fields])
+        num_reads = 0
+        for i in range(num_columns):
+            if any(indexes[i] for samples in lanes
+                   for sample_id, indexes in samples):
+                num_reads = i + 1
+        if lengths is not None:
+            num_reads = min(num_reads, len(lengths))
+        return num_reads
+
+    def mismatch_plan(self, mismatches=None, max_mismatches=2, lengths=None):
+        # Barcode mismatches per index read for bcl2fastq. Without
+        # mismatches the largest setting up to max_mismatches without
+        # collisions is picked, preferring the same value for all reads.
+        # Samples that collide even at the picked setting, two samples with
+        # the same indexes when searching, are listed in collisions.
+        key = '%s/%s/%s' % (mismatches, max_mismatches, lengths)
+        if key in self.plans:
+            return self.plans[key]
+        num_reads = self.index_reads(lengths)
+        if mismatches is not None:
+            mismatches = (list(mismatches) + [mismatches[-1]] * num_reads)[
+                :num_reads]
+            choices = [mismatches]
+        else:
+            choices = sorted(itertools.product(range(max_mismatches + 1),
+                                               repeat=num_reads),
+                             key=lambda c: (-sum(c), max(c) - min(c)))
+        limits = [2 * max(choice[i] for choice in choices)
+                  for i in range(num_reads)]
+        pairs = self.close_pairs(limits, lengths) if num_reads else []
+        for choice in choices:
+            collisions = [pair for pair in pairs if all(
+                distance <= 2 * m for distance, m in zip(pair[3], choice))]
+            if not collisions:
+                break
+        plan = {'barcode_mismatches': list(choice),
+                'collisions': collisions,
+                # Pairs within twice the most mismatches tried, nearest
+                # first
+                'close_pairs': sorted(pairs, key=lambda p: sum(p[3]))[
+                    :MAX_REPORTED_PAIRS],
+                'num_close_pairs': len(pairs)}
+        self.plans[key] = plan
+        return plan
+
+
+def check_plan(plan):
+    # Raise SampleSheetError when the plan leaves index collisions, before
+    # bcl2fastq fails on them
+    if plan['collisions']:
+        raise SampleSheetError(
+            'Index collisions with %s barcode mismatches:\n%s' % (
+                ','.join(str(m) for m in plan['barcode_mismatches']),
+                '\n'.join('Lane %s: %s and %s' % tuple(pair[:3])
+                          for pair in plan['collisions'])))
+
+
+def load_samplesheet(path, cache=True):
+    # Parsed SampleSheet of path, from the cache if the file did not change
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.md5(content).hexdigest()
+    cache_path = os.path.join(os.path.dirname(path), CACHE_NAME)
+    if cache:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached.get('version') == CACHE_VERSION and \
+                    cached.get('md5') == digest:
+                sheet = SampleSheet.from_dict(cached['sheet'])
+                sheet.md5 = digest
+                return sheet
+        except (IOError, ValueError, KeyError):
+            pass
+    sheet = SampleSheet.parse(content.splitlines())
+    sheet.md5 = digest
+    return sheet
+
+
+def save_samplesheet_cache(path, sheet):
+    # Store sheet, including the collision checks done so far, as the cache
+    # of path. Read only run folders just don't get a cache.
+    cache_path = os.path.join(os.path.dirname(path), CACHE_NAME)
+    try:
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'md5': sheet.md5,
+                       'sheet': sheet.to_dict()}, f)
+        os.rename(cache_path + '.tmp', cache_path)
+    except (IOError, OSError):
+        pass
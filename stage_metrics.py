@@ -0,0 +1,133 @@
+#!/usr/bin/python
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Resource use of the stages of a run. CPU time and block I/O come from
+# getrusage of the daemon and its finished child processes (bcl2fastq,
+# UMI workers), so they include other runs processed at the same time.
+# ru_maxrss is a peak over the whole life of the process, peak_rss_mb is
+# the highest value seen by the end of the stage.
+
+BLOCK_BYTES = 512
+# Prometheus metric name prefix and the numeric fields exported
+PROMETHEUS_PREFIX = 'seq_run_stage_'
+PROMETHEUS_FIELDS = ('seconds', 'wait_seconds', 'cpu_seconds', 'peak_rss_mb',
+                     'read_bytes', 'write_bytes', 'records',
+                     'records_per_second', 'data_bytes', 'bytes_per_second')
+
+_write_lock = threading.Lock()
+
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'cpu_seconds': own.ru_utime + own.ru_stime + children.ru_utime +
+            children.ru_stime,
+            'read_bytes': (own.ru_inblock + children.ru_inblock) *
+            BLOCK_BYTES,
+            'write_bytes': (own.ru_oublock + children.ru_oublock) *
+            BLOCK_BYTES,
+            # kB on Linux
+            'peak_rss_mb': max(own.ru_maxrss, children.ru_maxrss) / 1024.0}
+
+
+class StageMetrics(object):
+    # Measurements of the stages of one run in the order they ran. A stage
+    # can add fields, e.g. records or data_bytes, to current while it is
+    # measured and rates are derived from them.
+
+    def __init__(self, run):
+        self.run = os.path.basename(run.rstrip('/'))
+        self.stages = []
+        self.current = None
+
+    @contextmanager
+    def measure(self, stage, wait_seconds=None):
+        record = {'stage': stage}
+        if wait_seconds is not None:
+            record['wait_seconds'] = wait_seconds
+        start = time.time()
+        before = _usage()
+        self.current = record
+        try:
+            yield record
+        except Exception:
+            record['failed'] = True
+            raise
+        finally:
+            self.current = None
+            after = _usage()
+            record['seconds'] = time.time() - start
+            for key in ('cpu_seconds', 'read_bytes', 'write_bytes'):
+                record[key] = after[key] - before[key]
+            record['peak_rss_mb'] = after['peak_rss_mb']
+            seconds = max(record['seconds'], 1e-6)
+            if record.get('records') is not None:
+                record['records_per_second'] = record['records'] / seconds
+            if record.get('data_bytes') is not None:
+                record['bytes_per_second'] = record['data_bytes'] / seconds
+            self.stages.append(record)
+            sys.stderr.write('Stage %s of %s: %.1f s, %.1f s CPU\n' % (
+                stage, self.run, record['seconds'], record['cpu_seconds']))
+
+    def stage(self, name):
+        # Last record of stage name, None if it did not run
+        for record in reversed(self.stages):
+            if record['stage'] == name:
+                return record
+        return None
+
+    def set_records(self, name, records):
+        record = self.stage(name)
+        if record is not None:
+            record['records'] = records
+            record['records_per_second'] = records / max(
+                record['seconds'], 1e-6)
+
+
+def append_metrics_log(path, metrics, status):
+    # One JSON line per run
+    line = json.dumps({'run': metrics.run, 'time': time.time(),
+                       'status': status, 'stages': metrics.stages},
+                      sort_keys=True)
+    with _write_lock:
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+
+def _prometheus_lines(metrics):
+    lines = []
+    for field in PROMETHEUS_FIELDS:
+        name = PROMETHEUS_PREFIX + field
+        samples = [(record['stage'], record[field]) for record in
+                   metrics.stages if record.get(field) is not None]
+        if not samples:
+            continue
+        lines.append('# TYPE %s gauge' % name)
+        for stage, value in samples:
+            lines.append('%s{run="%s",stage="%s"} %r' % (
+                name, metrics.run, stage, float(value)))
+    return lines
+
+
+def textfile_path(path, run):
+    # One file per run next to path, runs processed at the same time would
+    # overwrite each other in a single file. path.prom becomes
+    # path_<run>.prom, the collector reads every .prom file.
+    root, ext = os.path.splitext(path)
+    return '%s_%s%s' % (root, run, ext or '.prom')
+
+
+def write_textfile(path, metrics):
+    # Prometheus textfile collector file with the stages of the run,
+    # replaced atomically so the collector never reads half a file
+    path = textfile_path(path, metrics.run)
+    with _write_lock:
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(_prometheus_lines(metrics)) + '\n')
+        os.rename(path + '.tmp', path)
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+import argparse
+import os
+import random
+import struct
+from compression import open_output
+
+# Deterministic synthetic run data for benchmark.py: FASTQs with UMIs in the
+# layouts of AddUmiNugen and AddUmiNEB, Undetermined FASTQs with barcode
+# errors, a SampleSheet.csv and the InterOp binaries the summaries are
+# computed from. The same seed always gives the same files.
+
+BASES = 'ACGT'
+# Random bases that reads are cut from, cheaper than drawing every base
+POOL_BASES = 1 << 20
+GENERATE_COMPRESSION = {'backend': 'zlib', 'level': 1, 'threads': 1}
+# Share of Undetermined reads by origin: sample barcodes with sequencing
+# errors, index hopping (i7 and i5 of different samples), poly-G of
+# two-colour chemistry without signal and unrelated random barcodes
+UNDETERMINED_MIX = (('error', 0.6), ('hopped', 0.2), ('polyg', 0.1),
+                    ('random', 0.1))
+
+
+class SequenceSource(object):
+    # Random sequences and qualities from a seeded generator
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.pool = ''.join(self.rng.choice(BASES)
+                            for _ in xrange(POOL_BASES))
+        self.quals = ''.join(chr(self.rng.choice((35, 37, 40, 41)) + 33)
+                             for _ in xrange(4096))
+
+    def seq(self, length):
+        start = self.rng.randrange(POOL_BASES - length)
+        return self.pool[start:start + length]
+
+    def qual(self, length):
+        start = self.rng.randrange(len(self.quals) - length)
+        return self.quals[start:start + length]
+
+    def mutate(self, seq, errors):
+        seq = list(seq)
+        for pos in self.rng.sample(xrange(len(seq)), min(errors, len(seq))):
+            seq[pos] = self.rng.choice([b for b in BASES + 'N'
+                                        if b != seq[pos]])
+        return ''.join(seq)
+
+
+def read_name(i, read, barcode):
+    return '@SYN:1:FLOWCELL:1:%d:%d:%d %d:N:0:%s' % (
+        1101 + i % 50, i % 30000, i // 30000, read, barcode)
+
+
+def write_fastq(path, records, compression=GENERATE_COMPRESSION):
+    out = open_output(path, compression)
+    try:
+        for name, seq, qual in records:
+            out.write('%s\n%s\n+\n%s\n' % (name, seq, qual))
+    finally:
+        out.close()
+
+
+def make_barcodes(seed, num_samples, length=8):
+    # num_samples distinct (i7, i5) pairs at least 3 apart in i7
+    rng = random.Random(seed)
+    barcodes = []
+    seen = set()
+    while len(barcodes) < num_samples:
+        i7 = ''.join(rng.choice(BASES) for _ in range(length))
+        if i7 in seen or any(sum(a != b for a, b in zip(i7, other)) < 3
+                             for other, i5 in barcodes[-64:]):
+            continue
+        seen.add(i7)
+        barcodes.append((i7, ''.join(rng.choice(BASES)
+                                     for _ in range(length))))
+    return barcodes
+
+
+def write_umi_sample(sample_dir, name, num_reads, seed, single_end=False,
+                     read_length=100, umi_length=12):
+    # bcl2fastq style sample folder for AddUmiNugen, R2 holds the UMIs and
+    # R3 the second read of pairs
+    source = SequenceSource(seed)
+    if not os.path.isdir(sample_dir):
+        os.makedirs(sample_dir)
+    reads = (('R1', read_length, 1), ('R2', umi_length, 2))
+    if not single_end:
+        reads += (('R3', read_length, 3),)
+    paths = []
+    for read, length, number in reads:
+        path = os.path.join(sample_dir, '%s_S1_L001_%s_001.fastq.gz' % (
+            name, read))
+        write_fastq(path, ((read_name(i, number, 'ACGTACGT'),
+                            source.seq(length), source.qual(length))
+                           for i in xrange(num_reads)))
+        paths.append(path)
+    return paths
+
+
+def write_neb_sample(sample_dir, name, num_reads, seed, read_length=100,
+                     umi_length=12):
+    # Picard IlluminaBasecallsToFastq style files for AddUmiNEB
+    source = SequenceSource(seed)
+    if not os.path.isdir(sample_dir):
+        os.makedirs(sample_dir)
+    paths = []
+    for suffix, length, number in (('1.fastq.gz', read_length, 1),
+                                   ('2.fastq.gz', read_length, 2),
+                                   ('index.fastq.gz', umi_length, 2)):
+        path = os.path.join(sample_dir, '%s_L001_R1.%s' % (name, suffix))
+        write_fastq(path, ((read_name(i, number, 'ACGTACGT'),
+                            source.seq(length), source.qual(length))
+                           for i in xrange(num_reads)))
+        paths.append(path)
+    return paths
+
+
+def undetermined_barcode(source, barcodes):
+    draw = source.rng.random()
+    for origin, share in UNDETERMINED_MIX:
+        if draw < share:
+            break
+        draw -= share
+    length = len(barcodes[0][0])
+    if origin == 'error':
+        i7, i5 = source.rng.choice(barcodes)
+        # Mostly one error, fewer with two or three
+        errors = 1 + int(source.rng.expovariate(1.5))
+        if source.rng.random() < 0.5:
+            i7 = source.mutate(i7, errors)
+        else:
+            i5 = source.mutate(i5, errors)
+    elif origin == 'hopped':
+        i7 = source.rng.choice(barcodes)[0]
+        i5 = source.rng.choice(barcodes)[1]
+    elif origin == 'polyg':
+        i7, i5 = 'G' * length, source.seq(length)
+    else:
+        i7, i5 = source.seq(length), source.seq(length)
+    return i7 + '+' + i5
+
+
+def write_undetermined(path, barcodes, num_reads, seed, read_length=100):
+    source = SequenceSource(seed)
+    write_fastq(path, ((read_name(i, 1, undetermined_barcode(source,
+                                                             barcodes)),
+                        source.seq(read_length), source.qual(read_length))
+                       for i in xrange(num_reads)))
+    return path
+
+
+def write_samplesheet(path, barcodes, lanes=1, project='Project1'):
+    with open(path, 'w') as f:
+        f.write('[Header],,,,,,\nIEMFileVersion,4,,,,,\n'
+                'Investigator Name,Synthetic,,,,,\n'
+                'Experiment Name,2024Jan01_synthetic,,,,,\n'
+                'Date,1/1/2024,,,,,\nDescription,benchmark,,,,,\n,,,,,,\n'
+                '[Reads],,,,,,\n100,,,,,,\n100,,,,,,\n,,,,,,\n'
+                '[Settings],,,,,,\n,,,,,,\n[Data],,,,,,\n'
+                'Lane,Sample_ID,Sample_Name,index,index2,Sample_Project,'
+                'Description\n')
+        for lane in range(1, lanes + 1):
+            for i, (i7, i5) in enumerate(barcodes):
+                f.write('%d,%d,Sample%d,%s,%s,%s,\n' % (lane, i + 1, i + 1,
+                                                        i7, i5, project))
+    return path
+
+
+def write_run_info(run_dir, lanes, read_cycles=(100, 8, 8, 100)):
+    with open(os.path.join(run_dir, 'RunInfo.xml'), 'w') as f:
+        f.write('<?xml version="1.0"?>\n<RunInfo><Run><Reads>\n')
+        for i, cycles in enumerate(read_cycles):
+            f.write('<Read Number="%d" NumCycles="%d" IsIndexedRead="%s"/>'
+                    '\n' % (i + 1, cycles, 'Y' if cycles <= 12 else 'N'))
+        f.write('</Reads><FlowcellLayout LaneCount="%d"/></Run></RunInfo>\n'
+                % lanes)
+
+
+def write_interop(run_dir, barcodes, lanes=2, tiles=48, seed=0,
+                  read_cycles=(100, 8, 8, 100)):
+    # TileMetricsOut.bin v2, QMetricsOut.bin v6 with 3 bins,
+    # ErrorMetricsOut.bin v3 and IndexMetricsOut.bin v1
+    rng = random.Random(seed)
+    interop_dir = os.path.join(run_dir, 'InterOp')
+    if not os.path.isdir(interop_dir):
+        os.makedirs(interop_dir)
+    write_run_info(run_dir, lanes, read_cycles)
+    tile_ids = [1101 + (t // 24) * 1000 + t % 24 for t in range(tiles)]
+    cycles = sum(read_cycles)
+    with open(os.path.join(interop_dir, 'TileMetricsOut.bin'), 'wb') as f:
+        f.write(struct.pack('<BB', 2, 10))
+        for lane in range(1, lanes + 1):
+            for tile in tile_ids:
+                count = rng.uniform(3e6, 4e6)
+                for code, value in ((100, count / 1.6), (101, count / 1.9),
+                                    (102, count), (103, count * 0.85),
+                                    (300, rng.uniform(0.5, 1.5)),
+                                    (303, rng.uniform(0.5, 1.5))):
+                    f.write(struct.pack('<HHHf', lane, tile, code, value))
+    bins = ((1, 9, 7), (10, 29, 20), (30, 41, 37))
+    with open(os.path.join(interop_dir, 'QMetricsOut.bin'), 'wb') as f:
+        f.write(struct.pack('<BBBB', 6, 6 + 4 * len(bins), 1, len(bins)))
+        for column in range(3):
+            f.write(''.join(chr(b[column]) for b in bins))
+        for lane in range(1, lanes + 1):
+            for tile in tile_ids:
+                for cycle in range(1, cycles + 1):
+                    good = int(rng.uniform(8e5, 9.5e5))
+                    f.write(struct.pack('<HHH3I', lane, tile, cycle, 20000,
+                                        1000000 - good - 20000, good))
+    with open(os.path.join(interop_dir, 'ErrorMetricsOut.bin'), 'wb') as f:
+        f.write(struct.pack('<BB', 3, 30))
+        for lane in range(1, lanes + 1):
+            for tile in tile_ids:
+                for cycle in range(1, cycles + 1):
+                    f.write(struct.pack('<HHHf5I', lane, tile, cycle,
+                                        rng.uniform(0.1, 1.0), 0, 0, 0, 0,
+                                        0))
+    with open(os.path.join(interop_dir, 'IndexMetricsOut.bin'), 'wb') as f:
+        f.write('\x01')
+        for lane in range(1, lanes + 1):
+            for tile in tile_ids:
+                for i, (i7, i5) in enumerate(barcodes):
+                    index = i7 + '+' + i5
+                    sample = str(i + 1)
+                    f.write(struct.pack('<HHHH', lane, tile, 1, len(index)) +
+                            index + struct.pack('<IH', rng.randint(500, 5000),
+                                                len(sample)) +
+                            sample + struct.pack('<H', 8) + 'Project1')
+    return interop_dir
+
+
+def make_run(out_dir, reads=200000, samples=384, lanes=2, tiles=48, seed=1):
+    # Write a complete synthetic data set to out_dir, returns the paths
+    barcodes = make_barcodes(seed, samples)
+    paths = {'run': os.path.join(out_dir, 'run'),
+             'umi_pe': os.path.join(out_dir, 'umi_pe'),
+             'umi_se': os.path.join(out_dir, 'umi_se'),
+             'neb': os.path.join(out_dir, 'neb'),
+             'undetermined': os.path.join(
+                 out_dir, 'Undetermined_S0_L001_R1_001.fastq.gz')}
+    if not os.path.isdir(paths['run']):
+        os.makedirs(paths['run'])
+    paths['samplesheet'] = write_samplesheet(
+        os.path.join(paths['run'], 'SampleSheet.csv'), barcodes, lanes)
+    write_interop(paths['run'], barcodes, lanes, tiles, seed)
+    write_umi_sample(paths['umi_pe'], 'Sample1', reads, seed)
+    write_umi_sample(paths['umi_se'], 'Sample1', reads, seed,
+                     single_end=True)
+    write_neb_sample(paths['neb'], 'Sample1', reads, seed)
+    write_undetermined(paths['undetermined'], barcodes, reads, seed)
+    return paths
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Write a deterministic synthetic run data set')
+    parser.add_argument('-o', '--output_dir', required=True)
+    parser.add_argument('-r', '--reads', type=int, default=200000,
+                        help='Reads per FASTQ')
+    parser.add_argument('-s', '--samples', type=int, default=384)
+    parser.add_argument('-l', '--lanes', type=int, default=2)
+    parser.add_argument('-t', '--tiles', type=int, default=48,
+                        help='Tiles per lane in the InterOp files')
+    parser.add_argument('--seed', type=int, default=1)
+
+    opts = parser.parse_args()
+    for name, path in sorted(make_run(opts.output_dir, opts.reads,
+                                      opts.samples, opts.lanes, opts.tiles,
+                                      opts.seed).iteritems()):
+        print '%s\t%s' % (name, path)
@@ -0,0 +1,87 @@
+import pytest
+from barcode_index import BarcodeIndex, encode_barcode
+from synthetic_run import SequenceSource, make_barcodes, undetermined_barcode
+
+
+def distance(a, b):
+    # Mismatches of equal length barcodes, N never matches
+    return sum(x != y or x not in 'ACGT' for x, y in zip(a, b))
+
+
+def brute_nearest(barcodes, barcode):
+    # Closest other barcode of the same length, first in sorted order
+    query = barcode.replace('+', '')
+    best = (None, None)
+    for name in sorted(barcodes):
+        bases = name.replace('+', '')
+        if len(bases) != len(query):
+            continue
+        d = distance(bases, query)
+        if 0 < d and (best[0] is None or d < best[0]):
+            best = (d, name)
+    return best
+
+
+@pytest.fixture(scope='module')
+def sample_barcodes():
+    return ['%s+%s' % pair for pair in make_barcodes(5, 96)]
+
+
+@pytest.fixture(scope='module')
+def queries(sample_barcodes):
+    # Undetermined barcodes: sample barcodes with errors and N, hopped
+    # pairs, poly-G and random ones
+    source = SequenceSource(5)
+    pairs = [barcode.split('+') for barcode in sample_barcodes]
+    return [undetermined_barcode(source, pairs) for _ in xrange(3000)]
+
+
+def test_encode_ignores_separator_and_n():
+    assert encode_barcode('ACGT+ACGT') == encode_barcode('ACGTACGT')
+    assert encode_barcode('NNNN')[0] == 0
+    code, length = encode_barcode('ANGT')
+    assert length == 4
+    assert bin(code & encode_barcode('ACGT')[0]).count('1') == 3
+
+
+def test_nearest_matches_brute_force(sample_barcodes, queries):
+    index = BarcodeIndex(sample_barcodes)
+    assert any('N' in query for query in queries)
+    for query in set(queries):
+        assert index.nearest(query) == brute_nearest(sample_barcodes, query)
+
+
+def test_nearest_ignores_exact_match(sample_barcodes):
+    index = BarcodeIndex(sample_barcodes)
+    barcode = sample_barcodes[0]
+    assert barcode in index
+    distance, nearest = index.nearest(barcode)
+    assert nearest != barcode
+    assert (distance, nearest) == brute_nearest(sample_barcodes, barcode)
+
+
+@pytest.mark.parametrize('query', ['ACGTNCGT', 'NNNNNNNN', 'ACGTACGA'])
+def test_nearest_with_n(query):
+    index = BarcodeIndex(['ACGTACGT', 'TTTTTTTT', 'ACGTTCGT'])
+    assert index.nearest(query) == brute_nearest(index.barcodes, query)
+
+
+def test_n_never_matches():
+    index = BarcodeIndex(['ACGTACGT', 'GGGGGGGG'])
+    assert index.nearest('ACGTACGN') == (1, 'ACGTACGT')
+    assert index.nearest('NNNNNNNN') == (8, 'ACGTACGT')
+
+
+def test_other_lengths():
+    index = BarcodeIndex(['ACGTACGT', 'ACGTAC'])
+    assert index.nearest('ACGTACG') == (None, None)
+    assert index.nearest('ACGTAC') == (None, None)
+    assert index.nearest('ACGTAA') == (1, 'ACGTAC')
+
+
+def test_search(sample_barcodes, queries):
+    index = BarcodeIndex(sample_barcodes)
+    results = index.search(queries[:200])
+    assert set(results) == set(queries[:200])
+    for query, result in results.iteritems():
+        assert result == index.nearest(query)
@@ -0,0 +1,101 @@
+import os
+import pytest
+from interop import (read_index_metrics, read_q_metrics, run_summary,
+                     tile_layout)
+from live_qc import InterOpTail
+from synthetic_run import make_barcodes, write_interop
+
+BARCODES = make_barcodes(3, 4)
+LANES = 2
+TILES = 6
+
+
+@pytest.fixture
+def run_dir(tmpdir):
+    write_interop(str(tmpdir), BARCODES, LANES, TILES, seed=5)
+    return str(tmpdir)
+
+
+def interop_path(run_dir, name):
+    return os.path.join(run_dir, 'InterOp', name)
+
+
+def set_version(path, version):
+    # Rewrite the version byte in place, the inode stays the same
+    with open(path, 'r+b') as f:
+        f.write(chr(version))
+
+
+def test_run_summary(run_dir):
+    read_summary, lane_summary = run_summary(run_dir)
+    assert [row['Level'] for row in read_summary] == [
+        'Read 1', 'Read 2 (I)', 'Read 3 (I)', 'Read 4', 'Non-indexed',
+        'Total']
+    assert [(row['Lane'], row['Read']) for row in lane_summary] == [
+        (str(lane), read) for lane in range(1, LANES + 1)
+        for read in ('Read 1', 'Read 2 (I)', 'Read 3 (I)', 'Read 4')]
+    for row in lane_summary:
+        assert row['Tiles'] == str(TILES)
+        assert 84.0 < float(row['Cluster PF%'].split()[0]) < 86.0
+        assert 80.0 < float(row['%>=Q30']) < 95.0
+
+
+def test_truncated_records_are_ignored(run_dir):
+    # A run still sequencing can end in a partly written record
+    expected = run_summary(run_dir)
+    for name in ('TileMetricsOut.bin', 'QMetricsOut.bin',
+                 'ErrorMetricsOut.bin'):
+        with open(interop_path(run_dir, name), 'ab') as f:
+            f.write('\x01\x00\x03')
+    assert run_summary(run_dir) == expected
+
+
+def test_index_metrics(run_dir):
+    rows = read_index_metrics(run_dir)
+    assert len(rows) == LANES * TILES * len(BARCODES)
+    lane, tile, read, index, sample, project, count = rows[0]
+    assert (lane, tile, read) == (1, 1101, 1)
+    assert index == '+'.join(BARCODES[0])
+    assert (sample, project) == ('1', 'Project1')
+    assert 500 <= count <= 5000
+
+
+def test_unsupported_tile_metrics(run_dir):
+    set_version(interop_path(run_dir, 'TileMetricsOut.bin'), 9)
+    with pytest.raises(ValueError):
+        run_summary(run_dir)
+
+
+def test_missing_tile_metrics(run_dir):
+    os.remove(interop_path(run_dir, 'TileMetricsOut.bin'))
+    with pytest.raises(ValueError):
+        run_summary(run_dir)
+
+
+def test_unsupported_metrics_are_skipped(run_dir):
+    set_version(interop_path(run_dir, 'QMetricsOut.bin'), 9)
+    set_version(interop_path(run_dir, 'IndexMetricsOut.bin'), 9)
+    assert read_q_metrics(run_dir, {}) == {}
+    assert read_index_metrics(run_dir) == []
+    read_summary, lane_summary = run_summary(run_dir)
+    assert all(row['Yield'] == '0.00' for row in lane_summary)
+
+
+def test_tail_unsupported_tile_metrics(run_dir):
+    path = interop_path(run_dir, 'TileMetricsOut.bin')
+    records = InterOpTail(path, tile_layout).new_records()
+    assert len(records) == LANES * TILES * 6
+    set_version(path, 9)
+    tail = InterOpTail(path, tile_layout)
+    assert tail.new_records() == []
+    with open(path, 'ab') as f:
+        f.write('\0' * 80)
+    assert tail.new_records() == []
+    # A replaced file is followed again
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path + '.tmp', 'wb') as f:
+        f.write('\x02' + data[1:-80])
+    os.rename(path + '.tmp', path)
+    assert tail.new_records() == records
+    assert tail.restarted
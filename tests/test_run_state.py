@@ -0,0 +1,100 @@
+import json
+import os
+import pytest
+from run_state import STATE_NAME, RunState
+from samplesheet import load_samplesheet
+from synthetic_run import make_barcodes, write_samplesheet
+
+BARCODES = make_barcodes(5, 8)
+
+
+@pytest.fixture
+def run_dir(tmpdir):
+    write_samplesheet(str(tmpdir.join('SampleSheet.csv')), BARCODES)
+    return str(tmpdir)
+
+
+def sheet_md5(run_dir):
+    return load_samplesheet(os.path.join(run_dir, 'SampleSheet.csv'),
+                            cache=False).md5
+
+
+def edit_samplesheet(run_dir):
+    write_samplesheet(os.path.join(run_dir, 'SampleSheet.csv'),
+                      BARCODES[:-1])
+
+
+def test_resume(run_dir):
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    state.mark_done('demux', demux_plan={'barcode_mismatches': [1, 1]})
+    state.mark_umi_sample('Sample1', {'reads': 10})
+    # A restarted daemon finds the checkpoints
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    assert state.done('demux') and not state.done('umi')
+    assert state.restore('demux') == {
+        'demux_plan': {'barcode_mismatches': [1, 1]}}
+    assert all(isinstance(key, str) for key in state.restore('demux'))
+    assert state.umi_samples() == set(['Sample1'])
+    assert state.umi_stats() == {'Sample1': {'reads': 10}}
+
+
+def test_changed_samplesheet_starts_over(run_dir):
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    state.mark_done('demux')
+    state.mark_umi_sample('Sample1')
+    edit_samplesheet(run_dir)
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    assert not state.done('demux')
+    assert state.umi_samples() == set()
+    with open(os.path.join(run_dir, STATE_NAME)) as f:
+        assert json.load(f)['samplesheet_md5'] == sheet_md5(run_dir)
+
+
+def test_restart(run_dir):
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    state.mark_done('demux')
+    state.start(sheet_md5(run_dir), restart=True)
+    assert not state.done('demux')
+    assert not RunState(run_dir).done('demux')
+
+
+def test_amend_keeps_other_stages(run_dir):
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    for stage in ('demux', 'umi', 'report', 'database'):
+        state.mark_done(stage)
+    edit_samplesheet(run_dir)
+    state.amend(sheet_md5(run_dir), ['report', 'database'])
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    assert [stage for stage in ('demux', 'umi', 'report', 'database')
+            if state.done(stage)] == ['demux', 'umi']
+
+
+def test_update_umi_stats(run_dir):
+    state = RunState(run_dir)
+    state.start(sheet_md5(run_dir))
+    state.mark_umi_sample('Sample1', {'reads': 10})
+    state.mark_umi_sample('Sample2', {'reads': 20})
+    state.mark_done('umi', umi_stats=state.umi_stats())
+    # Sample2 was dropped from the sheet, Sample1 tagged again
+    state.update_umi_stats({'Sample1': {'reads': 12}, 'Sample2': None})
+    expected = {'Sample1': {'reads': 12}}
+    assert state.umi_stats() == expected
+    assert state.restore('umi') == {'umi_stats': expected}
+    assert RunState(run_dir).restore('umi') == {'umi_stats': expected}
+
+
+def test_unreadable_state(run_dir):
+    with open(os.path.join(run_dir, STATE_NAME), 'w') as f:
+        f.write('{"stages": {"demux"')
+    state = RunState(run_dir)
+    assert not state.done('demux')
+    state.start(sheet_md5(run_dir))
+    state.mark_done('demux')
+    assert RunState(run_dir).done('demux')
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import pytest
+from s3_upload import (DEFAULT_UPLOAD, MANIFEST_NAME, S3Uploader, file_etag,
+                       multipart_etag)
+from synthetic_run import write_umi_sample
+
+OPTIONS = dict(DEFAULT_UPLOAD, concurrency=2, retries=0)
+# Smaller than S3 allows, so the synthetic FASTQs of about 1 MB have parts
+PART_SIZE = 256 * 1024
+PREFIX = 'runs/run1/'
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+class FakeS3(object):
+    # In memory bucket with the calls S3Uploader makes. Parts in fail_parts,
+    # (key, part number), are refused once like a dropped connection.
+
+    def __init__(self, fail_parts=()):
+        self.objects = {}
+        self.uploads = {}
+        self.fail_parts = set(fail_parts)
+        self.calls = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append(('put_object', Key, None))
+        self.objects[Key] = Body
+        return {'ETag': '"%s"' % md5(Body)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = 'upload%d' % len(self.calls)
+        self.calls.append(('create_multipart_upload', Key, None))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.calls.append(('upload_part', Key, PartNumber))
+        if (Key, PartNumber) in self.fail_parts:
+            self.fail_parts.remove((Key, PartNumber))
+            raise IOError('Connection reset')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"%s"' % md5(Body)}
+
+    def list_parts(self, Bucket, Key, UploadId, **kwargs):
+        if UploadId not in self.uploads:
+            raise KeyError('NoSuchUpload')
+        return {'Parts': [{'PartNumber': number, 'ETag': '"%s"' % md5(body)}
+                          for number, body in
+                          sorted(self.uploads[UploadId].iteritems())]}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        assert numbers == range(1, len(parts) + 1)
+        self.objects[Key] = ''.join(parts[number] for number in numbers)
+        return {'ETag': '"%s"' % multipart_etag(
+            [md5(parts[number]) for number in numbers])}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(('abort_multipart_upload', Key, None))
+        self.uploads.pop(UploadId, None)
+
+    def list_objects_v2(self, Bucket, Prefix, **kwargs):
+        return {'Contents': [{'Key': key, 'Size': len(body)}
+                             for key, body in sorted(self.objects.iteritems())
+                             if key.startswith(Prefix)]}
+
+
+def make_uploader(client):
+    uploader = S3Uploader(client, 'bucket', OPTIONS)
+    uploader.part_size = PART_SIZE
+    return uploader
+
+
+@pytest.fixture
+def run_dir(tmpdir):
+    # A UMI sample with R1 and R3 of a few parts and a small R2
+    sample_dir = str(tmpdir.join('Project1', 'Sample1'))
+    write_umi_sample(sample_dir, 'Sample1', 12000, 7)
+    with open(str(tmpdir.join('run_details.json')), 'w') as f:
+        f.write('{}\n')
+    return str(tmpdir)
+
+
+def key_of(rel):
+    return PREFIX + rel
+
+
+def fastq(name):
+    return 'Project1/Sample1/Sample1_S1_L001_%s_001.fastq.gz' % name
+
+
+def assert_uploaded(client, run_dir):
+    for root, dirs, files in os.walk(run_dir):
+        for name in files:
+            rel = os.path.relpath(os.path.join(root, name), run_dir)
+            if rel == MANIFEST_NAME:
+                assert key_of(rel) not in client.objects
+                continue
+            with open(os.path.join(root, name), 'rb') as f:
+                assert client.objects[key_of(rel)] == f.read()
+
+
+def test_files_span_parts(run_dir):
+    sizes = [os.path.getsize(os.path.join(run_dir, fastq(name)))
+             for name in ('R1', 'R2', 'R3')]
+    assert sizes[0] > 2 * PART_SIZE and sizes[2] > 2 * PART_SIZE
+    assert sizes[1] < PART_SIZE
+
+
+def test_resume_failed_parts(run_dir):
+    client = FakeS3([(key_of(fastq('R1')), 2), (key_of(fastq('R3')), 1)])
+    uploader = make_uploader(client)
+    failed = uploader.upload_dir(run_dir, PREFIX)
+    assert [rel for rel, error in failed] == [fastq('R1'), fastq('R3')]
+    assert key_of(fastq('R1')) not in client.objects
+    with open(os.path.join(run_dir, MANIFEST_NAME)) as f:
+        manifest = json.load(f)['files']
+    assert '2' not in manifest[fastq('R1')]['parts']
+    assert manifest[fastq('R1')]['upload_id']
+    # Only the failed parts are sent again
+    client.calls = []
+    assert uploader.upload_dir(run_dir, PREFIX) == []
+    assert sorted(client.calls) == [
+        ('upload_part', key_of(fastq('R1')), 2),
+        ('upload_part', key_of(fastq('R3')), 1)]
+    assert_uploaded(client, run_dir)
+    assert client.uploads == {}
+    # Nothing left to do, the ETags match the local files
+    client.calls = []
+    assert uploader.upload_dir(run_dir, PREFIX) == []
+    assert client.calls == []
+    assert uploader.verify(run_dir, PREFIX) == []
+    with open(os.path.join(run_dir, MANIFEST_NAME)) as f:
+        entry = json.load(f)['files'][fastq('R1')]
+    path = os.path.join(run_dir, fastq('R1'))
+    assert entry['etag'].strip('"') == file_etag(
+        path, os.path.getsize(path), PART_SIZE)
+
+
+def test_changed_file_restarts_upload(run_dir):
+    client = FakeS3([(key_of(fastq('R1')), 1)])
+    uploader = make_uploader(client)
+    assert uploader.upload_dir(run_dir, PREFIX) != []
+    with open(os.path.join(run_dir, fastq('R1')), 'ab') as f:
+        f.write('\0' * 1000)
+    client.calls = []
+    assert uploader.upload_dir(run_dir, PREFIX) == []
+    calls = [call for call in client.calls if call[1] == key_of(fastq('R1'))]
+    assert calls[0][0] == 'abort_multipart_upload'
+    assert calls[1][0] == 'create_multipart_upload'
+    assert sorted(number for method, key, number in calls
+                  if method == 'upload_part') == [1, 2, 3, 4]
+    assert_uploaded(client, run_dir)
+
+
+def test_expired_upload_restarts(run_dir):
+    client = FakeS3([(key_of(fastq('R3')), 3)])
+    uploader = make_uploader(client)
+    assert uploader.upload_dir(run_dir, PREFIX) != []
+    # The store dropped the unfinished upload, e.g. by a lifecycle rule
+    client.uploads.clear()
+    assert uploader.upload_dir(run_dir, PREFIX) == []
+    assert_uploaded(client, run_dir)
+
+
+def test_touched_file_is_not_uploaded_again(run_dir):
+    client = FakeS3()
+    uploader = make_uploader(client)
+    assert uploader.upload_dir(run_dir, PREFIX) == []
+    path = os.path.join(run_dir, 'run_details.json')
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    client.calls = []
+    assert uploader.upload_dir(run_dir, PREFIX) == []
+    assert client.calls == []
@@ -0,0 +1,133 @@
+import os
+import pytest
+from samplesheet import (CACHE_NAME, SampleSheet, SampleSheetError,
+                         check_plan, load_samplesheet,
+                         save_samplesheet_cache)
+from synthetic_run import make_barcodes, write_samplesheet
+
+BARCODES = make_barcodes(11, 12)
+
+
+@pytest.fixture
+def sheet_path(tmpdir):
+    return write_samplesheet(str(tmpdir.join('SampleSheet.csv')), BARCODES,
+                             lanes=2)
+
+
+def read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def add_sample(path, lane, sample_id, i7, i5):
+    with open(path, 'a') as f:
+        f.write('%d,%s,Sample%s,%s,%s,Project1,\n' % (lane, sample_id,
+                                                      sample_id, i7, i5))
+
+
+def test_parse(sheet_path):
+    sheet = load_samplesheet(sheet_path, cache=False)
+    assert sheet.reads == [100, 100]
+    assert sheet.header['Investigator Name'] == 'Synthetic'
+    assert sheet.fields[:4] == ['Lane', 'Sample_ID', 'Sample_Name', 'index']
+    assert len(sheet.samples) == 2 * len(BARCODES)
+    assert sheet.lane_indexes()['2'][0] == ('1', BARCODES[0])
+    exp_details = sheet.exp_details(sheet_path)
+    assert exp_details['experiment'] == '2024Jan01_synthetic'
+    assert exp_details['date'] == '2024-01-01T00:00:00'
+    assert len(exp_details['samples']) == 2 * len(BARCODES)
+
+
+def test_crlf_and_blank_rows(sheet_path):
+    lines = read_lines(sheet_path)
+    expected = SampleSheet.parse(lines)
+    # Blank rows as saved by Excel, between and after the Data rows
+    lines = lines[:-3] + [',,,,,,', ''] + lines[-3:] + [',,,,,,', '']
+    with open(sheet_path, 'wb') as f:
+        f.write('\r\n'.join(lines) + '\r\n')
+    sheet = load_samplesheet(sheet_path, cache=False)
+    assert sheet.fields == expected.fields
+    assert sheet.samples == expected.samples
+    assert sheet.header == expected.header
+    assert sheet.reads == expected.reads
+
+
+def test_missing_section(sheet_path):
+    lines = read_lines(sheet_path)
+    with pytest.raises(SampleSheetError) as error:
+        SampleSheet.parse([line for line in lines
+                           if not line.startswith('[Settings]')])
+    assert 'Settings' in str(error.value)
+    data = lines.index('[Data],,,,,,')
+    with pytest.raises(SampleSheetError):
+        SampleSheet.parse(lines[:data + 1])
+
+
+def test_subset(sheet_path):
+    sheet = load_samplesheet(sheet_path)
+    lane2 = sheet.subset([2])
+    assert len(lane2.samples) == len(BARCODES)
+    assert lane2.lane_indexes().keys() == ['2']
+    assert lane2.header == sheet.header
+
+
+def test_mismatch_plan(sheet_path):
+    sheet = load_samplesheet(sheet_path)
+    # i7 indexes are at least 3 apart, so 1 mismatch is always safe
+    plan = sheet.mismatch_plan(mismatches=[1])
+    assert plan['barcode_mismatches'] == [1, 1]
+    assert plan['collisions'] == []
+    plan = sheet.mismatch_plan()
+    assert sum(plan['barcode_mismatches']) >= 2
+    assert plan['collisions'] == []
+    check_plan(plan)
+    # Every pair that rules out 2 mismatches is reported
+    limits = [2 * m for m in plan['barcode_mismatches']]
+    for choice in ([2, 2], [2, 1], [1, 2]):
+        if sum(choice) > sum(plan['barcode_mismatches']):
+            assert any(all(distance <= 2 * m for distance, m in
+                           zip(pair[3], choice))
+                       for pair in plan['close_pairs'])
+    assert all(any(distance > limit for distance, limit in
+                   zip(pair[3], limits)) for pair in plan['close_pairs'])
+
+
+def test_n_in_index(sheet_path):
+    # One base apart in i7 only, N never matches
+    i7, i5 = BARCODES[0]
+    add_sample(sheet_path, 1, 'N1', 'N' + i7[1:], i5)
+    plan = load_samplesheet(sheet_path).mismatch_plan()
+    assert plan['barcode_mismatches'] == [0, 2]
+    assert plan['collisions'] == []
+    assert plan['close_pairs'][0] == ['1', '1', 'N1', [1, 0]]
+
+
+def test_duplicate_index_collides(sheet_path):
+    add_sample(sheet_path, 1, 'Dup', *BARCODES[3])
+    sheet = load_samplesheet(sheet_path)
+    plan = sheet.mismatch_plan()
+    assert plan['barcode_mismatches'] == [0, 0]
+    assert plan['collisions'] == [['1', '4', 'Dup', [0, 0]]]
+    with pytest.raises(SampleSheetError):
+        check_plan(plan)
+    # Lane 2 alone is fine
+    check_plan(sheet.subset([2]).mismatch_plan())
+
+
+def test_cache(sheet_path):
+    sheet = load_samplesheet(sheet_path)
+    plan = sheet.mismatch_plan(mismatches=[1])
+    save_samplesheet_cache(sheet_path, sheet)
+    assert os.path.isfile(os.path.join(os.path.dirname(sheet_path),
+                                       CACHE_NAME))
+    cached = load_samplesheet(sheet_path)
+    assert cached.plans == sheet.plans
+    assert cached.mismatch_plan(mismatches=[1]) == plan
+    assert cached.samples == sheet.samples
+    assert cached.md5 == sheet.md5
+    assert all(isinstance(value, str) for value in cached.samples[0])
+    # An edited sheet is parsed again
+    add_sample(sheet_path, 1, 'Dup', *BARCODES[3])
+    edited = load_samplesheet(sheet_path)
+    assert edited.plans == {}
+    assert len(edited.samples) == len(sheet.samples) + 1
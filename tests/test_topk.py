@@ -0,0 +1,118 @@
+from collections import Counter
+import pytest
+from synthetic_run import SequenceSource, make_barcodes, undetermined_barcode
+from topk import HyperLogLog, SpaceSaving, pack_barcode, unpack_barcode
+
+
+@pytest.fixture(scope='module')
+def undetermined():
+    # Barcodes of Undetermined reads: errors, hopped pairs, poly-G and N
+    source = SequenceSource(3)
+    barcodes = make_barcodes(3, 24)
+    return [undetermined_barcode(source, barcodes) for _ in xrange(20000)]
+
+
+@pytest.mark.parametrize('barcode', ['ACGTACGT', 'AAAAAAAA+CCCCCCCC',
+                                     'A', '+ACGT', 'ACGT+', 'TTTT+AAAAAA'])
+def test_pack_round_trip(barcode):
+    key = pack_barcode(barcode)
+    assert isinstance(key, (int, long))
+    assert unpack_barcode(key) == barcode
+
+
+@pytest.mark.parametrize('barcode', ['ACGNACGT', 'NNNNNNNN+ACGTACGT', '',
+                                     'AC+GT+AC', 'acgt'])
+def test_pack_keeps_other_barcodes_as_strings(barcode):
+    assert pack_barcode(barcode) == barcode
+    assert unpack_barcode(barcode) == barcode
+
+
+def test_packed_keys_differ_by_separator():
+    assert pack_barcode('ACGT+ACGT') != pack_barcode('ACGTACGT')
+    assert pack_barcode('ACG+TACGT') != pack_barcode('ACGT+ACGT')
+
+
+def test_space_saving_exact_within_capacity(undetermined):
+    barcodes = undetermined[:5000]
+    exact = Counter(barcodes)
+    sketch = SpaceSaving(len(exact))
+    sketch.update(exact.iteritems())
+    assert sketch.total == len(barcodes)
+    assert all(error == 0 and exact[key] == count
+               for key, count, error in sketch.top())
+
+
+def test_space_saving_bounds(undetermined):
+    barcodes = undetermined
+    exact = Counter(barcodes)
+    sketch = SpaceSaving(64)
+    for barcode in barcodes:
+        sketch.add(pack_barcode(barcode))
+    assert len(sketch) == 64
+    assert sketch.total == len(barcodes)
+    top = dict((unpack_barcode(key), (count, error))
+               for key, count, error in sketch.top())
+    for barcode, (count, error) in top.iteritems():
+        assert count - error <= exact[barcode] <= count
+    # Every barcode seen more than total / capacity times is kept
+    for barcode, count in exact.iteritems():
+        if count > len(barcodes) / 64.0:
+            assert barcode in top
+
+
+def test_space_saving_merge(undetermined):
+    barcodes = undetermined[:10000]
+    merged = SpaceSaving(32)
+    for part in (barcodes[:4000], barcodes[4000:]):
+        sketch = SpaceSaving(32)
+        sketch.update(Counter(part).iteritems())
+        merged.merge(sketch)
+    exact = Counter(barcodes)
+    assert merged.total == len(barcodes)
+    top = merged.top()
+    for key, count, error in top:
+        assert count - error <= exact[key] <= count
+    kept = set(key for key, count, error in top)
+    for barcode, count in exact.iteritems():
+        if count > len(barcodes) / 32.0:
+            assert barcode in kept
+
+
+def test_space_saving_capacity():
+    with pytest.raises(ValueError):
+        SpaceSaving(0)
+
+
+@pytest.mark.parametrize('num_keys', [0, 1, 100, 3000, 50000])
+def test_hyperloglog_count(num_keys):
+    sketch = HyperLogLog()
+    sketch.update('UMI%d' % i for i in xrange(num_keys))
+    # About 1.6% standard error at precision 12
+    assert abs(sketch.count() - num_keys) <= max(2, 0.05 * num_keys)
+
+
+def test_hyperloglog_ignores_repeats(undetermined):
+    sketch = HyperLogLog()
+    sketch.update(undetermined)
+    count = sketch.count()
+    sketch.update(undetermined[:5000])
+    assert sketch.count() == count
+
+
+def test_hyperloglog_merge_is_union():
+    keys = ['UMI%d' % i for i in xrange(20000)]
+    whole = HyperLogLog()
+    whole.update(keys)
+    merged = HyperLogLog()
+    for part in (keys[:12000], keys[8000:]):
+        sketch = HyperLogLog()
+        sketch.update(part)
+        merged.merge(sketch)
+    assert merged.registers == whole.registers
+
+
+def test_hyperloglog_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(3)
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(10))
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+import heapq
+import math
+import string
+
+# Barcodes made of ACGT (with an optional '+' between the i7 and i5 index)
+# are packed 2 bits per base into a single int. The low 6 bits hold the
+# position of the '+', NO_SEPARATOR if there is none, and a leading 1 bit
+# keeps leading A's. Barcodes with N or other characters stay strings.
+BASE_DIGITS = string.maketrans('ACGT', '0123')
+NO_SEPARATOR = 63
+
+
+def pack_barcode(barcode):
+    i7, sep, i5 = barcode.partition('+')
+    bases = i7 + i5
+    if not bases or bases.translate(None, 'ACGT') or \
+            len(i7) >= NO_SEPARATOR or '+' in i5:
+        return barcode
+    position = len(i7) if sep else NO_SEPARATOR
+    return int('1' + bases.translate(BASE_DIGITS), 4) << 6 | position
+
+
+def unpack_barcode(key):
+    if isinstance(key, str):
+        return key
+    position = key & NO_SEPARATOR
+    key >>= 6
+    bases = []
+    while key > 1:
+        bases.append('ACGT'[key & 3])
+        key >>= 2
+    bases.reverse()
+    if position != NO_SEPARATOR:
+        bases.insert(position, '+')
+    return ''.join(bases)
+
+
+class SpaceSaving(object):
+    # Space-Saving heavy hitters sketch (Metwally et al.) with weighted
+    # updates. At most capacity keys are kept, so memory does not depend on
+    # the number of distinct keys in the input. Counts are upper bounds and
+    # count - error lower bounds of the true counts, every key seen more
+    # than total / capacity times is guaranteed to be kept.
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('Capacity must be positive, got %d' % capacity)
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # Min-heap of (count, key). Counts only grow, so an entry whose
+        # count is out of date is refreshed when it reaches the top.
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1, error=0):
+        self.total += count
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            self.errors[key] += error
+        elif len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = error
+            heapq.heappush(self.heap, (count, key))
+        else:
+            min_count, min_key = self._pop_min()
+            del self.errors[min_key]
+            del counts[min_key]
+            counts[key] = min_count + count
+            self.errors[key] = min_count + error
+            heapq.heappush(self.heap, (counts[key], key))
+
+    def _pop_min(self):
+        heap = self.heap
+        while True:
+            count, key = heap[0]
+            current = self.counts[key]
+            if current == count:
+                return heapq.heappop(heap)
+            heapq.heapreplace(heap, (current, key))
+
+    def update(self, counts):
+        # Add an iterable of (key, count) pairs
+        add = self.add
+        for key, count in counts:
+            add(key, count)
+
+    def merge(self, other):
+        for key, count in other.counts.iteritems():
+            self.add(key, count, other.errors[key])
+
+    def top(self, n=None):
+        # (key, count, error) of the n largest counts, all kept keys if n
+        # is None
+        keys = sorted(self.counts, key=self.counts.get, reverse=True)[:n]
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+
+# Multipliers of the MurmurHash3 finalizer that spreads hash() over 64 bits.
+# Python 2 hashes of similar strings, e.g. UMIs or numbered names, differ
+# mostly in their low bits, a single multiplication leaves the counts of
+# such keys up to 15% too high.
+HASH_MULTIPLIERS = (0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53)
+HASH_MASK = (1 << 64) - 1
+
+
+class HyperLogLog(object):
+    # HyperLogLog distinct count (Flajolet et al.) with 2 ** precision one
+    # byte registers, the standard error is about 1.04 / sqrt(2 **
+    # precision). Sketches of the same precision merge by taking the larger
+    # register, so chunks can be counted in different processes. Keys are
+    # hashed with hash(), sketches must come from the same Python build.
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError('Precision must be 4 to 16, got %d' % precision)
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def update(self, keys):
+        registers = self.registers
+        shift = 64 - self.precision
+        rest_mask = (1 << shift) - 1
+        first, second = HASH_MULTIPLIERS
+        for key in keys:
+            h = hash(key) & HASH_MASK
+            h = ((h ^ (h >> 33)) * first) & HASH_MASK
+            h = ((h ^ (h >> 33)) * second) & HASH_MASK
+            h ^= h >> 33
+            index = h >> shift
+            # Position of the first 1 bit in the remaining bits
+            rank = shift - (h & rest_mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Precisions %d and %d differ' % (
+                self.precision, other.precision))
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank
+                                       for rank in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small counts
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
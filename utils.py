@@ -1,79 +1,36 @@
 #!/usr/bin/python
-import re
-import datetime
+import errno
 import os
+import time
 from collections import defaultdict
 import sys
 import json
 import glob
 import shutil
+from functools import partial
 from subprocess import check_call
 import rnaseq_rest.helpers as rest
 from AddUmiNugen import *
-from multiprocessing import Pool
-
-
-def find_string_index(input_str, input_list):
-    regex = re.compile(".*" + input_str + ".*")
-    item = [m.group(0) for i in input_list for m in [regex.search(i)] if m]
-    return input_list.index(item[0])
+from interop import (read_index_metrics, run_summary, write_index_summary,
+                     write_sav_summary)
+from read_stats import ReadStats, tagged_stats
+from samplesheet import load_samplesheet
+from s3_upload import upload_run
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+# Rough upper bound for the memory held by one read triplet of a chunk in
+# flight, input chunk and tagged output together
+CHUNK_RECORD_BYTES = 2048
+# Name ending of the tagged FASTQs written by AddUmiNugen
+UMI_SUFFIX = '_UMI_001.fastq.gz'
+# Written in a sample folder once its tagged FASTQs are complete and removed
+# after the untagged ones were moved away
+TAGGED_MARKER = 'UMI_TAGGED'
 
 
 def parse_samplesheet(infile):
-
-    exp_details = {}
-    samples = []
-    with open(infile) as f:
-        samplesheet = f.read().splitlines()
-
-    header = find_string_index('Header', samplesheet)
-    reads = find_string_index('Reads', samplesheet)
-    settings = find_string_index('Settings', samplesheet)
-    data = find_string_index('Data', samplesheet)
-
-    for lines in samplesheet[header:reads]:
-        if re.match("Investigator", lines):
-            exp_details["investigator"] = lines.rstrip().split(",")[
-                1].replace(" ", "_")
-        elif re.match("Experiment", lines):
-            exp_details["experiment"] = lines.rstrip().split(",")[
-                1].replace(" ", "_")
-        elif re.match("Description", lines):
-            exp_details["description"] = lines.rstrip().split(",")[
-                1].replace(" ", "_")
-            if re.search("\%", exp_details["experiment"]):
-                # Munich style samplesheet
-                exp_details['date'] = datetime.datetime.fromtimestamp(
-                    os.path.getctime(infile)).isoformat()
-            else:
-                try:
-                    exp_details['date'] = datetime.datetime.strptime(
-                        exp_details["experiment"].split("_")[0],
-                        '%Y%b%d').isoformat()
-                except ValueError:
-                    exp_details['date'] = datetime.datetime.fromtimestamp(
-                        os.path.getctime(infile)).isoformat()
-        elif re.match("Annotations", lines):
-            exp_details["annotations"] = lines.rstrip().split(
-                ",")[1].split("|")
-
-    sample_fields = samplesheet[data + 1].split(",")
-    read_data = ' '.join(samplesheet[reads + 1:settings])
-    read_lengths = re.findall('[0-9]+', read_data)
-    exp_details['read_lengths'] = read_lengths
-
-    for lines in samplesheet[data + 2:]:
-        if "annotations" in exp_details:
-            lines_data = lines.split(",")
-            sample_data = dict(zip(sample_fields[:-1], lines_data[:-1]))
-            sample_data["annotations"] = dict(
-                zip(exp_details["annotations"], lines_data[-1].split("|")))
-            samples.append(sample_data)
-        else:
-            samples.append(dict(zip(sample_fields, lines.split(","))))
-
-    exp_details["samples"] = samples
-    return exp_details
+    return load_samplesheet(infile).exp_details(infile)
 
 
 def print_summary(summary, fields=[], width=15):
@@ -101,28 +58,31 @@ def summarize(summary, field, avg=True):
 
 
 def count_indices(rundir):
-    index_counts = defaultdict(int)
+    # One entry per sample with its index, read count and read count per
+    # lane. Counts are keyed by sample rather than index sequence, so the
+    # same index used by different samples in different lanes is not merged.
+    sample_counts = defaultdict(int)
+    lane_counts = defaultdict(dict)
     samples = {}
     empty_index = [{'Sample': '', 'Index': '', 'Counts': ''}]
     index_metrics = []
-    index_file = os.path.join(rundir, "index_summary.csv")
-    if os.path.isfile(index_file):
-        infile = open(index_file, 'r')
-        for lines in infile:
-            if lines[0] == '#' or lines[0] == 'L':
-                continue
-            else:
-                fields = lines.rstrip().split(",")
-                samples[fields[4]] = fields[3]
-                # Only count for read 1 to prevent double counting
-                if fields[2] == '1':
-                    index_counts[fields[3]] += int(fields[6])
-        infile.close()
+    index_rows = read_index_metrics(rundir)
+    if index_rows:
+        # Keep the text version next to the run for barcode_bleedthrough
+        write_index_summary(os.path.join(rundir, "index_summary.csv"),
+                            index_rows)
+        for lane, tile, read, index, sample, project, count in index_rows:
+            samples.setdefault(sample, index)
+            # Only count for read 1 to prevent double counting
+            if read == 1:
+                sample_counts[sample] += count
+                lanes = lane_counts[sample]
+                lanes[lane] = lanes.get(lane, 0) + count
         if samples:
-            for sample in samples.keys():
-                index_metrics.append({'Sample': sample, 'Index': samples[
-                                     sample],
-                    'Counts': index_counts[samples[sample]]})
+            for sample, index in samples.iteritems():
+                index_metrics.append({'Sample': sample, 'Index': index,
+                                      'Counts': sample_counts[sample],
+                                      'Lanes': lane_counts[sample]})
             try:
                 index_metrics = sorted(
                     index_metrics, key=lambda x: int(x['Sample']))
@@ -136,37 +96,36 @@ def count_indices(rundir):
         return empty_index
 
 
+def lookup_by(items, key):
+    # Dict of items by the value of key, the first item wins like the
+    # linear searches this replaces
+    lookup = {}
+    for item in items:
+        lookup.setdefault(item.get(key), item)
+    return lookup
+
+
 def add_samplenames_to_index(index_metrics, exp_details):
     if index_metrics[0]['Sample'] == '':
         index_metrics[0]['SampleName'] = ''
         return index_metrics
     else:
+        by_id = lookup_by(exp_details['samples'], 'Sample_ID')
         for index in index_metrics:
-            sample = filter(lambda x: x['Sample_ID'] == index[
-                            'Sample'], exp_details['samples'])
-            if sample:
-                index['SampleName'] = sample[0]['Sample_Name']
+            sample = by_id.get(index['Sample'])
+            if sample is not None:
+                index['SampleName'] = sample['Sample_Name']
             else:
                 index['SampleName'] = 'Unknown'
         return index_metrics
 
 
 def summarize_SAV(rundir):
-    summary_file = os.path.join(rundir, "SAV_summary.tsv")
-    with open(summary_file, 'r') as f:
-        data = f.read().splitlines()
-    version = find_string_index('# Version', data)
-    lane = find_string_index('#Per', data)
-
-    fields = data[version + 1].rstrip().split('\t')
-    read_summary = []
-    for lines in data[version + 2:lane]:
-        read_summary.append(dict(zip(fields, lines.rstrip().split('\t'))))
-
-    fields = data[lane + 1].rstrip().split('\t')
-    lane_summary = []
-    for lines in data[lane + 2:]:
-        lane_summary.append(dict(zip(fields, lines.rstrip().split('\t'))))
+    # Summaries are computed from the InterOp binaries, the text version
+    # is still written to SAV_summary.tsv to be copied with the run
+    read_summary, lane_summary = run_summary(rundir)
+    write_sav_summary(os.path.join(rundir, "SAV_summary.tsv"), read_summary,
+                      lane_summary)
 
     read_fields = ['Level', 'Yield', 'Aligned%', 'Error Rate%', '%>=Q30']
     lane_fields = ['Lane', 'Read', 'Density(k/mm2)', 'Cluster PF%',
@@ -205,45 +164,51 @@ def summarize_SAV(rundir):
 
 
 def upload_run_to_S3(s3cfg, output_dir, s3_folder, region='us-east-1',
-                     s4=False):
+                     options=None, pipeline=None):
     # For Frankfurt use eu-central-1 region
-    # TO DO Add ability to specify region to s4cmd
-    if s4:
-        s4cmd = "s4cmd -p %s dsync --retry 10 -c 12" % s3cfg
-        s4cmdopts = (" --ignore-empty-source --retry 5 -c 12 -f -r -s "
-                     "--API-ServerSideEncryption=AES256 ")
-        run_name = os.path.split(output_dir)[1]
-        error = os.system("%s %s %s %s%s" % (
-            s4cmd, s4cmdopts, output_dir, s3_folder, run_name))
-        # TO DO s4cmd barfs on uploading empty files. Need to fix
-        error = 0
-    else:
-        error = 1
-        count = 0
-        s3cmd = "s3cmd -c %s sync --limit-rate=10m" % s3cfg
-        while (error and count <= 5):
-            error = os.system("%s --region=%s --server-side-encryption %s %s" %
-                              (s3cmd, region, output_dir, s3_folder))
-            count += 1
-    return error
+    # Returns the number of files that failed to upload, 0 on success
+    return len(upload_run(s3cfg, output_dir, s3_folder, region, options,
+                          pipeline=pipeline))
 
 
 def update_expdetails_with_counts(exp_details, index_metrics):
     samples = exp_details['samples']
+    by_name = lookup_by(index_metrics, 'SampleName')
     for sample in samples:
-        sample_data = filter(lambda x: x['SampleName'] == sample[
-                             'Sample_Name'], index_metrics)
-        if sample_data:
-            counts = sample_data[0]['Counts']
-        else:
+        sample_data = by_name.get(sample.get('Sample_Name'))
+        if sample_data is None:
             # Handle cases where the initial samplesheet in incorrect
             # leading to incorrect counts in IndexMetrics.bin
             counts = 0
+        elif sample.get('Lane', '').isdigit() and 'Lanes' in sample_data:
+            # Samplesheets with a Lane column list a sample once per lane
+            counts = sample_data['Lanes'].get(int(sample['Lane']), 0)
+        else:
+            counts = sample_data['Counts']
         sample['Counts'] = counts
     exp_details['samples'] = samples
     return exp_details
 
 
+def update_expdetails_with_read_stats(exp_details, read_stats):
+    # read_stats are the statistics of the UMI tagger by sample folder. Its
+    # read counts replace those of the index metrics, which are wrong when
+    # the samplesheet was corrected, except for samples listed once per
+    # lane since their FASTQs hold the reads of all lanes.
+    rows = defaultdict(int)
+    for sample in exp_details['samples']:
+        rows[sample.get('Sample_ID')] += 1
+    for sample in exp_details['samples']:
+        stats = read_stats.get(sample.get('Sample_ID')) or \
+            read_stats.get(sample.get('Sample_Name'))
+        if stats is None:
+            continue
+        sample['read_stats'] = stats
+        if rows[sample.get('Sample_ID')] == 1:
+            sample['Counts'] = stats['Reads']
+    return exp_details
+
+
 def create_run_in_db(dbserver, dbuser, dbpasswd, runjson):
     rest.init(dbserver, username=dbuser, password=dbpasswd)
     with open(runjson, 'r') as f:
@@ -264,34 +229,161 @@ def makedir(path):
         else:
             raise
 
-def add_UMI_to_read(indir):
-    sys.stderr.write('Processing %s\n' % indir)
-    raw_fq = glob.glob(indir + '/*.gz')
-    add_umi(indir, indir)
-    makedir(indir + '/raw_data')
-    for fq in raw_fq:
-        sys.stderr.write('moving %s to %s\n' % (fq, indir + '/rawdata'))
-        shutil.move(fq, indir + '/raw_data')
+def sample_input_bytes(indir):
+    return sum(os.path.getsize(fq) for fq in glob.glob(indir + '/*.gz'))
 
 
-def add_UMI_to_read_se(indir):
-    sys.stderr.write('Processing %s\n' % indir)
-    raw_fq = glob.glob(indir + '/*.gz')
-    add_umi_se(indir, indir)
-    makedir(indir + '/raw_data')
-    for fq in raw_fq:
-        sys.stderr.write('moving %s to %s\n' % (fq, indir + '/rawdata'))
-        shutil.move(fq, indir + '/raw_data')
+def store_raw(indir, raw_fq, keep_raw):
+    # Move the untagged FASTQs of a tagged sample to raw_data or remove them
+    if keep_raw:
+        makedir(indir + '/raw_data')
+        for fq in raw_fq:
+            sys.stderr.write('moving %s to %s\n' % (fq, indir + '/rawdata'))
+            shutil.move(fq, indir + '/raw_data')
+    else:
+        for fq in raw_fq:
+            sys.stderr.write('removing %s\n' % fq)
+            os.remove(fq)
+    os.remove(os.path.join(indir, TAGGED_MARKER))
 
 
-def processUMI(rundir, run_details, single_end=False):
+def add_UMI_to_read(indir, compression=None, pool=None, max_pending=None,
+                    single_end=False, chunk_size=CHUNK_RECORDS,
+                    keep_raw=True):
+    sys.stderr.write('Processing %s\n' % indir)
+    raw_fq = glob.glob(indir + '/*.gz')
+    input_bytes = sample_input_bytes(indir)
+    stats = ReadStats()
+    start = time.time()
+    if single_end:
+        records = add_umi_se(indir, indir, chunk_size=chunk_size,
+                             compression=compression, pool=pool,
+                             max_pending=max_pending, stats=stats)
+    else:
+        records = add_umi(indir, indir, chunk_size=chunk_size,
+                          compression=compression, pool=pool,
+                          max_pending=max_pending, stats=stats)
+    elapsed = time.time() - start
+    open(os.path.join(indir, TAGGED_MARKER), 'w').close()
+    store_raw(indir, raw_fq, keep_raw)
+    throughput = {'sample': os.path.basename(indir), 'bytes': input_bytes,
+                  'records': records, 'seconds': elapsed,
+                  'MB/s': input_bytes / 1e6 / max(elapsed, 1e-6),
+                  'records/s': records / max(elapsed, 1e-6),
+                  'stats': stats.summary()}
+    sys.stderr.write('Tagged %s: %.1f MB in %.1f s (%.1f MB/s)\n' % (
+        throughput['sample'], input_bytes / 1e6, elapsed, throughput['MB/s']))
+    return throughput
+
+
+def add_UMI_to_read_se(indir, compression=None, pool=None, max_pending=None,
+                       chunk_size=CHUNK_RECORDS, keep_raw=True):
+    return add_UMI_to_read(indir, compression, pool, max_pending, True,
+                           chunk_size, keep_raw)
+
+
+def get_umi_options(settings):
+    # Scheduler options for processUMI from config.cfg, empty values fall
+    # back to the defaults of processUMI
+    options = {}
+    for key, option in (('umi_processes', 'processes'),
+                        ('umi_memory_mb', 'memory_mb'),
+                        ('umi_parallel_samples', 'parallel_samples'),
+                        ('umi_chunk_size', 'chunk_size')):
+        if settings.get(key):
+            options[option] = int(settings[key])
+    if settings.get('umi_keep_raw'):
+        options['keep_raw'] = settings['umi_keep_raw'].lower() == 'true'
+    elif umi_fast_intermediates(settings):
+        # The raw FASTQs are only fast compressed intermediates then
+        options['keep_raw'] = False
+    return options
+
+
+def umi_fast_intermediates(settings):
+    return settings.get('umi_fast_intermediates', '').lower() == 'true'
+
+
+def tagged_before(indir, keep_raw=True):
+    # Resuming a sample: True if it was tagged and only the checkpoint is
+    # missing, otherwise the outputs of an interrupted tagging are removed
+    # so they are neither read as input nor moved to raw_data. Untagged
+    # FASTQs left by an interrupted move of a tagged sample are moved now.
+    outputs = glob.glob(indir + '/*' + UMI_SUFFIX)
+    raw_fq = [fq for fq in glob.glob(indir + '/*.gz') if fq not in outputs]
+    if os.path.isfile(os.path.join(indir, TAGGED_MARKER)):
+        store_raw(indir, raw_fq, keep_raw)
+        return True
+    if outputs and not raw_fq:
+        return True
+    for fq in outputs:
+        sys.stderr.write('removing partial %s\n' % fq)
+        os.remove(fq)
+    return False
+
+
+def processUMI(rundir, run_details, single_end=False, compression=None,
+               processes=None, memory_mb=4096, parallel_samples=None,
+               chunk_size=CHUNK_RECORDS, keep_raw=True, done_samples=(),
+               sample_done=None, sample_stats=None):
+    # All samples share one pool of tagging workers. Samples are started
+    # largest first from a few reader threads and every sample is split
+    # into chunks, so large samples spread over all workers and the step
+    # takes about total bytes / cores instead of the largest sample.
+    # Samples in done_samples are skipped and sample_done is called with
+    # the name and read statistics of every sample as soon as it is tagged.
+    # Samples found tagged before get their statistics from sample_stats,
+    # or from their tagged FASTQs if they were not kept.
     project_name = run_details['samples'][0]['Sample_Project']
     sample_list = os.listdir(rundir + '/' + project_name)
     project_dir = rundir + '/' + project_name
     sys.stderr.write('Base directory is %s\n' % project_dir)
-    sample_dirs = [project_dir + '/' + i for i in sample_list]
-    pool = Pool(processes=8)
-    if single_end:
-        pool.map(add_UMI_to_read_se, sample_dirs)
-    else:
-        pool.map(add_UMI_to_read, sample_dirs)
+    sample_dirs = [project_dir + '/' + i for i in sample_list
+                   if i not in done_samples]
+    sample_dirs = [d for d in sample_dirs if os.path.isdir(d)]
+    if done_samples:
+        sys.stderr.write('Skipping %d tagged samples\n' % len(done_samples))
+    for d in [d for d in sample_dirs if tagged_before(d, keep_raw)]:
+        sample_dirs.remove(d)
+        if sample_done is not None:
+            name = os.path.basename(d)
+            stats = (sample_stats or {}).get(name)
+            if stats is None:
+                stats = tagged_stats(sorted(glob.glob(d + '/*' + UMI_SUFFIX)),
+                                     compression).summary()
+            sample_done(name, stats)
+    sample_bytes = dict((d, sample_input_bytes(d)) for d in sample_dirs)
+    sample_dirs.sort(key=sample_bytes.get, reverse=True)
+    if not sample_dirs:
+        return []
+    if not processes:
+        processes = cpu_count()
+    if not parallel_samples:
+        parallel_samples = max(1, processes // 4)
+    parallel_samples = min(parallel_samples, len(sample_dirs))
+    max_pending = max(2, memory_mb * 2 ** 20 // (
+        parallel_samples * chunk_size * CHUNK_RECORD_BYTES))
+    sys.stderr.write('Tagging %d samples (%.1f GB) with %d workers, %d '
+                     'samples at a time\n' % (
+                         len(sample_dirs), sum(sample_bytes.values()) / 1e9,
+                         processes, parallel_samples))
+    pool = Pool(processes=processes)
+    tag = partial(add_UMI_to_read, compression=compression, pool=pool,
+                  max_pending=max_pending, single_end=single_end,
+                  chunk_size=chunk_size, keep_raw=keep_raw)
+
+    def tag_sample(indir):
+        throughput = tag(indir)
+        if sample_done is not None:
+            sample_done(throughput['sample'], throughput['stats'])
+        return throughput
+
+    readers = ThreadPool(processes=parallel_samples)
+    try:
+        throughput = readers.map(tag_sample, sample_dirs, chunksize=1)
+        pool.close()
+    finally:
+        readers.terminate()
+        pool.terminate()
+        pool.join()
+    return throughput